@@ -1,8 +1,19 @@
 import requests
 import os
 import re
-from bs4 import BeautifulSoup
+import shutil
 import tarfile
+import tempfile
+
+from singleflight import KeyedLocks
+from tracing import span
+
+# Overridable so that the benchmarks (see benchmarks/) can point them to local stand-ins.
+ARXIV_API_URL = os.environ.get("ARXIV_API_URL", "https://export.arxiv.org/api/query")
+ARXIV_EPRINT_URL = os.environ.get("ARXIV_EPRINT_URL", "https://arxiv.org/e-print/")
+
+# Threads downloading the same paper wait for the first one instead of downloading it again.
+download_locks = KeyedLocks()
 
 def untar(fname, dirs):
     """
@@ -42,13 +53,59 @@ def expand_inputs(base_path, file_content):
     
     return re.sub(input_pattern, replacer, file_content)
 
+def find_main_tex(output_path):
+    """
+    Finds the main .tex file of an extracted LaTeX source.
+
+    :param output_path: The directory the source was extracted to.
+    :return: The file name of the main .tex file.
+    """
+    # Then we check which file is the main one. For this we check a .bbl file and start with the corresponding .tex file. 
+    # Find the .bbl file
+    main_tex = None
+    for root, dirs, files in os.walk(output_path):
+        for file in files:
+            if file.endswith(".bbl"):
+                main_tex = file[:-4] + ".tex"
+                break
+
+    if main_tex is None:
+        # If no .bbl file is found, we just take the first .tex file we find
+        for root, dirs, files in os.walk(output_path):
+            for file in files:
+                if file.endswith(".tex"):
+                    main_tex = file
+                    break
+    return main_tex
+
+def parse_sections(all_content):
+    """
+    Splits the expanded LaTeX content into sections.
+
+    :param all_content: The expanded LaTeX content.
+    :return: (introduction, sections), where sections maps each section title to its content.
+    """
+    # Placeholder for introduction retrieval
+    all_content += r"\section{dummy}"
+
+    sections = dict()
+    introduction = ""
+
+    # The lookahead keeps the next section's header from being consumed by this match.
+    for m in re.finditer(r'\\section{(.*?)}(.*?)(?=\\section{)', all_content, re.DOTALL):
+        sec_title = m.group(1)
+        sec_content = m.group(2)
+
+        if sec_title == "Introduction":
+            introduction = sec_content
+        sections[sec_title] = sec_content
+
+    return introduction, sections
+
 class ArXiv:
     def __init__(self, paperlink=None, download=False):
         if paperlink is not None:
-            arxiv_id = paperlink.split('/')[-1]
-            if arxiv_id.endswith("pdf"):
-                # Getting rid of pdf suffix.
-                arxiv_id = arxiv_id[:-4]
+            arxiv_id = ArXiv.id_from_link(paperlink)
 
             self2 = ArXiv.search_arxiv([arxiv_id])[0]
             for k, v in self2.__dict__.items():
@@ -57,53 +114,27 @@ class ArXiv:
             if download:
                 self.download_latex()
 
-    def download_latex(self):
-        arxiv_id = self.arxiv_id
-        output_path = f"./{arxiv_id}"
-
-        if not os.path.exists(output_path):
-            source_link = "https://arxiv.org/e-print/" + arxiv_id
-            response = requests.get(source_link)
-            filename = arxiv_id + ".tar.gz"
-            with open(filename, "wb") as f:
-                f.write(response.content)
-
-            untar(filename, output_path)
-            # delete all non .tex files in all the root folders and subfolders to save space
-            # and put all tex files into a long text
-            # Traverse recursively  
-            for root, dirs, files in os.walk(output_path):
-                for file in files:
-                    if not file.endswith(".tex") and not file.endswith(".bbl"):
-                        os.remove(os.path.join(root, file))
-                        
-            # also remove the tar.gz file
-            os.remove(filename)
+    @staticmethod
+    def id_from_link(paperlink):
+        arxiv_id = paperlink.split('/')[-1]
+        if arxiv_id.endswith("pdf"):
+            # Getting rid of pdf suffix.
+            arxiv_id = arxiv_id[:-4]
+        return arxiv_id
 
-        # Then we check which file is the main one. For this we check a .bbl file and start with the corresponding .tex file. 
-        # Find the .bbl file
-        main_tex = None
-        for root, dirs, files in os.walk(output_path):
-            for file in files:
-                if file.endswith(".bbl"):
-                    main_tex = file[:-4] + ".tex"
-                    break
+    def download_latex(self, throttle=None):
+        """Downloads (unless already on disk) and parses the LaTeX source.
 
-        if main_tex is None:
-            # If no .bbl file is found, we just take the first .tex file we find
-            for root, dirs, files in os.walk(output_path):
-                for file in files:
-                    if file.endswith(".tex"):
-                        main_tex = file
-                        break
+        :param throttle: Optional paper_cache.Throttle capping the download bandwidth, for background prefetches.
+        """
+        arxiv_id = self.arxiv_id
+        output_path = f"./{arxiv_id}"
 
-        # Then we do recursive expansion. 
-        with open(os.path.join(output_path, main_tex), 'r') as f:
-            content = f.read()
-            all_content = expand_inputs(output_path, content)
+        with download_locks.get(arxiv_id):
+            if not os.path.exists(output_path):
+                self._download_source(arxiv_id, output_path, throttle)
 
-        # Placeholder for introduction retrieval
-        all_content += r"\section{dummy}"
+        all_content = self._read_source(output_path)
 
         # title = arxiv_info["title"] 
         # abstract = arxiv_info["abstract"]
@@ -114,26 +145,64 @@ class ArXiv:
         # with open(f"{arxiv_id}.tex", "w") as f:
         #     f.write(all_content)
 
-        sections = dict()
-        introduction = ""
-
-        for m in re.finditer(r'\\section{(.*?)}(.*?)\\section{', all_content, re.DOTALL):
-            sec_title = m.group(1)
-            sec_content = m.group(2)
-
-            if sec_title == "Introduction":
-                introduction = sec_content
-            sections[sec_title] = sec_content
+        introduction, sections = parse_sections(all_content)
 
-        self._all_content = all_content
+        # The expanded source is not kept, the sections hold the same text and all_content reads it again from
+        # disk when needed. The introduction is the same string as its section.
         self._introduction = introduction
         self._sections = sections 
+
+    @staticmethod
+    def _read_source(output_path):
+        main_tex = find_main_tex(output_path)
+
+        # Then we do recursive expansion. 
+        with open(os.path.join(output_path, main_tex), 'r') as f:
+            content = f.read()
+            return expand_inputs(output_path, content)
     
+    @staticmethod
+    def _download_source(arxiv_id, output_path, throttle=None):
+        # Extract into a scratch directory next to output_path and rename it into place once complete, so that
+        # readers (and other processes) never see a partially extracted paper.
+        work_dir = tempfile.mkdtemp(prefix=f".{arxiv_id}.", dir=os.path.dirname(output_path) or ".")
+        try:
+            source_link = ARXIV_EPRINT_URL + arxiv_id
+            filename = os.path.join(work_dir, arxiv_id + ".tar.gz")
+            with span("arxiv.download", arxiv_id=arxiv_id, throttled=throttle is not None):
+                response = requests.get(source_link, stream=throttle is not None)
+                with open(filename, "wb") as f:
+                    if throttle is None:
+                        f.write(response.content)
+                    else:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            throttle.consume(len(chunk), arxiv_id)
+                            f.write(chunk)
+
+            extract_path = os.path.join(work_dir, "source")
+            untar(filename, extract_path)
+            # delete all non .tex files in all the root folders and subfolders to save space
+            # and put all tex files into a long text
+            # Traverse recursively  
+            for root, dirs, files in os.walk(extract_path):
+                for file in files:
+                    if not file.endswith(".tex") and not file.endswith(".bbl"):
+                        os.remove(os.path.join(root, file))
+
+            try:
+                os.rename(extract_path, output_path)
+            except OSError:
+                # Another process got there first, its copy is just as good.
+                if not os.path.exists(output_path):
+                    raise
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
     @property
     def all_content(self):
-        if not hasattr(self, "_all_content"):
+        if not hasattr(self, "_sections"):
             self.download_latex()
-        return self._all_content    
+        return self._read_source(f"./{self.arxiv_id}")
     
     @property
     def introduction(self):
@@ -149,10 +218,12 @@ class ArXiv:
 
     @staticmethod
     def search_arxiv(keywords):
-        url = f"https://export.arxiv.org/api/query?search_query=all:{'+'.join(keywords)}&start=0&max_results=10&sortBy=relevance&sortOrder=descending"
-        response = requests.get(url)
+        url = f"{ARXIV_API_URL}?search_query=all:{'+'.join(keywords)}&start=0&max_results=10&sortBy=relevance&sortOrder=descending"
+        with span("arxiv.search"):
+            response = requests.get(url)
 
-        # use BeautifulSoup to parse the response
+        # use BeautifulSoup to parse the response, imported here as only searching needs it
+        from bs4 import BeautifulSoup
         parser = BeautifulSoup(response.text, features="xml")
 
         # extract title, summary and authors of the arXiv paper
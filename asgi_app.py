@@ -0,0 +1,226 @@
+"""
+Production ASGI serving path for the web app. It serves the same routes as main.py (which stays the Flask
+development server), but the handlers await the transcoding and the OpenAI calls, so one slow Whisper or GPT-4
+call doesn't tie up a worker.
+
+Run with `hypercorn asgi_app:app --bind 0.0.0.0:5000`.
+"""
+import asyncio
+import os
+import tempfile
+import time
+from contextlib import ExitStack
+
+from quart import Quart, Response, g, request, jsonify, send_from_directory, stream_with_context
+
+from audio_preprocess import ASR_AUDIO_EXTENSION, prepare_for_asr
+from core import (
+    paraphrase_text_async,
+    paraphrase_text_stream_async,
+)
+from main import (
+    SSE_HEADERS,
+    asr_backend,
+    ext_name_from_content_type,
+    format_sse,
+    live_sessions,
+    log_note,
+    paraphrase_router,
+    transcript_cache,
+)
+from tracing import METRICS_CONTENT_TYPE, render_metrics, span, start_trace
+from transcript_cache import content_key
+
+# Max number of requests doing transcoding / LLM work at the same time, others wait for a slot.
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "32"))
+# Seconds before a request (including the time waiting for a slot) is given up with 504.
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "300"))
+
+app = Quart(__name__)
+# Quart cancels responses after 60 seconds by default, which is shorter than a long GPT-4 call.
+app.config["RESPONSE_TIMEOUT"] = REQUEST_TIMEOUT + 10
+request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+
+@app.before_request
+async def begin_request_trace():
+    g.trace_stack = ExitStack()
+    g.trace_stack.enter_context(start_trace(route=request.path))
+
+
+@app.teardown_request
+async def end_request_trace(exc):
+    trace_stack = g.pop('trace_stack', None)
+    if trace_stack is not None:
+        trace_stack.close()
+
+
+async def run_limited(coro):
+    """Runs the coroutine under the concurrency limit and the request timeout."""
+    async def limited():
+        async with request_slots:
+            return await coro
+    return await asyncio.wait_for(limited(), REQUEST_TIMEOUT)
+
+
+async def transcribe_uploaded_file(audio_file, ext_name: str) -> str:
+    audio_data = audio_file.read()
+    # The same recording uploaded again is served from the transcript cache, without transcoding it.
+    cache_keys = [await asyncio.to_thread(content_key, audio_data)]
+    if transcript_cache:
+        cached = await asyncio.to_thread(transcript_cache.get, cache_keys, asr_backend)
+        if cached is not None:
+            return cached
+    with tempfile.NamedTemporaryFile(suffix=f'.{ext_name}') as temp_audio_file:
+        temp_audio_file.write(audio_data)
+        temp_audio_file.flush()
+        # Default is AAC, downmixed, trimmed and re-encoded for the ASR upload, see audio_preprocess.py.
+        with tempfile.NamedTemporaryFile(suffix=ASR_AUDIO_EXTENSION) as temp_output_file:
+            with span("transcode") as transcode:
+                report = await asyncio.to_thread(prepare_for_asr, temp_audio_file.name, temp_output_file.name)
+                transcode.tags["bytes_saved"] = report.bytes_saved
+            with span("asr", backend=asr_backend.name):
+                transcribed_text = await asr_backend.transcribe_async(temp_output_file.name)
+    if transcript_cache:
+        await asyncio.to_thread(transcript_cache.put, cache_keys, asr_backend, transcribed_text)
+    return transcribed_text
+
+
+@app.route('/transcribe', methods=['POST'])
+async def transcribe():
+    form = await request.form
+    if 'session_id' in form:
+        # The recording was uploaded chunk by chunk, only the last segment is left to transcribe.
+        try:
+            with span("asr", live=True):
+                transcribed_text = await run_limited(asyncio.to_thread(live_sessions.finish, form['session_id']))
+        except KeyError:
+            return jsonify({'error': 'Unknown session'}), 404
+        except asyncio.TimeoutError:
+            return jsonify({'error': 'Transcription timed out'}), 504
+        print(transcribed_text)
+        return jsonify(transcribed_text)
+
+    files = await request.files
+    if 'audio' not in files:
+        return jsonify({'error': 'No audio file'}), 400
+
+    audio_file = files['audio']
+    ext_name = ext_name_from_content_type(audio_file.content_type)
+    try:
+        transcribed_text = await run_limited(transcribe_uploaded_file(audio_file, ext_name))
+    except asyncio.TimeoutError:
+        return jsonify({'error': 'Transcription timed out'}), 504
+
+    print(transcribed_text)
+    return jsonify(transcribed_text)
+
+
+@app.route('/session', methods=['POST'])
+async def create_session():
+    """Starts a live transcription session (see main.create_session)."""
+    data = await request.get_json(force=True, silent=True) or {}
+    session = await asyncio.to_thread(
+        live_sessions.create, ext_name_from_content_type(data.get('mime_type', 'audio/webm'))
+    )
+    return jsonify({'session_id': session.session_id})
+
+
+@app.route('/session/<session_id>/chunk', methods=['POST'])
+async def upload_chunk(session_id):
+    """Appends one recorded chunk (form fields `audio` and `seq`) to the session."""
+    session = live_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Unknown session'}), 404
+    files = await request.files
+    if 'audio' not in files:
+        return jsonify({'error': 'No audio file'}), 400
+    form = await request.form
+    await asyncio.to_thread(session.append_chunk, int(form.get('seq', 0)), files['audio'].read())
+    return jsonify({'ok': True})
+
+
+@app.route('/process', methods=['POST'])
+async def process_audio():
+    data = await request.get_json(force=True)
+    text = data['text']
+
+    # Send transcribed text to ChatGPT with the provided system prompt
+    try:
+        with span("paraphrase"):
+            # A stalled model is hedged with the next candidate of the route.
+            processed_text, _ = await run_limited(paraphrase_router.run(
+                "paraphrase", lambda model: paraphrase_text_async(text, model=model)
+            ))
+    except asyncio.TimeoutError:
+        return jsonify({'error': 'Processing timed out'}), 504
+    print(processed_text)
+    log_note(text, processed_text, data.get('user'))
+    return jsonify(processed_text)
+
+
+@app.route('/process_stream', methods=['POST'])
+async def process_audio_stream():
+    """Same as /process, but streams the paraphrased text as server-sent events (see main.process_audio_stream)."""
+    data = await request.get_json(force=True)
+    text = data['text']
+    # Quart tears the request down before the body is sent, so the stream takes the trace over and closes it
+    # itself; otherwise the paraphrase span would be recorded after the trace was closed.
+    trace_stack = g.pop('trace_stack', None) or ExitStack()
+
+    @stream_with_context
+    async def generate():
+        with trace_stack:
+            async for event in paraphrase_events():
+                yield event
+
+    async def paraphrase_events():
+        deadline = time.monotonic() + REQUEST_TIMEOUT
+        pieces = []
+        try:
+            await asyncio.wait_for(request_slots.acquire(), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            yield format_sse({'error': 'Processing timed out'})
+            return
+        # A stream cannot be hedged once started, it only takes the routed model.
+        model = paraphrase_router.choose("paraphrase")[0]
+        try:
+            with span("paraphrase", stream=True, model=model), paraphrase_router.timed(model):
+                stream = paraphrase_text_stream_async(text, model=model)
+                while True:
+                    try:
+                        delta = await asyncio.wait_for(stream.__anext__(), deadline - time.monotonic())
+                    except StopAsyncIteration:
+                        break
+                    pieces.append(delta)
+                    yield format_sse({'delta': delta})
+        except asyncio.TimeoutError:
+            yield format_sse({'error': 'Processing timed out'})
+            return
+        except Exception as e:
+            yield format_sse({'error': str(e)})
+            return
+        finally:
+            request_slots.release()
+
+        processed_text = "".join(pieces).strip()
+        print(processed_text)
+        log_note(text, processed_text, data.get('user'))
+        yield format_sse({'done': True, 'text': processed_text})
+
+    return generate(), 200, {'Content-Type': 'text/event-stream', **SSE_HEADERS}
+
+
+@app.route('/')
+async def index():
+    return await send_from_directory('static', 'index.html')
+
+
+
+@app.route('/metrics')
+async def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,151 @@
+"""
+Pluggable speech recognition (ASR) backends. The web app and the bot pick one by name (ASR_BACKEND):
+* openai: the OpenAI Whisper API (core.transcribe_voice_message), the web app's default.
+* gemini: Gemini (GEMINI_ASR_MODEL), through the shared client of llm_client.py, the bot's default.
+* local: Whisper on the local CPU through faster-whisper (CTranslate2, int8 quantized by default). The model is
+  loaded once and stays resident; `pip install faster-whisper` to use it. Runs fully offline once the model has
+  been downloaded. Batching (LOCAL_ASR_BATCH_SIZE) is within one recording only, over its 30-second windows;
+  concurrent requests are not batched together but decoded side by side by LOCAL_ASR_WORKERS workers.
+
+get_asr_backend(name) returns one shared instance per backend, so the local model is only loaded once per process.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from core import WHISPER_MODEL, WHISPER_PROMPT, transcribe_voice_message, transcribe_voice_message_async
+from llm_client import get_llm_client
+
+GEMINI_ASR_MODEL = os.environ.get("GEMINI_ASR_MODEL", "gemini-2.5-flash")
+LOCAL_ASR_MODEL = os.environ.get("LOCAL_ASR_MODEL", "small")
+LOCAL_ASR_COMPUTE_TYPE = os.environ.get("LOCAL_ASR_COMPUTE_TYPE", "int8")
+# Number of transcriptions decoded in parallel, each worker shares the loaded model weights.
+LOCAL_ASR_WORKERS = int(os.environ.get("LOCAL_ASR_WORKERS", "2"))
+# CPU threads per worker, 0 lets CTranslate2 decide.
+LOCAL_ASR_CPU_THREADS = int(os.environ.get("LOCAL_ASR_CPU_THREADS", "0"))
+# Batch size for decoding the 30-second windows of one recording together, 1 disables batching. Windows of
+# different recordings are never batched together.
+LOCAL_ASR_BATCH_SIZE = int(os.environ.get("LOCAL_ASR_BATCH_SIZE", "8"))
+LOCAL_ASR_LANGUAGE = os.environ.get("LOCAL_ASR_LANGUAGE", "") or None
+
+
+class ASRBackend:
+    name = ""
+    model = ""
+    prompt = ""
+
+    def transcribe(self, audio_path: str) -> str:
+        raise NotImplementedError
+
+    async def transcribe_async(self, audio_path: str) -> str:
+        return await asyncio.to_thread(self.transcribe, audio_path)
+
+
+class OpenAIWhisperBackend(ASRBackend):
+    name = "openai"
+    model = WHISPER_MODEL
+    prompt = WHISPER_PROMPT
+
+    def transcribe(self, audio_path: str) -> str:
+        return transcribe_voice_message(audio_path)
+
+    async def transcribe_async(self, audio_path: str) -> str:
+        return await transcribe_voice_message_async(audio_path)
+
+
+class GeminiBackend(ASRBackend):
+    name = "gemini"
+    model = GEMINI_ASR_MODEL
+
+    def transcribe(self, audio_path: str) -> str:
+        return get_llm_client().transcribe_sync(audio_path, self.model)
+
+    async def transcribe_async(self, audio_path: str) -> str:
+        return await get_llm_client().transcribe(audio_path, self.model)
+
+
+class LocalWhisperBackend(ASRBackend):
+    name = "local"
+    prompt = WHISPER_PROMPT
+
+    def __init__(
+        self,
+        model_size: str = LOCAL_ASR_MODEL,
+        compute_type: str = LOCAL_ASR_COMPUTE_TYPE,
+        num_workers: int = LOCAL_ASR_WORKERS,
+        cpu_threads: int = LOCAL_ASR_CPU_THREADS,
+        batch_size: int = LOCAL_ASR_BATCH_SIZE,
+        language: Optional[str] = LOCAL_ASR_LANGUAGE,
+    ):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise ImportError("The local ASR backend needs faster-whisper: pip install faster-whisper") from e
+
+        self.model = f"faster-whisper-{model_size}-{compute_type}"
+        self.language = language
+        self.batch_size = batch_size
+        self._model = WhisperModel(
+            model_size,
+            device="cpu",
+            compute_type=compute_type,
+            cpu_threads=cpu_threads,
+            num_workers=num_workers,
+        )
+        self._pipeline = None
+        if batch_size > 1:
+            try:
+                from faster_whisper import BatchedInferencePipeline
+                self._pipeline = BatchedInferencePipeline(model=self._model)
+            except ImportError:
+                # Older faster-whisper, decode the windows one by one.
+                pass
+        # One thread per model worker, so concurrent requests are decoded in parallel rather than queued in
+        # the default executor behind unrelated work. They are not batched with each other: faster-whisper only
+        # batches the windows of one file, and voice notes are mostly a window or two, so a cross-request batcher
+        # would have to feed the model's internal batch API directly.
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="local_asr")
+
+    def transcribe(self, audio_path: str) -> str:
+        if self._pipeline is not None:
+            segments, _ = self._pipeline.transcribe(
+                audio_path,
+                language=self.language,
+                initial_prompt=self.prompt,
+                batch_size=self.batch_size,
+            )
+        else:
+            segments, _ = self._model.transcribe(
+                audio_path,
+                language=self.language,
+                initial_prompt=self.prompt,
+                vad_filter=True,
+            )
+        # segments is a generator, the decoding happens while iterating it.
+        return "".join(segment.text for segment in segments).strip()
+
+    async def transcribe_async(self, audio_path: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.transcribe, audio_path)
+
+
+ASR_BACKENDS = {
+    "openai": OpenAIWhisperBackend,
+    "gemini": GeminiBackend,
+    "local": LocalWhisperBackend,
+}
+
+_backends: Dict[str, ASRBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_asr_backend(name: str) -> ASRBackend:
+    """Returns the shared instance of the named backend, creating (and for `local`, loading) it on first use."""
+    if name not in ASR_BACKENDS:
+        raise ValueError(f"Unknown ASR backend {name}, choose from {list(ASR_BACKENDS)}")
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = ASR_BACKENDS[name]()
+        return _backends[name]
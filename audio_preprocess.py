@@ -0,0 +1,133 @@
+"""
+Shrinks recordings before they are sent to speech recognition: downmixes to mono 16 kHz (what Whisper and Gemini
+use internally anyway), trims leading, trailing and long internal silences with an energy-based voice activity
+detector, and encodes to low-bitrate Opus (AUDIO_OPUS_BITRATE). Voice memos are mostly pauses, so the uploads and
+the audio the provider bills for both get much shorter.
+
+prepare_for_asr(input, output) is the drop-in replacement of convert_audio_file_to_format for the ASR paths, and
+export_for_asr(audio, output) the one of AudioSegment.export for segments; write to files ending in
+ASR_AUDIO_EXTENSION. Every call reports the bytes saved, in the log and as the
+voicenote_asr_audio_bytes histogram on /metrics. AUDIO_PREPROCESS=0 goes back to the plain MP3 conversion.
+"""
+import os
+from dataclasses import dataclass
+
+from tracing import metrics
+
+AUDIO_PREPROCESS = os.environ.get("AUDIO_PREPROCESS", "1") == "1"
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_OPUS_BITRATE = os.environ.get("AUDIO_OPUS_BITRATE", "24k")
+# Quieter than the recording's average loudness by this many dB counts as silence.
+AUDIO_VAD_THRESHOLD_DB = float(os.environ.get("AUDIO_VAD_THRESHOLD_DB", "16"))
+# Silences shorter than this are kept as they are, longer ones are cut down to twice the padding.
+AUDIO_VAD_MIN_SILENCE_MS = int(os.environ.get("AUDIO_VAD_MIN_SILENCE_MS", "700"))
+# Audio kept around each stretch of speech, so that soft word onsets and endings survive.
+AUDIO_VAD_PADDING_MS = int(os.environ.get("AUDIO_VAD_PADDING_MS", "200"))
+# Step of the detector, coarser is faster on long recordings.
+VAD_SEEK_STEP_MS = 20
+
+ASR_AUDIO_FORMAT = "ogg" if AUDIO_PREPROCESS else "mp3"
+ASR_AUDIO_EXTENSION = f".{ASR_AUDIO_FORMAT}"
+
+audio_bytes = metrics.histogram(
+    "voicenote_asr_audio_bytes",
+    "Size of the recordings before (original) and after (uploaded) preprocessing.",
+    ("kind",),
+    buckets=(16e3, 64e3, 256e3, 1e6, 4e6, 16e6, 64e6),
+)
+
+
+@dataclass
+class AudioReport:
+    input_bytes: int
+    output_bytes: int
+    input_seconds: float
+    output_seconds: float
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.input_bytes - self.output_bytes
+
+    def __str__(self) -> str:
+        saved = 100 * self.bytes_saved / self.input_bytes if self.input_bytes else 0.0
+        return (
+            f"{self.input_bytes} -> {self.output_bytes} bytes ({saved:.0f}% saved), "
+            f"{self.input_seconds:.1f}s -> {self.output_seconds:.1f}s"
+        )
+
+
+def downmix(audio):
+    """Mono at AUDIO_SAMPLE_RATE."""
+    return audio.set_channels(1).set_frame_rate(AUDIO_SAMPLE_RATE)
+
+
+def trim_silence(
+    audio,
+    threshold_db: float = AUDIO_VAD_THRESHOLD_DB,
+    min_silence_ms: int = AUDIO_VAD_MIN_SILENCE_MS,
+    padding_ms: int = AUDIO_VAD_PADDING_MS,
+):
+    """Drops the leading and trailing silence and shortens the long pauses. Unchanged if no speech is found."""
+    from pydub.silence import detect_nonsilent
+
+    if len(audio) == 0 or audio.dBFS == float("-inf"):
+        return audio
+    speech = detect_nonsilent(
+        audio,
+        min_silence_len=min_silence_ms,
+        silence_thresh=audio.dBFS - threshold_db,
+        seek_step=VAD_SEEK_STEP_MS,
+    )
+    if not speech:
+        # All below the threshold, e.g. a very quiet recording; better send it whole than nothing.
+        return audio
+    ranges = []
+    for start, end in speech:
+        start, end = max(0, start - padding_ms), min(len(audio), end + padding_ms)
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    trimmed = audio[ranges[0][0]:ranges[0][1]]
+    for start, end in ranges[1:]:
+        trimmed += audio[start:end]
+    return trimmed
+
+
+def export_for_asr(audio, output_file: str):
+    """Writes a decoded recording (or a segment of one) to output_file, returns the audio actually written."""
+    if not AUDIO_PREPROCESS:
+        audio.export(output_file, format=ASR_AUDIO_FORMAT)
+        return audio
+    prepared = trim_silence(downmix(audio))
+    prepared.export(
+        output_file,
+        format=ASR_AUDIO_FORMAT,
+        codec="libopus",
+        bitrate=AUDIO_OPUS_BITRATE,
+        # Tuned for speech.
+        parameters=["-application", "voip"],
+    )
+    return prepared
+
+
+def record_sizes(report: AudioReport) -> None:
+    audio_bytes.observe(report.input_bytes, kind="original")
+    audio_bytes.observe(report.output_bytes, kind="uploaded")
+    print(f"ASR audio: {report}")
+
+
+def prepare_for_asr(input_file: str, output_file: str) -> AudioReport:
+    """Writes the recording to output_file, ready for speech recognition, and reports the bytes saved."""
+    from pydub import AudioSegment
+
+    audio = AudioSegment.from_file(input_file)
+    prepared = export_for_asr(audio, output_file)
+    report = AudioReport(
+        input_bytes=os.path.getsize(input_file),
+        output_bytes=os.path.getsize(output_file),
+        input_seconds=len(audio) / 1000,
+        output_seconds=len(prepared) / 1000,
+    )
+    record_sizes(report)
+    return report
@@ -0,0 +1,204 @@
+# Transcribe (and optionally paraphrase) a directory of recordings in bulk
+
+"""
+Batch transcription of audio archives, e.g. recorded meetings.
+
+Transcoding runs on a process pool (it is CPU bound), the ASR and paraphrase calls are async, and every finished
+file is appended to the output JSONL right away, so an interrupted run loses at most the files in flight. Running
+the same command again skips the files that are already in the output (failed files are retried).
+
+Long recordings are cut into --segment_minutes segments, which also keeps each upload under the Whisper API's
+file size limit; the segments are transcribed and, with --paraphrase, paraphrased concurrently.
+
+Usage:
+    python batch_transcribe.py --input recordings/ --output transcripts.jsonl --paraphrase
+    python batch_transcribe.py --input manifest.txt --output transcripts.jsonl --processes 8 --concurrency 16
+
+A manifest is a text file with one audio path per line, or a JSONL file with a "path" field per line.
+Each output line has path, duration_seconds, segments, transcribed and, with --paraphrase, paraphrased; or path and
+error if the file failed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Set, Tuple
+
+from asr import ASR_BACKENDS, get_asr_backend
+from audio_preprocess import ASR_AUDIO_FORMAT, AudioReport, export_for_asr, record_sizes
+from core import paraphrase_text_async
+
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.wav', '.ogg', '.oga', '.opus', '.webm', '.flac', '.aac', '.mp4')
+
+
+def list_audio_files(input_path: str) -> List[str]:
+    if os.path.isdir(input_path):
+        files = []
+        for root, dirs, names in os.walk(input_path):
+            dirs.sort()
+            for name in sorted(names):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    files.append(os.path.join(root, name))
+        return files
+
+    # A manifest, paths are relative to it.
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    files = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = json.loads(line)["path"] if line.startswith("{") else line
+            files.append(os.path.join(base_dir, path))
+    return files
+
+
+def load_done(output_path: str) -> Set[str]:
+    """Paths already transcribed successfully in a previous run."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash.
+                continue
+            if "error" not in record:
+                done.add(record["path"])
+    return done
+
+
+def transcode_to_segments(input_path: str, work_dir: str, segment_seconds: float) -> Tuple[float, List[str]]:
+    """Decodes the recording and writes it as segments ready for the ASR backend. Runs in a worker process."""
+    from pydub import AudioSegment
+
+    audio = AudioSegment.from_file(input_path)
+    segment_ms = int(segment_seconds * 1000)
+    segment_paths = []
+    output_seconds = 0.0
+    for index, start in enumerate(range(0, max(len(audio), 1), segment_ms)):
+        segment_path = os.path.join(work_dir, f"segment{index:04d}.{ASR_AUDIO_FORMAT}")
+        output_seconds += len(export_for_asr(audio[start:start + segment_ms], segment_path)) / 1000
+        segment_paths.append(segment_path)
+    record_sizes(AudioReport(
+        input_bytes=os.path.getsize(input_path),
+        output_bytes=sum(os.path.getsize(path) for path in segment_paths),
+        input_seconds=len(audio) / 1000,
+        output_seconds=output_seconds,
+    ))
+    return len(audio) / 1000, segment_paths
+
+
+class BatchTranscriber:
+    def __init__(self, args):
+        self.args = args
+        self.asr_backend = get_asr_backend(args.asr_backend)
+        self.executor = ProcessPoolExecutor(max_workers=args.processes)
+        # Limits the files in flight, and with them the temp space and the concurrent API calls.
+        self.file_slots = asyncio.Semaphore(args.concurrency)
+        self.output = open(args.output, "a+", encoding="utf-8")
+        self.output.seek(0, os.SEEK_END)
+        if self.output.tell() > 0:
+            self.output.seek(self.output.tell() - 1)
+            if self.output.read(1) != "\n":
+                # The previous run died mid-line, don't glue the next record to it.
+                self.output.write("\n")
+        self.completed = 0
+        self.failed = 0
+        self.audio_seconds = 0.0
+
+    def write(self, record: dict) -> None:
+        self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.output.flush()
+
+    async def process_file(self, path: str) -> dict:
+        loop = asyncio.get_running_loop()
+        work_dir = tempfile.mkdtemp(prefix="batch_transcribe_")
+        try:
+            duration, segment_paths = await loop.run_in_executor(
+                self.executor, transcode_to_segments, path, work_dir, self.args.segment_minutes * 60
+            )
+            texts = await asyncio.gather(*[
+                self.asr_backend.transcribe_async(segment_path) for segment_path in segment_paths
+            ])
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        record = {
+            "path": path,
+            "duration_seconds": duration,
+            "segments": len(segment_paths),
+            "transcribed": " ".join(text.strip() for text in texts),
+        }
+        if self.args.paraphrase:
+            # Per segment, a whole meeting does not fit in one prompt.
+            paraphrased = await asyncio.gather(*[
+                paraphrase_text_async(text, model=self.args.model) for text in texts if text.strip()
+            ])
+            record["paraphrased"] = "\n\n".join(paraphrased)
+        return record
+
+    async def run_one(self, path: str, index: int, total: int) -> None:
+        async with self.file_slots:
+            start = time.perf_counter()
+            try:
+                record = await self.process_file(path)
+            except Exception as e:
+                self.failed += 1
+                self.write({"path": path, "error": repr(e)})
+                print(f"[{index}/{total}] {path} failed: {e!r}")
+                return
+            self.completed += 1
+            self.audio_seconds += record["duration_seconds"]
+            self.write(record)
+            print(f"[{index}/{total}] {path}: {record['duration_seconds']:.0f}s of audio "
+                  f"in {time.perf_counter() - start:.1f}s")
+
+    async def run(self, paths: List[str]) -> None:
+        try:
+            await asyncio.gather(*[self.run_one(path, i + 1, len(paths)) for i, path in enumerate(paths)])
+        finally:
+            self.executor.shutdown()
+            self.output.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True, help="directory of audio files, or a manifest")
+    parser.add_argument("--output", type=str, default="transcribed.jsonl")
+    parser.add_argument("--paraphrase", action="store_true")
+    parser.add_argument("--model", type=str, default="gpt-4", help="model for --paraphrase")
+    parser.add_argument("--asr_backend", type=str, default="openai", choices=list(ASR_BACKENDS))
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="transcoding processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="files in flight")
+    parser.add_argument("--segment_minutes", type=float, default=10)
+    args = parser.parse_args()
+
+    paths = list_audio_files(args.input)
+    done = load_done(args.output)
+    todo = [path for path in paths if path not in done]
+    print(f"{len(paths)} audio files, {len(paths) - len(todo)} already done, {len(todo)} to go.")
+
+    batch = BatchTranscriber(args)
+    start = time.perf_counter()
+    asyncio.run(batch.run(todo))
+    elapsed = time.perf_counter() - start
+
+    print(f"Done in {elapsed:.1f}s: {batch.completed} transcribed, {batch.failed} failed, "
+          f"{len(paths) - len(todo)} skipped.")
+    if elapsed > 0:
+        print(f"Throughput: {batch.completed / elapsed * 60:.1f} files/min, "
+              f"{batch.audio_seconds / elapsed:.1f}x real time ({batch.audio_seconds / 3600:.2f}h of audio).")
+    return 1 if batch.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+Local stand-ins for the OpenAI, Gemini and arXiv HTTP APIs, so that the benchmarks run without network.
+
+All services are served by one threaded HTTP server:
+* POST /v1/audio/transcriptions, POST /v1/chat/completions (also streaming): OpenAI, use OPENAI_BASE_URL=<url>/v1.
+* POST /v1beta/models/<model>:generateContent: Gemini (REST transport), use GEMINI_API_ENDPOINT=<url>.
+* GET /api/query, GET /e-print/<arxiv_id>: arXiv, use ARXIV_API_URL=<url>/api/query, ARXIV_EPRINT_URL=<url>/e-print/.
+
+Every request waits `latency` (+ up to `jitter`) seconds, and fails with `failure_status` with probability
+`failure_rate`. Run standalone with `python -m benchmarks.fake_services --port 8765 --latency 0.2`.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from benchmarks.fixtures import make_arxiv_feed, make_latex_tarball_bytes
+
+FAKE_TRANSCRIPT = "嘎嘎嘎聊天 今天我们讨论一下基准测试的设计，以及如何在没有网络的情况下衡量性能。"
+FAKE_COMPLETION = "这是一段经过整理的文字。It keeps the author's tone and corrects recognition errors."
+
+arxiv_id_matcher = re.compile(r"^\d{4}\.\d{4,5}(v\d+)?$")
+
+
+@dataclass
+class FakeServiceConfig:
+    latency: float = 0.0
+    jitter: float = 0.0
+    failure_rate: float = 0.0
+    failure_status: int = 500
+    seed: int = 0
+    num_papers: int = 10
+    num_sections: int = 12
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    server_version = "FakeServices/1.0"
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output clean.
+        pass
+
+    @property
+    def config(self) -> FakeServiceConfig:
+        return self.server.config
+
+    def _delay_or_fail(self) -> bool:
+        """Applies the configured latency. Returns True if the request was failed on purpose."""
+        with self.server.lock:
+            self.server.request_count += 1
+            jitter = self.server.rng.uniform(0, self.config.jitter) if self.config.jitter else 0.0
+            fail = self.server.rng.random() < self.config.failure_rate
+        time.sleep(self.config.latency + jitter)
+        if fail:
+            with self.server.lock:
+                self.server.failure_count += 1
+            headers = {"Retry-After": "1"} if self.config.failure_status == 429 else {}
+            self._send_json({"error": {"message": "injected failure", "code": self.config.failure_status}},
+                            status=self.config.failure_status, headers=headers)
+        return fail
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, body: bytes, content_type: str, status: int = 200, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, payload, status: int = 200, headers: Optional[Dict[str, str]] = None):
+        self._send(json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json", status, headers)
+
+    def do_GET(self):
+        if self._delay_or_fail():
+            return
+        path, _, query = self.path.partition("?")
+        if path == "/api/query":
+            self._arxiv_query(query)
+        elif path.startswith("/e-print/"):
+            self._send(self.server.latex_tarball, "application/x-eprint-tar")
+        else:
+            self._send_json({"error": f"unknown path {path}"}, status=404)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self._delay_or_fail():
+            return
+        path = self.path.partition("?")[0]
+        if path == "/v1/audio/transcriptions":
+            self._send_json({"text": FAKE_TRANSCRIPT})
+        elif path == "/v1/chat/completions":
+            self._chat_completion(json.loads(body or b"{}"))
+        elif path.startswith("/v1beta/models/") and path.endswith(":generateContent"):
+            self._send_json({
+                "candidates": [{
+                    "content": {"parts": [{"text": FAKE_COMPLETION}], "role": "model"},
+                    "finishReason": "STOP",
+                    "index": 0,
+                }],
+            })
+        else:
+            self._send_json({"error": f"unknown path {path}"}, status=404)
+
+    def _arxiv_query(self, query: str):
+        match = re.search(r"search_query=all:([^&]*)", query)
+        terms = match.group(1).split("+") if match else []
+        ids = [f"2401.{i:05d}" for i in range(self.config.num_papers)]
+        # A lookup by id (as in ArXiv(link)) returns that paper first.
+        if len(terms) == 1 and arxiv_id_matcher.match(terms[0]):
+            ids[0] = terms[0]
+        self._send(make_arxiv_feed(ids).encode("utf-8"), "application/atom+xml")
+
+    def _chat_completion(self, request: dict):
+        model = request.get("model", "gpt-4")
+        content = FAKE_COMPLETION
+        if request.get("response_format", {}).get("type") == "json_object":
+            content = json.dumps({"tag": "聊天", "content": FAKE_TRANSCRIPT, "paraphrased": FAKE_COMPLETION},
+                                 ensure_ascii=False)
+        if not request.get("stream"):
+            self._send_json({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i in range(0, len(content), 8):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": content[i:i + 8]}, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+class FakeServiceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: Optional[FakeServiceConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), FakeServiceHandler)
+        self.config = config or FakeServiceConfig()
+        self.rng = random.Random(self.config.seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.failure_count = 0
+        self.latex_tarball = make_latex_tarball_bytes(num_sections=self.config.num_sections)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environ(self) -> Dict[str, str]:
+        """Environment variables that point the repo's clients to this server."""
+        return {
+            "OPENAI_BASE_URL": f"{self.url}/v1",
+            "OPENAI_API_KEY": "fake-key",
+            "GEMINI_API_ENDPOINT": self.url,
+            "GEMINI_API_KEY": "fake-key",
+            "ARXIV_API_URL": f"{self.url}/api/query",
+            "ARXIV_EPRINT_URL": f"{self.url}/e-print/",
+        }
+
+    def start(self) -> "FakeServiceServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max random seconds added on top of latency")
+    parser.add_argument("--failure_rate", type=float, default=0.0)
+    parser.add_argument("--failure_status", type=int, default=500)
+    args = parser.parse_args()
+
+    config = FakeServiceConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        failure_status=args.failure_status,
+    )
+    server = FakeServiceServer(config, host=args.host, port=args.port)
+    for key, value in server.environ().items():
+        print(f"export {key}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,129 @@
+"""
+Synthetic fixtures for the benchmarks: speech-like audio, LaTeX sources (plain and as e-print tarballs), arXiv
+search feeds and long Telegram messages. Everything is generated deterministically with the standard library.
+
+`python -m benchmarks.fixtures --output_dir fixtures` writes a set of them to disk.
+"""
+import argparse
+import io
+import math
+import os
+import random
+import struct
+import tarfile
+import tempfile
+import wave
+from typing import List
+
+LOREM = (
+    "We study the scaling behavior of self-supervised representation learning and show that the learned "
+    "features transfer across domains. Our method composes a contrastive objective with a reconstruction term, "
+    "which stabilizes training at large batch sizes. Experiments on standard benchmarks confirm the analysis. "
+)
+
+
+def make_speech_like_wav(path: str, seconds: float = 10.0, sample_rate: int = 16000, seed: int = 0) -> str:
+    """Writes a mono 16-bit WAV of voiced bursts (harmonics with a syllable-rate envelope) separated by pauses."""
+    rng = random.Random(seed)
+    frames = bytearray()
+    t = 0
+    total = int(seconds * sample_rate)
+    while t < total:
+        burst = int(rng.uniform(0.4, 2.5) * sample_rate)
+        pause = int(rng.uniform(0.1, 0.8) * sample_rate)
+        pitch = rng.uniform(100, 220)
+        for i in range(min(burst, total - t)):
+            x = i / sample_rate
+            envelope = 0.5 * (1 - math.cos(2 * math.pi * 4 * x))
+            sample = sum(math.sin(2 * math.pi * pitch * k * x) / k for k in (1, 2, 3))
+            frames += struct.pack("<h", int(8000 * envelope * sample / 1.8))
+        t += burst
+        silence = min(pause, max(0, total - t))
+        frames += b"\x00\x00" * silence
+        t += silence
+
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(bytes(frames))
+    return path
+
+
+def make_latex_source(output_dir: str, num_sections: int = 12, paragraphs_per_section: int = 20,
+                      num_inputs: int = 4) -> str:
+    """Writes a LaTeX paper split over `num_inputs` \\input files plus a .bbl file. Returns the main .tex path."""
+    os.makedirs(output_dir, exist_ok=True)
+    titles = ["Introduction"] + [f"Section {i}" for i in range(1, num_sections)]
+    per_input = max(1, math.ceil(num_sections / num_inputs))
+    inputs = []
+    for start in range(0, num_sections, per_input):
+        name = f"sec{start // per_input}"
+        with open(os.path.join(output_dir, f"{name}.tex"), "w") as f:
+            for title in titles[start:start + per_input]:
+                f.write(f"\\section{{{title}}}\n")
+                for p in range(paragraphs_per_section):
+                    f.write(f"{LOREM}(paragraph {p})\n\n")
+        inputs.append(name)
+
+    main_path = os.path.join(output_dir, "main.tex")
+    with open(main_path, "w") as f:
+        f.write("\\documentclass{article}\n\\begin{document}\n")
+        for name in inputs:
+            f.write(f"\\input{{{name}}}\n")
+        f.write("\\bibliography{main}\n\\end{document}\n")
+    with open(os.path.join(output_dir, "main.bbl"), "w") as f:
+        f.write("\\begin{thebibliography}{1}\n\\end{thebibliography}\n")
+    return main_path
+
+
+def make_latex_tarball_bytes(**kwargs) -> bytes:
+    """The LaTeX source of make_latex_source, as an arXiv e-print .tar.gz."""
+    with tempfile.TemporaryDirectory() as source_dir:
+        make_latex_source(source_dir, **kwargs)
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            for name in sorted(os.listdir(source_dir)):
+                tar.add(os.path.join(source_dir, name), arcname=name)
+    return buffer.getvalue()
+
+
+def make_arxiv_feed(arxiv_ids: List[str]) -> str:
+    """An arXiv API (Atom) response listing the given papers."""
+    entries = []
+    for arxiv_id in arxiv_ids:
+        entries.append(f"""  <entry>
+    <id>http://arxiv.org/abs/{arxiv_id}</id>
+    <title>Scaling Laws for Synthetic Benchmarks ({arxiv_id})</title>
+    <summary>{LOREM}</summary>
+    <author><name>Ada Lovelace</name></author>
+    <author><name>Alan Turing</name></author>
+  </entry>""")
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<feed xmlns="http://www.w3.org/2005/Atom">\n' + "\n".join(entries) + "\n</feed>\n")
+
+
+def make_long_message(num_paragraphs: int = 200, seed: int = 0) -> str:
+    """A long HTML-formatted reply, as produced by the `bs` and `a:` commands."""
+    rng = random.Random(seed)
+    paragraphs = []
+    for i in range(num_paragraphs):
+        words = LOREM.split()
+        rng.shuffle(words)
+        paragraphs.append(f"<b>Paper {i}</b>: <a href='https://arxiv.org/abs/2401.{i:05d}'>link</a> "
+                          + " ".join(words[:rng.randint(10, len(words))]))
+    return "\n".join(paragraphs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", type=str, default="fixtures")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for seconds in (5, 30, 120):
+        print(make_speech_like_wav(os.path.join(args.output_dir, f"speech_{seconds}s.wav"), seconds=seconds))
+    tarball_path = os.path.join(args.output_dir, "paper.tar.gz")
+    with open(tarball_path, "wb") as f:
+        f.write(make_latex_tarball_bytes())
+    print(tarball_path)
@@ -0,0 +1,101 @@
+"""
+Import-time budget check. Each module is imported in a fresh interpreter with `python -X importtime`, so the
+numbers are what a cold start (a new webhook replica, a CLI run of transcribe_youtube.py) pays before doing any
+work, including the module's import-time side effects such as building API clients.
+
+Usage (from the repository root):
+    python -m benchmarks.import_time                  # exits with 1 when a module is over its budget
+    python -m benchmarks.import_time --iterations 5 --only bot_core,core --json imports.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import List, Optional
+
+from benchmarks.stats import BenchResult, format_table
+
+# Seconds of cumulative import time allowed per module, with all dependencies installed.
+IMPORT_BUDGETS = {
+    "tracing": 0.05,
+    "message_utils": 0.05,
+    "core": 0.1,
+    "asr": 0.1,
+    "arxiv_utils": 0.3,
+    "get_stock_info": 0.3,
+    "llm_summary": 0.3,
+    "bot_core": 0.4,
+    "transcribe_youtube": 0.3,
+}
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import(module: str) -> float:
+    """Cumulative import time of the module in seconds, in a fresh interpreter. Raises ImportError on failure."""
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        raise ImportError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else module)
+    # Lines look like `import time:       self [us] |  cumulative |  imported package`, the module's own line
+    # comes after those of everything it imports.
+    for line in reversed(completed.stderr.splitlines()):
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.strip() == module:
+            return int(cumulative) / 1e6
+    raise ImportError(f"no import time reported for {module}")
+
+
+def check_budgets(modules: List[str], iterations: int, budget_scale: float = 1.0) -> List[BenchResult]:
+    results = []
+    for module in modules:
+        result = BenchResult(f"import {module}")
+        try:
+            for _ in range(iterations):
+                elapsed = measure_import(module)
+                result.latencies.append(elapsed)
+                result.wall_time += elapsed
+        except ImportError as e:
+            result.note = f"missing dependency: {e}"
+            results.append(result)
+            continue
+        budget = IMPORT_BUDGETS[module] * budget_scale
+        best = min(result.latencies)
+        if best > budget:
+            result.note = f"over budget: {best * 1000:.0f}ms > {budget * 1000:.0f}ms"
+        results.append(result)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=3, help="the best of these is compared to the budget")
+    parser.add_argument("--only", type=str, default=None, help="comma-separated module names")
+    parser.add_argument("--budget_scale", type=float, default=1.0, help="multiplier for slow machines")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    modules = args.only.split(",") if args.only else list(IMPORT_BUDGETS)
+    unknown = [module for module in modules if module not in IMPORT_BUDGETS]
+    if unknown:
+        parser.error(f"unknown modules: {unknown}, choose from {list(IMPORT_BUDGETS)}")
+
+    results = check_budgets(modules, args.iterations, args.budget_scale)
+    print(format_table(results))
+    over_budget = [result for result in results if result.note.startswith("over budget")]
+    for result in over_budget:
+        print(f"{result.name}: {result.note}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([result.summary() for result in results], f, indent=2)
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
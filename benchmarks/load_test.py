@@ -0,0 +1,253 @@
+"""
+Concurrent-user load and soak test for BotCore.
+
+N simulated users send synthetic voice and text updates with random think times. As with the Telegram
+application, updates go through one queue and are processed by `--concurrency` workers, each user with its own
+state dict (the `context.user_data` of the bot). The LLM and deep research backends are the stubs of
+benchmarks/stubs.py, and arXiv is served by benchmarks/fake_services.py, so no network is needed.
+
+Reported periodically and at the end:
+* end-to-end latency (from the update being queued to the reply being ready) per update kind,
+* event loop lag (how late a periodic timer fires, e.g. because a handler blocks the loop),
+* queue depth and in-flight updates,
+* RSS and the size of the user states (entries in `history` / `chat_history`, pickled bytes as persisted).
+
+Usage (from the repository root):
+    python -m benchmarks.load_test --users 50 --duration 300 --messages_per_minute 2
+    python -m benchmarks.load_test --users 20 --duration 14400 --report_interval 300 --json soak.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from benchmarks.fake_services import FakeServiceConfig, FakeServiceServer
+from benchmarks.fixtures import make_speech_like_wav
+from benchmarks.stats import BenchResult, format_table, percentile
+from benchmarks.stubs import StubLLMService, make_deep_research_runner
+
+TEXT_MESSAGES = [
+    "a: representation learning",
+    "a: speech recognition latency",
+    "这个想法还需要再想一想",
+]
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current RSS, but better than nothing off Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoadTest:
+    def __init__(self, args, bot_core, voice_bytes: Optional[bytes]):
+        self.args = args
+        self.bot_core = bot_core
+        self.voice_bytes = voice_bytes
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.states: Dict[int, dict] = defaultdict(dict)
+        self.results: Dict[str, BenchResult] = {}
+        self.window: List[float] = []
+        self.loop_lags: List[float] = []
+        self.queue_depths: List[int] = []
+        self.in_flight = 0
+        self.samples: List[dict] = []
+        self.start_time = 0.0
+
+    def result(self, kind: str) -> BenchResult:
+        if kind not in self.results:
+            self.results[kind] = BenchResult(kind)
+        return self.results[kind]
+
+    async def user(self, user_id: int) -> None:
+        rng = random.Random(self.args.seed * 100003 + user_id)
+        mean_think_time = 60.0 / self.args.messages_per_minute
+        # Spread the users' first messages over one think time.
+        await asyncio.sleep(rng.uniform(0, mean_think_time))
+        while True:
+            if self.voice_bytes is not None and rng.random() < self.args.voice_ratio:
+                update = ("voice", None)
+            else:
+                update = ("text", rng.choice(TEXT_MESSAGES))
+            await self.queue.put((user_id, update, time.perf_counter()))
+            await asyncio.sleep(rng.expovariate(1.0 / mean_think_time))
+
+    async def worker(self) -> None:
+        while True:
+            user_id, (kind, text), queued_at = await self.queue.get()
+            self.in_flight += 1
+            state = self.states[user_id]
+            # Keys the user's queue in the fair scheduler, as check_auth does in the bot.
+            state.setdefault("user_id", user_id)
+            self.bot_core.ensure_state(state)
+            try:
+                if kind == "voice":
+                    await self.bot_core.handle_voice(state, self.voice_bytes, message_date=time.time())
+                else:
+                    await self.bot_core.handle_text(state, text)
+                elapsed = time.perf_counter() - queued_at
+                self.result(kind).latencies.append(elapsed)
+                self.window.append(elapsed)
+            except Exception:
+                self.result(kind).record_error()
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    async def monitor_loop_lag(self, interval: float = 0.1) -> None:
+        while True:
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            self.loop_lags.append(max(0.0, time.perf_counter() - expected))
+            self.queue_depths.append(self.queue.qsize())
+
+    def sample(self) -> dict:
+        states = list(self.states.values())
+        window = sorted(self.window)
+        lags = sorted(self.loop_lags)
+        sample = {
+            "elapsed_s": time.perf_counter() - self.start_time,
+            "completed": sum(len(r.latencies) for r in self.results.values()),
+            "errors": sum(r.errors for r in self.results.values()),
+            "p50_ms": percentile(window, 50) * 1000,
+            "p99_ms": percentile(window, 99) * 1000,
+            "loop_lag_p99_ms": percentile(lags, 99) * 1000,
+            "loop_lag_max_ms": (lags[-1] if lags else 0.0) * 1000,
+            "queue_depth_max": max(self.queue_depths, default=0),
+            "in_flight": self.in_flight,
+            "rss_mb": rss_bytes() / 2 ** 20,
+            "history_entries": sum(len(s.get("history", [])) for s in states),
+            "chat_history_entries": sum(len(s.get("chat_history", [])) for s in states),
+            # What PicklePersistence would write for all users.
+            "state_pickle_kb": len(pickle.dumps(dict(self.states))) / 1024,
+        }
+        self.window = []
+        self.loop_lags = []
+        self.queue_depths = []
+        self.samples.append(sample)
+        return sample
+
+    async def report(self) -> None:
+        while True:
+            await asyncio.sleep(self.args.report_interval)
+            s = self.sample()
+            print(
+                f"[{s['elapsed_s']:7.0f}s] done={s['completed']} err={s['errors']} "
+                f"p50={s['p50_ms']:.0f}ms p99={s['p99_ms']:.0f}ms "
+                f"lag_p99={s['loop_lag_p99_ms']:.0f}ms lag_max={s['loop_lag_max_ms']:.0f}ms "
+                f"queue_max={s['queue_depth_max']} in_flight={s['in_flight']} rss={s['rss_mb']:.1f}MB "
+                f"history={s['history_entries']} chat_history={s['chat_history_entries']} "
+                f"state={s['state_pickle_kb']:.0f}KB",
+                flush=True,
+            )
+
+    async def run(self) -> None:
+        self.start_time = time.perf_counter()
+        background = [asyncio.create_task(self.worker()) for _ in range(self.args.concurrency)]
+        background.append(asyncio.create_task(self.monitor_loop_lag()))
+        background.append(asyncio.create_task(self.report()))
+        users = [asyncio.create_task(self.user(user_id)) for user_id in range(self.args.users)]
+
+        await asyncio.sleep(self.args.duration)
+        for task in users:
+            task.cancel()
+        await asyncio.gather(*users, return_exceptions=True)
+        # Let the queued updates drain, so their latencies are counted.
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=self.args.drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.queue.qsize()} updates still queued after {self.args.drain_timeout}s")
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        for result in self.results.values():
+            result.wall_time = time.perf_counter() - self.start_time
+        self.sample()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60, help="seconds, use hours for a soak test")
+    parser.add_argument("--messages_per_minute", type=float, default=2.0, help="per user, on average")
+    parser.add_argument("--voice_ratio", type=float, default=0.7, help="fraction of updates that are voice")
+    parser.add_argument("--writer_mode", action="store_true", help="enable writer mode for all users")
+    parser.add_argument("--concurrency", type=int, default=8, help="updates processed concurrently")
+    parser.add_argument("--llm_latency", type=float, default=0.5)
+    parser.add_argument("--llm_jitter", type=float, default=0.5)
+    parser.add_argument("--llm_failure_rate", type=float, default=0.0)
+    parser.add_argument("--research_latency", type=float, default=2.0)
+    parser.add_argument("--api_latency", type=float, default=0.05, help="latency of the fake arXiv API")
+    parser.add_argument("--report_interval", type=float, default=10.0)
+    parser.add_argument("--drain_timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=str, default=None, help="write the samples and the summary to this file")
+    args = parser.parse_args(argv)
+
+    server = FakeServiceServer(FakeServiceConfig(latency=args.api_latency)).start()
+    # Has to happen before the repo modules are imported: the clients are built on first use, but the endpoints
+    # (ARXIV_API_URL, GEMINI_API_ENDPOINT) are read into module constants at import time.
+    os.environ.update(server.environ())
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if repo_root not in sys.path:
+        sys.path.insert(0, repo_root)
+    from bot_core import BotCore
+
+    bot_core = BotCore(
+        llm_service=StubLLMService(
+            latency=args.llm_latency, jitter=args.llm_jitter, failure_rate=args.llm_failure_rate, seed=args.seed,
+        ),
+        deep_research_runner=make_deep_research_runner(latency=args.research_latency),
+    )
+
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="voicenote_load_") as work_dir:
+        os.chdir(work_dir)
+        try:
+            voice_bytes = None
+            if args.voice_ratio > 0:
+                if shutil.which("ffmpeg") is None:
+                    print("ffmpeg not found, only sending text updates.")
+                else:
+                    with open(make_speech_like_wav(os.path.join(work_dir, "voice.wav"), seconds=8), "rb") as f:
+                        voice_bytes = f.read()
+
+            load_test = LoadTest(args, bot_core, voice_bytes)
+            if args.writer_mode:
+                for user_id in range(args.users):
+                    load_test.states[user_id]["writer_mode"] = True
+            asyncio.run(load_test.run())
+        finally:
+            os.chdir(original_cwd)
+            server.stop()
+
+    results = list(load_test.results.values())
+    print()
+    print(format_table(results))
+    last = load_test.samples[-1]
+    print(f"Final RSS {last['rss_mb']:.1f}MB, {last['history_entries']} history and "
+          f"{last['chat_history_entries']} chat_history entries, {last['state_pickle_kb']:.0f}KB of user state.")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "args": vars(args),
+                "results": [result.summary() for result in results],
+                "samples": load_test.samples,
+            }, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
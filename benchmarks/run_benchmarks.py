@@ -0,0 +1,296 @@
+"""
+Offline microbenchmarks for the voice note pipeline. The OpenAI, Gemini and arXiv APIs are replaced by the local
+stand-ins of benchmarks/fake_services.py and the bot's LLM / deep research backends by benchmarks/stubs.py, so
+this runs on a plain Linux box without network (the audio benchmarks additionally need ffmpeg).
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmarks --iterations 50 --latency 0.05
+    python -m benchmarks.run_benchmarks --only split_for_telegram,parse_sections --json bench.json
+
+Reports throughput and p50/p99 latency per benchmark. model_providers doubles as a check that every model the
+apps use by default (including whisper-1) maps to a provider of llm_client; any errors in its row are a bug.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional
+
+from benchmarks.fake_services import FakeServiceConfig, FakeServiceServer
+from benchmarks.fixtures import make_latex_source, make_long_message, make_speech_like_wav
+from benchmarks.stats import BenchResult, format_table
+from benchmarks.stubs import StubLLMService, make_deep_research_runner
+
+
+@dataclass
+class BenchContext:
+    iterations: int
+    work_dir: str
+    server: FakeServiceServer
+    llm_latency: float
+
+
+def run_sync(name: str, fn: Callable[[], object], iterations: int,
+             setup: Optional[Callable[[], None]] = None) -> BenchResult:
+    result = BenchResult(name)
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception:
+            result.record_error()
+            continue
+        finally:
+            elapsed = time.perf_counter() - start
+            result.wall_time += elapsed
+        result.latencies.append(elapsed)
+    return result
+
+
+def run_async(name: str, fn: Callable[[], Awaitable[object]], iterations: int,
+              setup: Optional[Callable[[], None]] = None) -> BenchResult:
+    async def timed() -> BenchResult:
+        result = BenchResult(name)
+        for _ in range(iterations):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            try:
+                await fn()
+            except Exception:
+                result.record_error()
+                continue
+            finally:
+                elapsed = time.perf_counter() - start
+                result.wall_time += elapsed
+            result.latencies.append(elapsed)
+        return result
+    return asyncio.run(timed())
+
+
+def needs_ffmpeg(name: str) -> Optional[BenchResult]:
+    if shutil.which("ffmpeg") is None:
+        return BenchResult(name, note="ffmpeg not found")
+    return None
+
+
+def bench_split_for_telegram(ctx: BenchContext) -> BenchResult:
+    from message_utils import split_for_telegram
+
+    text = make_long_message(num_paragraphs=400)
+    return run_sync("split_for_telegram", lambda: split_for_telegram(text), ctx.iterations)
+
+
+def bench_expand_inputs(ctx: BenchContext) -> BenchResult:
+    from arxiv_utils import expand_inputs
+
+    source_dir = os.path.join(ctx.work_dir, "latex_source")
+    main_tex = make_latex_source(source_dir, num_sections=24, paragraphs_per_section=40, num_inputs=8)
+    with open(main_tex) as f:
+        content = f.read()
+    return run_sync("expand_inputs", lambda: expand_inputs(source_dir, content), ctx.iterations)
+
+
+def bench_parse_sections(ctx: BenchContext) -> BenchResult:
+    from arxiv_utils import expand_inputs, parse_sections
+
+    source_dir = os.path.join(ctx.work_dir, "latex_source_sections")
+    main_tex = make_latex_source(source_dir, num_sections=24, paragraphs_per_section=40, num_inputs=8)
+    with open(main_tex) as f:
+        all_content = expand_inputs(source_dir, f.read())
+    return run_sync("parse_sections", lambda: parse_sections(all_content), ctx.iterations)
+
+
+def bench_convert_audio(ctx: BenchContext) -> BenchResult:
+    skipped = needs_ffmpeg("convert_audio_file_to_format (30s)")
+    if skipped:
+        return skipped
+    from core import convert_audio_file_to_format
+
+    input_path = make_speech_like_wav(os.path.join(ctx.work_dir, "speech_30s.wav"), seconds=30)
+    output_path = os.path.join(ctx.work_dir, "speech_30s.mp3")
+    return run_sync(
+        "convert_audio_file_to_format (30s)",
+        lambda: convert_audio_file_to_format(input_path, output_path, "mp3"),
+        ctx.iterations,
+    )
+
+
+def bench_transcribe_voice_message(ctx: BenchContext) -> BenchResult:
+    from core import transcribe_voice_message
+
+    input_path = make_speech_like_wav(os.path.join(ctx.work_dir, "speech_5s.wav"), seconds=5)
+    return run_sync("core.transcribe_voice_message (fake API)",
+                    lambda: transcribe_voice_message(input_path), ctx.iterations)
+
+
+def bench_model_providers(ctx: BenchContext) -> BenchResult:
+    """Resolves the provider of every model the apps use by default, an iteration fails if one has none."""
+    from asr import GEMINI_ASR_MODEL
+    from core import WHISPER_MODEL
+    from llm_client import get_llm_client
+    from model_router import GEMINI_MODELS, OPENAI_MODELS, bot_router, web_router
+
+    models = {WHISPER_MODEL, GEMINI_ASR_MODEL, "gemini-pro"}
+    models.update(spec.name for spec in GEMINI_MODELS + OPENAI_MODELS)
+    for router in (bot_router(), web_router()):
+        for policy in router.routes.values():
+            models.update(policy.candidates)
+    client = get_llm_client()
+
+    def resolve_all():
+        for model in sorted(models):
+            client.provider(model)
+
+    return run_sync(f"LLMClient.provider ({len(models)} models)", resolve_all, ctx.iterations)
+
+
+def bench_paraphrase_text(ctx: BenchContext) -> BenchResult:
+    from core import paraphrase_text
+
+    return run_sync("core.paraphrase_text (fake API)",
+                    lambda: paraphrase_text("今天我们讨论一下基准测试。"), ctx.iterations)
+
+
+def bench_search_arxiv(ctx: BenchContext) -> BenchResult:
+    from arxiv_utils import ArXiv
+
+    return run_sync("ArXiv.search_arxiv (fake API)",
+                    lambda: ArXiv.search_arxiv(["representation", "learning"]), ctx.iterations)
+
+
+def make_bot_core():
+    from bot_core import BotCore
+
+    return BotCore(
+        llm_service=StubLLMService(latency=0.0),
+        deep_research_runner=make_deep_research_runner(latency=0.0),
+    )
+
+
+def bench_handle_text_search(ctx: BenchContext) -> BenchResult:
+    bot_core = make_bot_core()
+    state = {}
+    bot_core.ensure_state(state)
+    return run_async("BotCore.handle_text (a:)",
+                     lambda: bot_core.handle_text(state, "a: representation learning"), ctx.iterations)
+
+
+def bench_handle_text_arxiv(ctx: BenchContext) -> BenchResult:
+    bot_core = make_bot_core()
+    bot_core.llm_service.latency = ctx.llm_latency
+    state = {}
+    bot_core.ensure_state(state)
+    paper_dir = os.path.join(os.getcwd(), "2402.18510")
+
+    def remove_downloaded_paper():
+        # Measure the cold path: e-print download, untar and parse.
+        shutil.rmtree(paper_dir, ignore_errors=True)
+
+    return run_async("BotCore.handle_text (arxiv link)",
+                     lambda: bot_core.handle_text(state, "https://arxiv.org/abs/2402.18510"),
+                     ctx.iterations, setup=remove_downloaded_paper)
+
+
+def bench_handle_voice(ctx: BenchContext) -> BenchResult:
+    skipped = needs_ffmpeg("BotCore.handle_voice (writer mode)")
+    if skipped:
+        return skipped
+    bot_core = make_bot_core()
+    bot_core.llm_service.latency = ctx.llm_latency
+    state = {}
+    bot_core.ensure_state(state)
+    state["writer_mode"] = True
+    input_path = make_speech_like_wav(os.path.join(ctx.work_dir, "voice_10s.wav"), seconds=10)
+    with open(input_path, "rb") as f:
+        voice_bytes = f.read()
+
+    def reset_state():
+        # Keep the history from growing across iterations.
+        state["chat_history"] = []
+        state["history"] = []
+
+    return run_async("BotCore.handle_voice (writer mode)",
+                     lambda: bot_core.handle_voice(state, voice_bytes), ctx.iterations, setup=reset_state)
+
+
+BENCHMARKS = {
+    "split_for_telegram": bench_split_for_telegram,
+    "expand_inputs": bench_expand_inputs,
+    "parse_sections": bench_parse_sections,
+    "convert_audio": bench_convert_audio,
+    "model_providers": bench_model_providers,
+    "transcribe_voice_message": bench_transcribe_voice_message,
+    "paraphrase_text": bench_paraphrase_text,
+    "search_arxiv": bench_search_arxiv,
+    "handle_text_search": bench_handle_text_search,
+    "handle_text_arxiv": bench_handle_text_arxiv,
+    "handle_voice": bench_handle_voice,
+}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--only", type=str, default=None, help="comma-separated benchmark names")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency of the fake HTTP APIs, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="failure rate of the fake HTTP APIs")
+    parser.add_argument("--llm_latency", type=float, default=0.0, help="latency of the stub LLM calls")
+    parser.add_argument("--json", type=str, default=None, help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {unknown}, choose from {list(BENCHMARKS)}")
+
+    server = FakeServiceServer(FakeServiceConfig(
+        latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+    )).start()
+    # Has to happen before the repo modules are imported: the clients are built on first use, but the endpoints
+    # (ARXIV_API_URL, GEMINI_API_ENDPOINT) are read into module constants at import time.
+    os.environ.update(server.environ())
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if repo_root not in sys.path:
+        sys.path.insert(0, repo_root)
+
+    results = []
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="voicenote_bench_") as work_dir:
+        # ArXiv.download_latex extracts papers into the working directory.
+        os.chdir(work_dir)
+        try:
+            ctx = BenchContext(args.iterations, work_dir, server, args.llm_latency)
+            for name in names:
+                try:
+                    result = BENCHMARKS[name](ctx)
+                except ImportError as e:
+                    result = BenchResult(name, note=f"missing dependency: {e}")
+                except Exception:
+                    traceback.print_exc()
+                    result = BenchResult(name, note="failed, see traceback")
+                results.append(result)
+                print(format_table([result]).splitlines()[-1], flush=True)
+        finally:
+            os.chdir(original_cwd)
+            server.stop()
+
+    print()
+    print(format_table(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([result.summary() for result in results], f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""Latency statistics and reporting shared by the benchmarks."""
+import sys
+import traceback
+from dataclasses import dataclass, field
+from typing import List
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of already sorted values, q in [0, 100]."""
+    if not sorted_values:
+        return float("nan")
+    rank = max(1, int(round(q / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+@dataclass
+class BenchResult:
+    name: str
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    wall_time: float = 0.0
+    note: str = ""
+
+    def record_error(self) -> None:
+        """Counts a failed iteration, from an except block. The first failure's traceback is printed."""
+        if self.errors == 0:
+            print(f"{self.name}: iteration failed, further failures are only counted", file=sys.stderr)
+            traceback.print_exc()
+        self.errors += 1
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.wall_time if self.wall_time > 0 else 0.0
+
+    def summary(self) -> dict:
+        values = sorted(self.latencies)
+        return {
+            "name": self.name,
+            "count": len(values),
+            "errors": self.errors,
+            "throughput": self.throughput,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": (values[-1] if values else float("nan")) * 1000,
+            "note": self.note,
+        }
+
+
+def format_table(results: List[BenchResult]) -> str:
+    header = f"{'benchmark':<40} {'count':>7} {'errors':>6} {'ops/s':>10} {'p50 ms':>10} {'p99 ms':>10}"
+    lines = [header, "-" * len(header)]
+    for result in results:
+        s = result.summary()
+        if result.note and not s["count"]:
+            lines.append(f"{s['name']:<40} skipped: {result.note}")
+            continue
+        lines.append(
+            f"{s['name']:<40} {s['count']:>7} {s['errors']:>6} {s['throughput']:>10.1f} "
+            f"{s['p50_ms']:>10.2f} {s['p99_ms']:>10.2f}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,97 @@
+"""
+In-process stand-ins for the `llm_service` and `deep_research_runner` backends of BotCore, with configurable
+latency and failure injection.
+"""
+import asyncio
+import random
+import time
+from typing import Callable, List, Optional, Tuple
+
+from benchmarks.fake_services import FAKE_COMPLETION, FAKE_TRANSCRIPT
+from model_router import bot_router
+from paper_summary import OVERALL_KEY, plan_summary
+
+
+class InjectedFailure(Exception):
+    pass
+
+
+class StubLLMService:
+    """Implements the LLMService interface used by BotCore without calling any model."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+        # Keys BotCore's transcript cache, like LLMService.default_model.
+        self.default_model = "stub"
+        # The real router, so its overhead is part of the measurements.
+        self.router = bot_router()
+
+    async def _call(self) -> None:
+        self.calls += 1
+        await asyncio.sleep(self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0))
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            raise InjectedFailure("injected LLM failure")
+
+    async def transcribe_audio(self, audio_path: str) -> str:
+        await self._call()
+        return FAKE_TRANSCRIPT
+
+    async def summarize_past_discussions(self, snippets: List[str]) -> str:
+        if not snippets:
+            return ""
+        await self._call()
+        return FAKE_COMPLETION
+
+    async def summarize_keywords(self, comments: List[str]) -> List[str]:
+        await self._call()
+        return ["representation", "learning"]
+
+    async def summarize_paper_sections(self, paper, reference_idea: Optional[str] = None) -> dict:
+        # As many calls as the real, token-budgeted summarization would make.
+        plan = plan_summary(paper.sections, reference_idea=reference_idea)
+        await asyncio.gather(*[self._call() for _ in range(plan.num_calls)])
+        results = {OVERALL_KEY: FAKE_COMPLETION}
+        results.update((sec_title, FAKE_COMPLETION) for sec_title in paper.sections)
+        return results
+
+    async def summarize_notes(self, notes: List[str]) -> str:
+        await self._call()
+        return FAKE_COMPLETION
+
+    async def merge_summaries(self, summaries: List[str], period: str = "day") -> str:
+        await self._call()
+        return FAKE_COMPLETION
+
+    async def preprocess_text(self, text: str) -> dict:
+        await self._call()
+        return {"tag": "聊天", "content": text}
+
+    async def paraphrase_text(self, text: str, model_family: str) -> str:
+        await self._call()
+        return FAKE_COMPLETION
+
+    async def preprocess_and_paraphrase(self, text: str, model_family: str) -> dict:
+        await self._call()
+        return {"tag": "聊天", "content": text, "paraphrased": FAKE_COMPLETION}
+
+    async def paraphrase_routed(self, text: str, route: str) -> Tuple[str, str]:
+        return await self.router.run(route, lambda model_family: self.paraphrase_text(text, model_family))
+
+    async def preprocess_and_paraphrase_routed(self, text: str, route: str) -> dict:
+        result, model_family = await self.router.run(
+            route, lambda model_family: self.preprocess_and_paraphrase(text, model_family)
+        )
+        result["model"] = model_family
+        return result
+
+
+def make_deep_research_runner(latency: float = 0.0, answer: str = FAKE_COMPLETION) -> Callable[[str], str]:
+    """A deep_research_runner that sleeps (blocking, like the real subprocess) and returns a canned answer."""
+    def run(query: str) -> str:
+        time.sleep(latency)
+        return answer
+    return run
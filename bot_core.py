@@ -1,18 +1,28 @@
-import re
+import asyncio
+import copy
+import os
 import tempfile
 from dataclasses import dataclass
-from typing import Callable, List, Optional
+from typing import Awaitable, Callable, List, Optional, Union
 
 from arxiv_utils import ArXiv
-from get_stock_info import get_sentiment
-from core import convert_audio_file_to_format
+from audio_preprocess import ASR_AUDIO_EXTENSION, prepare_for_asr
+from core import parse_tag
+from fair_scheduler import BATCH, INTERACTIVE, RESEARCH, FairScheduler, SchedulerBusy
+from media_fetcher import MediaFetcher
+from memory import StateLimiter
+from paper_cache import PaperCache, PaperPrefetcher
+from pipeline import Pipeline, Stage
+from singleflight import SingleFlight
+from tracing import span
+from transcript_cache import TranscriptCache, content_key, telegram_key
 
 
-OUTPUT_FORMAT = "mp3"
-
-file_matcher = re.compile(r"Correcting container of \"(.*)\"")
-file_matcher2 = re.compile(r"\[download\] Destination: (.*)")
-file_matcher3 = re.compile(r"\[download\] (.*) has already been downloaded")
+# Seconds each stage of handle_voice may take, overridable with e.g. STAGE_TIMEOUT_DEEP_RESEARCH.
+STAGE_TIMEOUTS = {
+    stage: float(os.environ.get(f"STAGE_TIMEOUT_{stage.upper()}", default))
+    for stage, default in [("transcribe", 300), ("research_query", 60), ("deep_research", 1800), ("writer", 300)]
+}
 
 
 @dataclass
@@ -32,14 +42,95 @@ class BotResult:
 
 
 class BotCore:
-    def __init__(self, llm_service, deep_research_runner: Callable[[str], str]):
+    def __init__(
+        self,
+        llm_service,
+        deep_research_runner: Callable[[str], str],
+        use_combined_prompt: bool = False,
+        asr_backend=None,
+        media_fetcher: Optional[MediaFetcher] = None,
+        transcript_cache: Optional[TranscriptCache] = None,
+        paper_cache: Optional[PaperCache] = None,
+        state_limiter: Optional[StateLimiter] = None,
+        scheduler: Optional[FairScheduler] = None,
+    ):
         self.llm_service = llm_service
+        # An asr.ASRBackend; without one, voice notes are transcribed by llm_service.transcribe_audio (Gemini).
+        self.asr_backend = asr_backend
         self.deep_research_runner = deep_research_runner
+        # The 嘎嘎嘎 tag is parsed locally, so writer mode needs one LLM call either way. The combined prompt lets
+        # the LLM split the tag as well, which is more forgiving when the marker is misrecognized.
+        self.use_combined_prompt = use_combined_prompt
+        # Users pasting the same link or query at the same time share one fetch and summary.
+        self.single_flight = SingleFlight()
+        self.media_fetcher = media_fetcher or MediaFetcher()
+        # Transcripts of voice notes already seen, None to always transcribe.
+        self.transcript_cache = transcript_cache
+        # Parsed papers, warmed by prefetching the results of `a:` searches.
+        self.paper_cache = paper_cache or PaperCache()
+        self._paper_requests = 0
+        self.prefetcher = PaperPrefetcher(self.paper_cache, is_busy=lambda: self._paper_requests > 0)
+        # Caps on the per-user state, see memory.py.
+        self.state_limiter = state_limiter or StateLimiter()
+        # Shares the slots for transcription, deep research and paper summaries fairly between users.
+        self.scheduler = scheduler or FairScheduler()
+
+    async def schedule(
+        self,
+        state: dict,
+        priority: int,
+        fn: Callable[[], Awaitable],
+        notify: Optional[Callable[[str], None]] = None,
+    ):
+        """Runs fn() in the user's turn, see fair_scheduler.py. notify(text) tells the user if it has to wait."""
+        on_queued = None
+        if notify is not None:
+            on_queued = lambda position: notify(f"Queued, position {position}.")
+        return await self.scheduler.run(state.get("user_id", "default"), priority, fn, on_queued)
+
+    async def transcribe(self, audio_path: str) -> str:
+        if self.asr_backend is not None:
+            return await self.asr_backend.transcribe_async(audio_path)
+        return await self.llm_service.transcribe_audio(audio_path)
+
+    async def load_paper(self, arxiv_id: str, load: Callable[[], ArXiv]) -> ArXiv:
+        """The paper with its LaTeX parsed, from the paper cache or load(). A copy, free to set a summary on."""
+        paper = self.paper_cache.get(arxiv_id)
+        if paper is None:
+            self._paper_requests += 1
+            # If it is being prefetched, lift the bandwidth cap rather than downloading it again.
+            self.prefetcher.boost(arxiv_id)
+            try:
+                # Downloading and parsing the LaTeX source blocks, keep it off the event loop.
+                paper = await asyncio.to_thread(load)
+            finally:
+                self._paper_requests -= 1
+            self.paper_cache.put(paper)
+        return copy.copy(paper)
+
+    @staticmethod
+    def _download(paper: ArXiv) -> ArXiv:
+        # A search result may be shared with coalesced requests, parse a copy.
+        paper = copy.copy(paper)
+        paper.download_latex()
+        return paper
+
+    async def fetch_and_summarize_paper(self, paperlink: str) -> ArXiv:
+        paper = await self.load_paper(ArXiv.id_from_link(paperlink), lambda: ArXiv(paperlink, True))
+        with span("paper_summary"):
+            paper.summary = await self.llm_service.summarize_paper_sections(paper)
+        return paper
+
+    async def search_arxiv(self, keywords: List[str]) -> List[ArXiv]:
+        return await self.single_flight.do(
+            ("arxiv_search", tuple(keywords)), lambda: asyncio.to_thread(ArXiv.search_arxiv, keywords)
+        )
 
     def ensure_state(self, state: dict) -> None:
         state.setdefault("chat_history", [])
         state.setdefault("writer_mode", False)
         state.setdefault("use_context_summary", True)
+        state.setdefault("deep_research", True)
         state.setdefault("history", [])
 
     def append_chat_history(self, state: dict, text: str, reply_text: Optional[str]) -> None:
@@ -58,7 +149,8 @@ class BotCore:
         past_snippets = history[-5:]
         context_summary = ""
         if state.get("use_context_summary", True):
-            context_summary = await self.llm_service.summarize_past_discussions(past_snippets)
+            with span("context_summary"):
+                context_summary = await self.llm_service.summarize_past_discussions(past_snippets)
         self.append_chat_history(state, current_text, reply_text)
         if context_summary:
             return (
@@ -73,6 +165,10 @@ class BotCore:
         state["writer_mode"] = not state.get("writer_mode", False)
         return state["writer_mode"]
 
+    def toggle_deep_research(self, state: dict) -> bool:
+        state["deep_research"] = not state.get("deep_research", True)
+        return state["deep_research"]
+
     def toggle_context_summary(self, state: dict) -> bool:
         state["use_context_summary"] = not state.get("use_context_summary", True)
         return state["use_context_summary"]
@@ -83,35 +179,48 @@ class BotCore:
         text: str,
         reply_text: Optional[str] = None,
         reply_chain: Optional[List[str]] = None,
+        notify: Optional[Callable[[str], None]] = None,
     ) -> List[BotResponse]:
+        """The replies to a text message. notify(text) is for the "queued" notice of the scheduled commands."""
         self.append_chat_history(state, text, reply_text)
+        self.state_limiter.enforce(state)
+        try:
+            return await self._handle_text(state, text, reply_chain, notify)
+        except SchedulerBusy as e:
+            return [BotResponse(kind="text", text=str(e))]
 
+    async def _handle_text(
+        self,
+        state: dict,
+        text: str,
+        reply_chain: Optional[List[str]],
+        notify: Optional[Callable[[str], None]],
+    ) -> List[BotResponse]:
         if text.startswith("https://arxiv.org/"):
-            paper = ArXiv(text)
-            summary = await self.llm_service.summarize_paper_sections(paper)
-            paper.summary = summary
+            paper = await self.single_flight.do(
+                ("arxiv", text),
+                lambda: self.schedule(state, BATCH, lambda: self.fetch_and_summarize_paper(text), notify),
+            )
             return [
                 BotResponse(kind="text", text=msg, parse_mode="HTML")
                 for msg in paper.to_message()
             ]
 
         if text.startswith("https://www.youtube.com/watch?") or text.startswith("https://youtu.be/"):
-            from subprocess import check_output
-
-            output = check_output(f"yt-dlp --cookies ../youtube_cookie.txt -f 140 {text}", shell=True).decode("utf-8")
-            output_file = ""
-            for line in output.split("\n"):
-                m = file_matcher.search(line) or file_matcher2.search(line) or file_matcher3.search(line)
-                if m:
-                    output_file = m.group(1).strip()
-                    break
-            if output_file:
-                return [BotResponse(kind="audio", file_path=output_file, cleanup_path=True)]
-            return [BotResponse(kind="text", text="Failed to extract audio from youtube link.")]
+            try:
+                with span("youtube_download"):
+                    output_file = await self.media_fetcher.fetch(text)
+            except Exception as e:
+                print(f"YouTube download failed: {e!r}")
+                return [BotResponse(kind="text", text="Failed to extract audio from youtube link.")]
+            # The file stays in the media cache for the next request.
+            return [BotResponse(kind="audio", file_path=output_file)]
 
         if text.startswith("a:"):
             _, keywords = text.split(":", 1)
-            papers = ArXiv.search_arxiv(keywords.split())
+            papers = await self.search_arxiv(keywords.split())
+            # The user is likely to paste one of the top results next, download them in the background.
+            self.prefetcher.submit(papers)
             responses = []
             for paper in papers:
                 for msg in paper.to_message():
@@ -122,75 +231,185 @@ class BotCore:
             chain = reply_chain or []
             if not chain:
                 return [BotResponse(kind="text", text="No reply chain found for brainstorming.")]
-            keywords = await self.llm_service.summarize_keywords(chain)
-            papers = ArXiv.search_arxiv(keywords)
-            responses = [
-                BotResponse(kind="text", text=f"Keywords: {keywords}. Find {len(papers)} papers")
-            ]
-            reference_idea = " ".join(chain)
-            for paper in papers:
-                paper.summary = await self.llm_service.summarize_paper_sections(
-                    paper,
-                    reference_idea=reference_idea,
-                )
-                for msg in paper.to_message():
-                    responses.append(BotResponse(kind="text", text=msg, parse_mode="HTML"))
-            return responses
+            return await self.schedule(state, BATCH, lambda: self.brainstorm(chain), notify)
 
         if text.startswith("search"):
+            # Imported on demand, it sets up the Gemini client.
+            from get_stock_info import get_sentiment
+
             item = text.split(" ", 1)[1].strip()
-            _, overall_output = get_sentiment(item)
+            with span("stock_sentiment"):
+                _, overall_output = await self.single_flight.do(
+                    ("sentiment", item),
+                    lambda: self.schedule(state, BATCH, lambda: asyncio.to_thread(get_sentiment, item), notify),
+                )
             overall_output = overall_output.replace("[", "<b>").replace("]", "</b>")
             return [BotResponse(kind="text", text=overall_output, parse_mode="HTML")]
 
         return [BotResponse(kind="text", text="I don't understand")]
 
+    async def brainstorm(self, chain: List[str]) -> List[BotResponse]:
+        """`bs`: finds papers on the ideas of the reply chain and summarizes each against them."""
+        with span("summarize_keywords"):
+            keywords = await self.llm_service.summarize_keywords(chain)
+        papers = await self.search_arxiv(keywords)
+        responses = [
+            BotResponse(kind="text", text=f"Keywords: {keywords}. Find {len(papers)} papers")
+        ]
+        reference_idea = " ".join(chain)
+        for paper in papers:
+            paper = await self.load_paper(paper.arxiv_id, lambda paper=paper: self._download(paper))
+            with span("paper_summary"):
+                paper.summary = await self.llm_service.summarize_paper_sections(
+                    paper,
+                    reference_idea=reference_idea,
+                )
+            for msg in paper.to_message():
+                responses.append(BotResponse(kind="text", text=msg, parse_mode="HTML"))
+        return responses
+
+    async def transcribe_voice(
+        self,
+        voice: Union[bytes, Callable[[], Awaitable[bytes]]],
+        file_unique_id: Optional[str] = None,
+    ) -> str:
+        """Transcribes the voice note, given as bytes or as a coroutine function downloading them.
+
+        With a transcript cache, a note seen before (same file_unique_id or same bytes) is neither downloaded nor
+        transcribed again.
+        """
+        cache = self.transcript_cache
+        # Without an ASR backend, tells the transcripts of LLMService's models apart.
+        llm_model = self.llm_service.default_model if self.asr_backend is None else None
+        keys = [telegram_key(file_unique_id)] if file_unique_id else []
+        if cache is not None and keys:
+            # A miss here is counted by the content lookup below.
+            cached = await asyncio.to_thread(cache.get, keys, self.asr_backend, llm_model, False)
+            if cached is not None:
+                return cached
+
+        voice_bytes = voice if isinstance(voice, (bytes, bytearray)) else await voice()
+        if cache is not None:
+            keys.append(content_key(bytes(voice_bytes)))
+            cached = await asyncio.to_thread(cache.get, keys[-1:], self.asr_backend, llm_model)
+            if cached is not None:
+                await asyncio.to_thread(cache.put, keys[:-1], self.asr_backend, cached, llm_model)
+                return cached
+
+        with tempfile.NamedTemporaryFile("wb+", suffix=".ogg") as temp_audio_file:
+            temp_audio_file.write(voice_bytes)
+            temp_audio_file.seek(0)
+            with tempfile.NamedTemporaryFile(suffix=ASR_AUDIO_EXTENSION) as temp_output_file:
+                with span("transcode") as transcode:
+                    report = await asyncio.to_thread(prepare_for_asr, temp_audio_file.name, temp_output_file.name)
+                    transcode.tags["bytes_saved"] = report.bytes_saved
+                with span("asr"):
+                    transcribed_text = await self.transcribe(temp_output_file.name)
+        if cache is not None:
+            await asyncio.to_thread(cache.put, keys, self.asr_backend, transcribed_text, llm_model)
+        return transcribed_text
+
+    async def write(self, state: dict, transcribed_text: str, message_date=None) -> dict:
+        """Writer mode: splits the tag and paraphrases the note, and keeps it in the history."""
+        with span("preprocess"):
+            result_obj = parse_tag(transcribed_text)
+        # The router picks the model within the route's latency SLO and cost ceiling, see model_router.py.
+        route = "chat" if result_obj.get("tag") == "聊天" else "writing"
+        if self.use_combined_prompt:
+            with span("paraphrase", route=route, combined=True):
+                result_obj = await self.llm_service.preprocess_and_paraphrase_routed(transcribed_text, route)
+        else:
+            with span("paraphrase", route=route):
+                paraphrased_text, model_family = await self.llm_service.paraphrase_routed(
+                    result_obj["content"], route
+                )
+            result_obj["paraphrased"] = paraphrased_text
+            result_obj["model"] = model_family
+        result_obj["transcribed"] = transcribed_text
+        result_obj["date"] = message_date
+        state.setdefault("history", []).append(result_obj)
+        return result_obj
+
     async def handle_voice(
         self,
         state: dict,
-        voice_bytes: bytes,
+        voice: Union[bytes, Callable[[], Awaitable[bytes]]],
         reply_text: Optional[str] = None,
         log_research_query: Optional[Callable[[str], None]] = None,
         message_date=None,
+        file_unique_id: Optional[str] = None,
+        notify: Optional[Callable[[str], None]] = None,
     ) -> BotResult:
-        with tempfile.NamedTemporaryFile("wb+", suffix=".ogg") as temp_audio_file:
-            temp_audio_file.write(voice_bytes)
-            temp_audio_file.seek(0)
-            with tempfile.NamedTemporaryFile(suffix=f".{OUTPUT_FORMAT}") as temp_output_file:
-                convert_audio_file_to_format(temp_audio_file.name, temp_output_file.name, OUTPUT_FORMAT)
-                transcribed_text = await self.llm_service.transcribe_audio(temp_output_file.name)
+        """Transcribes the voice note, then runs deep research and writer mode on it concurrently (see pipeline.py).
+
+        Only a failed transcription raises; a failed or timed out deep research or paraphrase is reported in the
+        responses. The transcription and writer stages are scheduled as interactive work, deep research as research
+        (see fair_scheduler.py); notify(text) tells the user when one of them has to wait for its turn.
+        """
+        deep_research = state.get("deep_research", True)
+        writer_mode = state.get("writer_mode", False)
+
+        async def transcribe() -> str:
+            return await self.schedule(state, INTERACTIVE, lambda: self.transcribe_voice(voice, file_unique_id), notify)
+
+        async def research_query(transcribe: str) -> str:
+            query = await self.build_research_query(state, transcribe, reply_text)
+            if log_research_query:
+                log_research_query(query)
+            return query
+
+        async def run_deep_research(research_query: str) -> str:
+            # The runner blocks (a subprocess), keep it off the event loop. A timeout stops waiting for it, the
+            # thread itself runs to completion.
+            return await self.schedule(
+                state, RESEARCH, lambda: asyncio.to_thread(self.deep_research_runner, research_query), notify
+            )
+
+        async def writer(transcribe: str) -> dict:
+            return await self.schedule(state, INTERACTIVE, lambda: self.write(state, transcribe, message_date), notify)
+
+        pipeline = Pipeline([
+            Stage("transcribe", transcribe, timeout=STAGE_TIMEOUTS["transcribe"], required=True),
+            Stage("research_query", research_query, inputs=("transcribe",),
+                  timeout=STAGE_TIMEOUTS["research_query"], enabled=deep_research),
+            Stage("deep_research", run_deep_research, inputs=("research_query",),
+                  timeout=STAGE_TIMEOUTS["deep_research"], enabled=deep_research),
+            Stage("writer", writer, inputs=("transcribe",),
+                  timeout=STAGE_TIMEOUTS["writer"], enabled=writer_mode),
+        ])
+        results = await pipeline.run()
+        transcribed_text = results["transcribe"].value
 
         responses = [
             BotResponse(kind="text", text="Transcribed text:"),
             BotResponse(kind="text", text=transcribed_text),
         ]
 
-        research_query = await self.build_research_query(state, transcribed_text, reply_text)
-        if log_research_query:
-            log_research_query(research_query)
-        research_answer = self.deep_research_runner(research_query)
-
-        if not research_answer:
+        if not deep_research:
+            # Still part of the conversation for the next research query.
+            self.append_chat_history(state, transcribed_text, reply_text)
+        elif not results["deep_research"].ok:
+            error = results["research_query"].error or results["deep_research"].error
+            responses.append(BotResponse(kind="text", text=f"Deep research failed: {error!r}"))
+        elif not results["deep_research"].value:
             responses.append(BotResponse(kind="text", text="Deep research returned no answer."))
         else:
+            research_answer = results["deep_research"].value
             responses.append(BotResponse(kind="text", text="Starting deep research..."))
             responses.append(BotResponse(kind="text", text=research_answer))
             self.append_chat_history(state, research_answer, reply_text=None)
 
-        if state.get("writer_mode", False):
-            result_obj = await self.llm_service.preprocess_text(transcribed_text)
-            model_family = "gemini-2.5-flash" if result_obj.get("tag") == "聊天" else "gemini-2.5-pro-preview-05-06"
-            result_obj["model"] = model_family
-            result_obj["transcribed"] = transcribed_text
-            paraphrased_text = await self.llm_service.paraphrase_text(result_obj["content"], model_family)
-            result_obj["paraphrased"] = paraphrased_text
-            result_obj["date"] = message_date
-            state.setdefault("history", []).append(result_obj)
-            responses.append(BotResponse(kind="text", text=f"Paraphrased using {model_family}:"))
-            responses.append(BotResponse(kind="text", text=paraphrased_text))
+        if writer_mode:
+            if results["writer"].ok:
+                result_obj = results["writer"].value
+                responses.append(BotResponse(kind="text", text=f"Paraphrased using {result_obj['model']}:"))
+                responses.append(BotResponse(kind="text", text=result_obj["paraphrased"]))
+            else:
+                responses.append(BotResponse(kind="text", text=f"Paraphrasing failed: {results['writer'].error!r}"))
 
+        self.state_limiter.enforce(state)
         return BotResult(
             responses=responses,
-            research_query=research_query,
+            research_query=results["research_query"].value,
             transcribed_text=transcribed_text,
         )
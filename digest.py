@@ -0,0 +1,207 @@
+"""
+Daily digest of the writer-mode notes (`state["history"]`), sent to every user by a job on Application.job_queue.
+
+* Every day at DIGEST_TIME, each user gets a digest of the complete days since their last digest (at most
+  DIGEST_MAX_CATCHUP_DAYS, e.g. after the bot was down). With DIGEST_WEEKLY_WEEKDAY set (0 is Monday), that day
+  also brings a rollup of the previous 7 days.
+* A day is summarized map-reduce style: its notes are packed into batches of at most DIGEST_BATCH_CHARS characters
+  (sized to the model context), the batches are summarized in parallel and the partial summaries merged.
+* Day summaries are cached in `state["digest_days"]`, so the weekly rollup only merges the cached summaries.
+* Users are processed concurrently (DIGEST_USER_CONCURRENCY), and all digest LLM calls share a global cap
+  (DIGEST_LLM_CONCURRENCY), so the job does not crowd out interactive traffic.
+
+Needs the job queue extra of python-telegram-bot (`pip install "python-telegram-bot[job-queue]"`).
+"""
+import asyncio
+import datetime
+import os
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from tracing import span
+
+DIGEST_TIME = os.environ.get("DIGEST_TIME", "08:00")
+DIGEST_TIMEZONE = os.environ.get("DIGEST_TIMEZONE", "UTC")
+DIGEST_LLM_CONCURRENCY = int(os.environ.get("DIGEST_LLM_CONCURRENCY", "4"))
+DIGEST_USER_CONCURRENCY = int(os.environ.get("DIGEST_USER_CONCURRENCY", "8"))
+DIGEST_BATCH_CHARS = int(os.environ.get("DIGEST_BATCH_CHARS", "24000"))
+DIGEST_MAX_CATCHUP_DAYS = int(os.environ.get("DIGEST_MAX_CATCHUP_DAYS", "7"))
+# -1 disables the weekly rollup.
+DIGEST_WEEKLY_WEEKDAY = int(os.environ.get("DIGEST_WEEKLY_WEEKDAY", "0"))
+# Day summaries older than this are dropped from the cache.
+DIGEST_CACHE_DAYS = 14
+
+
+def pack_batches(notes: List[str], max_chars: int) -> List[List[str]]:
+    """Packs the notes in order into batches of at most max_chars characters. A longer note gets a batch of its own."""
+    batches: List[List[str]] = []
+    size = 0
+    for note in notes:
+        if not batches or size + len(note) > max_chars:
+            batches.append([])
+            size = 0
+        batches[-1].append(note)
+        size += len(note)
+    return batches
+
+
+def as_utc_aware(value: datetime.datetime) -> datetime.datetime:
+    # Telegram dates are UTC.
+    return value if value.tzinfo is not None else value.replace(tzinfo=datetime.timezone.utc)
+
+
+def format_note(entry: dict, tz: datetime.tzinfo) -> str:
+    text = entry.get("paraphrased") or entry.get("content") or entry.get("transcribed") or ""
+    return f"[{as_utc_aware(entry['date']).astimezone(tz):%H:%M}] ({entry.get('tag', '')}) {text}"
+
+
+class DigestBuilder:
+    def __init__(
+        self,
+        llm_service,
+        tz: datetime.tzinfo = ZoneInfo(DIGEST_TIMEZONE),
+        llm_concurrency: int = DIGEST_LLM_CONCURRENCY,
+        batch_chars: int = DIGEST_BATCH_CHARS,
+        max_catchup_days: int = DIGEST_MAX_CATCHUP_DAYS,
+        weekly_weekday: int = DIGEST_WEEKLY_WEEKDAY,
+    ):
+        self.llm_service = llm_service
+        self.tz = tz
+        self.llm_slots = asyncio.Semaphore(llm_concurrency)
+        self.batch_chars = batch_chars
+        self.max_catchup_days = max_catchup_days
+        self.weekly_weekday = weekly_weekday
+
+    async def summarize_notes(self, notes: List[str]) -> str:
+        async with self.llm_slots:
+            return await self.llm_service.summarize_notes(notes)
+
+    async def merge_summaries(self, summaries: List[str], period: str) -> str:
+        if len(summaries) == 1:
+            return summaries[0]
+        # Reduce in rounds while the partial summaries don't fit in one call.
+        while len(summaries) > 1 and sum(len(s) for s in summaries) > self.batch_chars:
+            groups = pack_batches(summaries, self.batch_chars)
+            if len(groups) == len(summaries):
+                # Every summary is a batch of its own already, merge them in pairs.
+                groups = [summaries[i:i + 2] for i in range(0, len(summaries), 2)]
+            summaries = await asyncio.gather(*[self._merge(group, period) for group in groups])
+        return await self._merge(summaries, period) if len(summaries) > 1 else summaries[0]
+
+    async def _merge(self, summaries: List[str], period: str) -> str:
+        if len(summaries) == 1:
+            return summaries[0]
+        async with self.llm_slots:
+            return await self.llm_service.merge_summaries(summaries, period)
+
+    def local_day(self, entry: dict) -> Optional[datetime.date]:
+        entry_date = entry.get("date")
+        if not isinstance(entry_date, datetime.datetime):
+            return None
+        return as_utc_aware(entry_date).astimezone(self.tz).date()
+
+    def notes_by_day(self, state: dict) -> Dict[datetime.date, List[dict]]:
+        days: Dict[datetime.date, List[dict]] = {}
+        for entry in state.get("history", []):
+            day = self.local_day(entry)
+            if day is not None:
+                days.setdefault(day, []).append(entry)
+        return days
+
+    async def day_summary(self, state: dict, day: datetime.date, entries: List[dict]) -> str:
+        """Summary of one complete day, cached in the state."""
+        cache = state.setdefault("digest_days", {})
+        key = day.isoformat()
+        if key in cache and cache[key]["count"] == len(entries):
+            return cache[key]["summary"]
+
+        notes = [format_note(entry, self.tz) for entry in entries]
+        with span("digest.day", notes=len(notes)):
+            partials = await asyncio.gather(*[
+                self.summarize_notes(batch) for batch in pack_batches(notes, self.batch_chars)
+            ])
+            summary = await self.merge_summaries(list(partials), "day")
+        cache[key] = {"summary": summary, "count": len(entries)}
+        return summary
+
+    async def build(self, state: dict, today: datetime.date) -> Tuple[List[str], datetime.date]:
+        """The digest messages due for the user on `today`, and the last_digest_day to store once all are sent.
+
+        The state is only marked by the caller, so that a digest that fails to send is tried again next time.
+        """
+        by_day = self.notes_by_day(state)
+        last_day = state.get("last_digest_day")
+        first_day = today - datetime.timedelta(days=self.max_catchup_days)
+        if last_day is not None:
+            first_day = max(first_day, last_day + datetime.timedelta(days=1))
+        else:
+            # First digest, only the day before, not the whole history.
+            first_day = today - datetime.timedelta(days=1)
+
+        days = sorted(day for day in by_day if first_day <= day < today)
+        summaries = await asyncio.gather(*[self.day_summary(state, day, by_day[day]) for day in days])
+        messages = [
+            f"Digest of {day.isoformat()} ({len(by_day[day])} notes):\n\n{summary}"
+            for day, summary in zip(days, summaries)
+        ]
+
+        if self.weekly_weekday == today.weekday():
+            week = [today - datetime.timedelta(days=i) for i in range(7, 0, -1)]
+            week_days = [day for day in week if day in by_day]
+            if len(week_days) > 1:
+                week_summaries = await asyncio.gather(*[
+                    self.day_summary(state, day, by_day[day]) for day in week_days
+                ])
+                with span("digest.week", days=len(week_days)):
+                    weekly = await self.merge_summaries(list(week_summaries), "week")
+                messages.append(f"Digest of the week {week[0].isoformat()} to {week[-1].isoformat()}:\n\n{weekly}")
+
+        cutoff = (today - datetime.timedelta(days=DIGEST_CACHE_DAYS)).isoformat()
+        cache = state.get("digest_days", {})
+        for key in [key for key in cache if key < cutoff]:
+            del cache[key]
+        return messages, today - datetime.timedelta(days=1)
+
+
+async def send_digests(
+    application, builder: DigestBuilder, outbox, user_concurrency: int = DIGEST_USER_CONCURRENCY
+) -> None:
+    today = datetime.datetime.now(builder.tz).date()
+    user_slots = asyncio.Semaphore(user_concurrency)
+
+    async def send_one(user_id: int, state: dict) -> None:
+        async with user_slots:
+            try:
+                messages, last_digest_day = await builder.build(state, today)
+                # Paced by the outbox together with the interactive replies.
+                await asyncio.gather(*[
+                    outbox.send_text(application.bot, user_id, message) for message in messages
+                ])
+                state["last_digest_day"] = last_digest_day
+            except Exception as e:
+                print(f"Digest for user {user_id} failed: {e!r}")
+            finally:
+                application.mark_data_for_update_persistence(user_ids=[user_id])
+
+    # Only users who went through check_auth have a writer-mode history.
+    users = [(user_id, state) for user_id, state in application.user_data.items() if state.get("history")]
+    await asyncio.gather(*[send_one(user_id, state) for user_id, state in users])
+
+
+def schedule_digests(application, llm_service, outbox) -> bool:
+    """Registers the daily digest job, sending through the outbox (a MessageScheduler). False without a job queue."""
+    if application.job_queue is None:
+        print('Daily digests are disabled, install "python-telegram-bot[job-queue]" to enable them.')
+        return False
+    builder = DigestBuilder(llm_service)
+    hour, minute = (int(part) for part in DIGEST_TIME.split(":"))
+
+    async def digest_job(context) -> None:
+        await send_digests(context.application, builder, outbox)
+
+    application.job_queue.run_daily(
+        digest_job,
+        time=datetime.time(hour, minute, tzinfo=builder.tz),
+        name="daily_digest",
+    )
+    return True
@@ -0,0 +1,217 @@
+"""
+Fair scheduling of the bot's expensive work across users, so one user's `bs` run (dozens of LLM calls) or deep
+research does not hold up everyone else's voice notes.
+
+* Priority classes: INTERACTIVE (transcription, writer mode) runs before RESEARCH (deep research) and BATCH (paper
+  summaries, `bs`, stock sentiment). SCHEDULER_INTERACTIVE_SLOTS of the SCHEDULER_SLOTS are reserved for
+  interactive work, so it never waits behind a slot full of half-hour research runs.
+* Weighted fair sharing (start-time fair queuing): each job is tagged with the service its user will have received
+  once the user's earlier jobs are done, in seconds divided by the user's weight (SCHEDULER_USER_WEIGHTS as
+  `user_id:weight,...`), and within a class the job with the smallest tag starts first. So a user with ten `bs`
+  runs queued shares the slots evenly with the other users waiting, and a user coming back after a pause starts at
+  the current virtual time rather than with a large credit.
+* Per-user caps: at most SCHEDULER_PER_USER_RUNNING research and batch jobs of a user run at once (interactive jobs
+  are not counted and not held back, so a user's voice note never waits for their own `bs` run), and at most
+  SCHEDULER_PER_USER_QUEUED wait; beyond that (or SCHEDULER_MAX_QUEUED in total) a job is rejected with
+  SchedulerBusy. A job that has to wait is told its position, for the "queued, position N" reply.
+
+Time spent waiting is exported as the voicenote_scheduler_wait_seconds histogram (label: priority).
+"""
+import asyncio
+import itertools
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from tracing import metrics
+
+SCHEDULER_SLOTS = int(os.environ.get("SCHEDULER_SLOTS", "8"))
+SCHEDULER_INTERACTIVE_SLOTS = int(os.environ.get("SCHEDULER_INTERACTIVE_SLOTS", "2"))
+SCHEDULER_PER_USER_RUNNING = int(os.environ.get("SCHEDULER_PER_USER_RUNNING", "2"))
+SCHEDULER_PER_USER_QUEUED = int(os.environ.get("SCHEDULER_PER_USER_QUEUED", "5"))
+SCHEDULER_MAX_QUEUED = int(os.environ.get("SCHEDULER_MAX_QUEUED", "100"))
+SCHEDULER_USER_WEIGHTS = os.environ.get("SCHEDULER_USER_WEIGHTS", "")
+
+INTERACTIVE = 0
+RESEARCH = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", RESEARCH: "research", BATCH: "batch"}
+# Service charged for a job when it is queued, in seconds, corrected by its actual duration when it ends.
+ESTIMATED_SECONDS = {INTERACTIVE: 10.0, RESEARCH: 600.0, BATCH: 120.0}
+
+wait_seconds = metrics.histogram(
+    "voicenote_scheduler_wait_seconds", "Time jobs waited for a slot of the fair scheduler.", ("priority",)
+)
+
+T = TypeVar("T")
+
+
+class SchedulerBusy(Exception):
+    """The job was not admitted, the user (or everyone) has too many jobs waiting."""
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """`123:2,456:0.5` -> {"123": 2.0, "456": 0.5}."""
+    weights = {}
+    for item in spec.split(","):
+        if item.strip():
+            user, weight = item.rsplit(":", 1)
+            weights[user.strip()] = float(weight)
+    return weights
+
+
+@dataclass
+class _Job:
+    user: str
+    priority: int
+    tag: float
+    seq: int
+    enqueued: float
+    grant: asyncio.Future = field(repr=False)
+
+
+class FairScheduler:
+    def __init__(
+        self,
+        slots: int = SCHEDULER_SLOTS,
+        interactive_slots: int = SCHEDULER_INTERACTIVE_SLOTS,
+        per_user_running: int = SCHEDULER_PER_USER_RUNNING,
+        per_user_queued: int = SCHEDULER_PER_USER_QUEUED,
+        max_queued: int = SCHEDULER_MAX_QUEUED,
+        weights: Optional[Dict[str, float]] = None,
+    ):
+        self.slots = slots
+        self.interactive_slots = min(interactive_slots, slots - 1)
+        self.per_user_running = per_user_running
+        self.per_user_queued = per_user_queued
+        self.max_queued = max_queued
+        self.weights = parse_weights(SCHEDULER_USER_WEIGHTS) if weights is None else weights
+        self._queue: List[_Job] = []
+        self._running: Dict[str, int] = {}
+        # Research and batch jobs running per user, the ones per_user_running applies to.
+        self._running_heavy: Dict[str, int] = {}
+        self._running_by_priority: Dict[int, int] = {}
+        # Tag of the last job started, and the tag at which each user's queued and running jobs will be done.
+        # Idle users are forgotten.
+        self._virtual_time = 0.0
+        self._finish_tags: Dict[str, float] = {}
+        self._seq = itertools.count()
+        self.rejected = 0
+
+    def weight(self, user: str) -> float:
+        return self.weights.get(user, 1.0)
+
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    def queued(self, user: Optional[str] = None) -> int:
+        return sum(1 for job in self._queue if user is None or job.user == user)
+
+    def _tag(self, user: str, priority: int) -> float:
+        tag = max(self._virtual_time, self._finish_tags.get(user, 0.0))
+        self._finish_tags[user] = tag + ESTIMATED_SECONDS[priority] / self.weight(user)
+        return tag
+
+    def _forget_if_idle(self, user: str) -> None:
+        if not self._running.get(user) and not any(job.user == user for job in self._queue):
+            self._finish_tags.pop(user, None)
+            self._running.pop(user, None)
+            self._running_heavy.pop(user, None)
+
+    def _can_start(self, user: str, priority: int) -> bool:
+        if priority == INTERACTIVE:
+            return self.running < self.slots
+        if self._running_heavy.get(user, 0) >= self.per_user_running:
+            return False
+        heavy = self.running - self._running_by_priority.get(INTERACTIVE, 0)
+        return self.running < self.slots and heavy < self.slots - self.interactive_slots
+
+    @staticmethod
+    def _order(job: _Job):
+        return job.priority, job.tag, job.seq
+
+    def position(self, job: _Job) -> int:
+        """1-based place of the job in the order jobs are started, as things stand."""
+        return sorted(self._queue, key=self._order).index(job) + 1
+
+    def _start(self, user: str, priority: int, tag: float) -> None:
+        self._running[user] = self._running.get(user, 0) + 1
+        if priority != INTERACTIVE:
+            self._running_heavy[user] = self._running_heavy.get(user, 0) + 1
+        self._running_by_priority[priority] = self._running_by_priority.get(priority, 0) + 1
+        self._virtual_time = max(self._virtual_time, tag)
+
+    def _finish(self, user: str, priority: int, duration: float) -> None:
+        self._running[user] -= 1
+        if priority != INTERACTIVE:
+            self._running_heavy[user] -= 1
+        self._running_by_priority[priority] -= 1
+        self._finish_tags[user] += (duration - ESTIMATED_SECONDS[priority]) / self.weight(user)
+        self._forget_if_idle(user)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        for job in sorted(self._queue, key=self._order):
+            if self.running >= self.slots:
+                break
+            if self._can_start(job.user, job.priority):
+                self._queue.remove(job)
+                self._start(job.user, job.priority, job.tag)
+                job.grant.set_result(None)
+
+    async def run(
+        self,
+        user,
+        priority: int,
+        fn: Callable[[], Awaitable[T]],
+        on_queued: Optional[Callable[[int], None]] = None,
+    ) -> T:
+        """Runs fn() when the user's turn comes. on_queued(position) is called if it has to wait.
+
+        Raises SchedulerBusy without running fn if the job is not admitted.
+        """
+        user = str(user)
+        if not self._queue and self._can_start(user, priority):
+            self._start(user, priority, self._tag(user, priority))
+            wait_seconds.observe(0.0, priority=PRIORITY_NAMES[priority])
+        else:
+            if self.queued(user) >= self.per_user_queued or len(self._queue) >= self.max_queued:
+                self.rejected += 1
+                raise SchedulerBusy(
+                    f"Too many requests waiting ({self.queued(user)} of yours, {len(self._queue)} in total), "
+                    "please try again later."
+                )
+            job = _Job(
+                user, priority, self._tag(user, priority), next(self._seq), time.monotonic(),
+                asyncio.get_running_loop().create_future(),
+            )
+            self._queue.append(job)
+            # Queued jobs may still start right away, e.g. ahead of jobs blocked by their user's cap.
+            self._dispatch()
+            if not job.grant.done() and on_queued is not None:
+                on_queued(self.position(job))
+            try:
+                await job.grant
+            except asyncio.CancelledError:
+                if job.grant.done() and not job.grant.cancelled():
+                    # Granted just as it was cancelled, give the slot back.
+                    self._finish(user, priority, ESTIMATED_SECONDS[priority])
+                else:
+                    self._queue.remove(job)
+                    self._finish_tags[user] -= ESTIMATED_SECONDS[priority] / self.weight(user)
+                    self._forget_if_idle(user)
+                    self._dispatch()
+                raise
+            wait_seconds.observe(time.monotonic() - job.enqueued, priority=PRIORITY_NAMES[priority])
+
+        start = time.monotonic()
+        try:
+            return await fn()
+        finally:
+            self._finish(user, priority, time.monotonic() - start)
+
+    def stats(self) -> Dict[str, int]:
+        return {"running": self.running, "queued": len(self._queue), "users": len(self._finish_tags),
+                "rejected": self.rejected}
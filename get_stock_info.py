@@ -2,18 +2,15 @@ from datetime import datetime
 import requests
 import json
 
-import requests
-import google.generativeai as genai
 import re
 import os
 
-genai.configure(api_key=os.environ.get('GEMINI_API_KEY'))
-
-# for m in genai.list_models():
-#     if 'generateContent' in m.supported_generation_methods:
-#         print(m.name)
+from llm_client import get_llm_client
+from tracing import span
 
-model = genai.GenerativeModel('gemini-pro') 
+SENTIMENT_MODEL = 'gemini-pro'
+# Attempts at getting a parsable answer, the client retries failed calls on its own.
+SENTIMENT_MAX_ATTEMPTS = 3
 
 def search_twitter(keyword):
     url = "https://twitter-api45.p.rapidapi.com/search.php"
@@ -25,7 +22,8 @@ def search_twitter(keyword):
         "X-RapidAPI-Host": "twitter-api45.p.rapidapi.com"
     }
 
-    response = requests.get(url, headers=headers, params=querystring)
+    with span("twitter.search"):
+        response = requests.get(url, headers=headers, params=querystring)
     return response.json()
 
 def get_sentiment(query):
@@ -78,15 +76,18 @@ def get_sentiment(query):
         Here are the posts:
     '''
 
-    while True:
+    for attempt in range(SENTIMENT_MAX_ATTEMPTS):
         try:
-            response = model.generate_content(prompt.format(stock=query) + "\n".join(input_data))
-            # parse by json
-            results = json.loads(response.text)
+            with span("sentiment_llm"):
+                # Asks for a JSON answer and parses it.
+                results = get_llm_client().generate_sync(
+                    prompt.format(stock=query) + "\n".join(input_data), SENTIMENT_MODEL, json_output=True
+                )
             break
         except Exception as e:
             print(e)
-            continue
+            if attempt == SENTIMENT_MAX_ATTEMPTS - 1:
+                raise
 
     overall_sentiment = 0 
     overall_quality = 0
@@ -0,0 +1,178 @@
+"""
+Incremental transcription of a recording that is still being uploaded.
+
+The web recorder posts small timesliced chunks of one recording while the user is still talking. Chunks are
+appended to the session's recording file, which is periodically decoded in the background; every time a full
+segment (LIVE_SEGMENT_SECONDS) of audio is available, it is cut out (at a pause if there is one near the boundary),
+transcoded and transcribed in a worker thread. When the recording stops, only the last partial segment is left to
+transcribe and the final text is the segments stitched together.
+
+Note that timesliced MediaRecorder chunks are not decodable on their own (only the first one carries the container
+header), hence the whole recording received so far is decoded, rather than each chunk.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+from pydub.silence import detect_silence
+
+from audio_preprocess import ASR_AUDIO_FORMAT, export_for_asr
+from core import transcribe_voice_message
+
+SEGMENT_SECONDS = float(os.environ.get("LIVE_SEGMENT_SECONDS", "30"))
+LIVE_TRANSCRIBE_WORKERS = int(os.environ.get("LIVE_TRANSCRIBE_WORKERS", "8"))
+# Sessions without any activity for this long are dropped.
+SESSION_TTL_SECONDS = float(os.environ.get("LIVE_SESSION_TTL_SECONDS", "3600"))
+
+# The tail of a partially uploaded recording may be truncated mid-frame, so it is never cut before the end.
+TAIL_GUARD_MS = 1000
+# Look for a pause to cut at within this window before the nominal segment boundary.
+CUT_SEARCH_MS = 5000
+MIN_SILENCE_MS = 300
+
+
+def find_cut_point(audio: AudioSegment, start_ms: int, end_ms: int) -> int:
+    """Returns where to end the segment [start_ms, end_ms), preferring the middle of the last pause near end_ms."""
+    window_start = max(start_ms, end_ms - CUT_SEARCH_MS)
+    window = audio[window_start:end_ms]
+    if len(window) < MIN_SILENCE_MS or window.dBFS == float("-inf"):
+        return end_ms
+    silences = detect_silence(window, min_silence_len=MIN_SILENCE_MS, silence_thresh=window.dBFS - 16)
+    if not silences:
+        return end_ms
+    silence_start, silence_end = silences[-1]
+    return window_start + (silence_start + silence_end) // 2
+
+
+class TranscriptionSession:
+    def __init__(
+        self,
+        ext_name: str,
+        executor: ThreadPoolExecutor,
+        transcribe_fn: Callable[[str], str] = transcribe_voice_message,
+        segment_seconds: float = SEGMENT_SECONDS,
+    ):
+        self.session_id = uuid.uuid4().hex
+        self.executor = executor
+        self.transcribe_fn = transcribe_fn
+        self.segment_ms = int(segment_seconds * 1000)
+        self.work_dir = tempfile.mkdtemp(prefix="voice_session_")
+        self.recording_path = os.path.join(self.work_dir, f"recording.{ext_name}")
+        self.last_activity = time.monotonic()
+
+        self._lock = threading.Lock()
+        self._next_seq = 0
+        self._pending_chunks: Dict[int, bytes] = {}
+        self._segments: List[Future] = []
+        self._next_start_ms = 0
+        self._last_scan = 0.0
+        self._scan_future: Optional[Future] = None
+
+    def append_chunk(self, seq: int, data: bytes) -> None:
+        """Appends the chunk with sequence number `seq`. Chunks arriving out of order are held back."""
+        with self._lock:
+            self.last_activity = time.monotonic()
+            self._pending_chunks[seq] = data
+            with open(self.recording_path, "ab") as f:
+                while self._next_seq in self._pending_chunks:
+                    f.write(self._pending_chunks.pop(self._next_seq))
+                    self._next_seq += 1
+            # Decoding is O(recording length), so don't rescan more often than a fraction of a segment.
+            due = time.monotonic() - self._last_scan >= self.segment_ms / 3000
+            if due and (self._scan_future is None or self._scan_future.done()):
+                self._last_scan = time.monotonic()
+                self._scan_future = self.executor.submit(self._scan, False)
+
+    def _scan(self, final: bool) -> None:
+        try:
+            audio = AudioSegment.from_file(self.recording_path)
+        except CouldntDecodeError:
+            if final:
+                raise
+            # Not enough data for a valid container yet, try again with the next chunks.
+            return
+
+        with self._lock:
+            available_ms = len(audio) if final else len(audio) - TAIL_GUARD_MS
+            while available_ms - self._next_start_ms >= self.segment_ms:
+                end_ms = find_cut_point(audio, self._next_start_ms, self._next_start_ms + self.segment_ms)
+                self._submit_segment(audio[self._next_start_ms:end_ms])
+                self._next_start_ms = end_ms
+            if final and len(audio) > self._next_start_ms:
+                self._submit_segment(audio[self._next_start_ms:])
+                self._next_start_ms = len(audio)
+
+    def _submit_segment(self, segment: AudioSegment) -> None:
+        index = len(self._segments)
+        self._segments.append(self.executor.submit(self._transcribe_segment, segment, index))
+
+    def _transcribe_segment(self, segment: AudioSegment, index: int) -> str:
+        segment_path = os.path.join(self.work_dir, f"segment_{index:04d}.{ASR_AUDIO_FORMAT}")
+        export_for_asr(segment, segment_path)
+        try:
+            return self.transcribe_fn(segment_path)
+        finally:
+            os.remove(segment_path)
+
+    def finish(self) -> str:
+        """Transcribes what is left of the recording and returns the whole transcription."""
+        with self._lock:
+            scan_future = self._scan_future
+        if scan_future is not None:
+            scan_future.result()
+        self._scan(final=True)
+        texts = [future.result().strip() for future in self._segments]
+        return " ".join(text for text in texts if text)
+
+    def close(self) -> None:
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class SessionStore:
+    def __init__(
+        self,
+        max_workers: int = LIVE_TRANSCRIBE_WORKERS,
+        ttl_seconds: float = SESSION_TTL_SECONDS,
+        transcribe_fn: Callable[[str], str] = transcribe_voice_message,
+    ):
+        self.transcribe_fn = transcribe_fn
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="live_transcription")
+        self.ttl_seconds = ttl_seconds
+        self._sessions: Dict[str, TranscriptionSession] = {}
+        self._lock = threading.Lock()
+
+    def create(self, ext_name: str) -> TranscriptionSession:
+        self.expire()
+        session = TranscriptionSession(ext_name, self.executor, transcribe_fn=self.transcribe_fn)
+        with self._lock:
+            self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id: str) -> Optional[TranscriptionSession]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def finish(self, session_id: str) -> str:
+        """Finishes the session and returns its transcription. Raises KeyError for an unknown session."""
+        with self._lock:
+            session = self._sessions.pop(session_id)
+        try:
+            return session.finish()
+        finally:
+            session.close()
+
+    def expire(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [s for s in self._sessions.values() if now - s.last_activity > self.ttl_seconds]
+            for session in expired:
+                del self._sessions[session.session_id]
+        for session in expired:
+            session.close()
@@ -0,0 +1,461 @@
+"""
+The shared LLM client: one async layer over the OpenAI and Gemini APIs, used by core.py (the web app and the CLIs),
+LLMService (the bot), llm_summary.py and get_stock_info.py, so that every call shares connections, retries and
+backpressure.
+
+* Connections: one pool of keep-alive HTTP connections per provider (httpx, at most LLM_MAX_CONNECTIONS), built on
+  first use. OpenAI goes through the openai SDK on top of that pool (OPENAI_BASE_URL is honored), Gemini through
+  its REST API at GEMINI_API_ENDPOINT.
+* Backpressure: at most LLM_MAX_CONCURRENCY calls per provider are in flight, the others wait for a slot. The
+  waits are exported as the voicenote_llm_slot_wait_seconds histogram.
+* Retries: timeouts, connection errors, 429 and 5xx are retried LLM_MAX_RETRIES times with exponential backoff,
+  honoring Retry-After. Streams are only retried before the first piece.
+* generate(json_output=True) asks the model for JSON and returns it parsed; stream() yields the text as it is
+  generated; transcribe() for audio. use_cache=True serves identical calls from an LRU of LLM_CACHE_SIZE responses.
+* The *_sync shims run the same calls on a background event loop, for the Flask app and the CLIs.
+
+The model name picks the provider (model_router.provider_of), e.g. gemini-2.5-flash goes to Gemini and gpt-4o to
+OpenAI. Connection pools are kept per event loop, since httpx connections cannot be shared between loops (the bot,
+the ASGI app and the sync shims each run on their own loop). The concurrency slots are process-wide, shared by all
+loops and threads, so LLM_MAX_CONCURRENCY holds for the process as a whole.
+"""
+import asyncio
+import base64
+import functools
+import json
+import mimetypes
+import os
+import random
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Iterator, Optional, TypeVar
+
+from model_router import provider_of
+from tracing import metrics
+
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "16"))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "32"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "120"))
+LLM_CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", "512"))
+# Overridable so that the benchmarks (see benchmarks/) can point it to a local stand-in.
+GEMINI_API_ENDPOINT = os.environ.get("GEMINI_API_ENDPOINT") or "https://generativelanguage.googleapis.com"
+GEMINI_TRANSCRIBE_PROMPT = (
+    "Transcribe this recording verbatim, in the language spoken. Output only the transcript, without any comments."
+)
+# Idle connections are kept open this long.
+KEEPALIVE_SECONDS = 60.0
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 30.0
+
+slot_wait_seconds = metrics.histogram(
+    "voicenote_llm_slot_wait_seconds", "Time LLM calls waited for a concurrency slot.", ("provider",)
+)
+
+T = TypeVar("T")
+
+
+class LLMError(Exception):
+    """A call that failed for good, or a response without any text."""
+
+
+def parse_json_output(text: str) -> Any:
+    """Parses a JSON response, also when the model wrapped it in a ``` fence."""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    return json.loads(text)
+
+
+def backoff_seconds(attempt: int, retry_after: Optional[str] = None) -> float:
+    if retry_after:
+        try:
+            return min(MAX_BACKOFF_SECONDS, float(retry_after))
+        except ValueError:
+            # An HTTP date, rare enough to fall back to the backoff.
+            pass
+    # Full jitter, so that the calls throttled together do not come back together.
+    return random.uniform(0.5, 1.0) * min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt)
+
+
+class ProcessSemaphore:
+    """An asyncio semaphore usable from any event loop and thread of the process, unlike asyncio.Semaphore."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._lock = threading.Lock()
+        # (loop, future) of the callers waiting, in order.
+        self._waiters: deque = deque()
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, future))
+                    granted = False
+                except ValueError:
+                    # release() already handed the slot over, pass it on.
+                    granted = True
+            if granted:
+                self.release()
+            raise
+
+    def release(self) -> None:
+        with self._lock:
+            while self._waiters:
+                loop, future = self._waiters.popleft()
+                if loop.is_closed():
+                    continue
+                # The slot goes straight to the waiter, so callers arriving meanwhile cannot take it.
+                loop.call_soon_threadsafe(_grant, future)
+                return
+            self._value += 1
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+def _grant(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Provider:
+    name = ""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_connections: int = LLM_MAX_CONNECTIONS):
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        # Event loop -> client.
+        self._clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self._slots = ProcessSemaphore(max_concurrency)
+
+    def _http_client(self, **kwargs):
+        import httpx
+
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=KEEPALIVE_SECONDS,
+            ),
+            timeout=LLM_TIMEOUT_SECONDS,
+            **kwargs,
+        )
+
+    def _build_client(self):
+        raise NotImplementedError
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = self._build_client()
+        return client
+
+    @asynccontextmanager
+    async def slot(self):
+        start = time.perf_counter()
+        async with self._slots:
+            slot_wait_seconds.observe(time.perf_counter() - start, provider=self.name)
+            yield
+
+    async def complete(
+        self, model: str, prompt: str, system: Optional[str], temperature: Optional[float], json_output: bool
+    ) -> str:
+        raise NotImplementedError
+
+    def stream(
+        self, model: str, prompt: str, system: Optional[str], temperature: Optional[float]
+    ) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def transcribe(self, audio_path: str, model: str, prompt: Optional[str]) -> str:
+        raise NotImplementedError
+
+
+class OpenAIProvider(Provider):
+    name = "openai"
+
+    def _build_client(self):
+        from openai import AsyncOpenAI
+
+        # The SDK retries (with backoff and Retry-After) on its own, including the request opening a stream.
+        return AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            organization=os.environ.get("OPENAI_ORG"),
+            max_retries=LLM_MAX_RETRIES,
+            timeout=LLM_TIMEOUT_SECONDS,
+            http_client=self._http_client(),
+        )
+
+    @staticmethod
+    def _messages(prompt: str, system: Optional[str]):
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    async def complete(self, model, prompt, system, temperature, json_output) -> str:
+        kwargs = {}
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+        if json_output:
+            kwargs["response_format"] = {"type": "json_object"}
+        client = self.client()
+        async with self.slot():
+            response = await client.chat.completions.create(
+                model=model, messages=self._messages(prompt, system), **kwargs
+            )
+        return response.choices[0].message.content or ""
+
+    async def stream(self, model, prompt, system, temperature) -> AsyncIterator[str]:
+        kwargs = {} if temperature is None else {"temperature": temperature}
+        client = self.client()
+        async with self.slot():
+            stream = await client.chat.completions.create(
+                model=model, messages=self._messages(prompt, system), stream=True, **kwargs
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    async def transcribe(self, audio_path, model, prompt) -> str:
+        kwargs = {"prompt": prompt} if prompt else {}
+        client = self.client()
+        async with self.slot():
+            with open(audio_path, "rb") as file:
+                response = await client.audio.transcriptions.create(model=model, file=file, **kwargs)
+        return response.text
+
+
+class GeminiProvider(Provider):
+    name = "google"
+
+    def _build_client(self):
+        endpoint = GEMINI_API_ENDPOINT if "://" in GEMINI_API_ENDPOINT else f"https://{GEMINI_API_ENDPOINT}"
+        return self._http_client(
+            base_url=endpoint, headers={"x-goog-api-key": os.environ.get("GEMINI_API_KEY", "")}
+        )
+
+    @staticmethod
+    def _body(parts, system: Optional[str], temperature: Optional[float], json_output: bool = False) -> dict:
+        body = {"contents": [{"role": "user", "parts": parts}]}
+        if system:
+            body["systemInstruction"] = {"parts": [{"text": system}]}
+        config = {}
+        if temperature is not None:
+            config["temperature"] = temperature
+        if json_output:
+            config["responseMimeType"] = "application/json"
+        if config:
+            body["generationConfig"] = config
+        return body
+
+    @staticmethod
+    def _text(payload: dict) -> str:
+        candidates = payload.get("candidates") or []
+        if not candidates:
+            return ""
+        return "".join(part.get("text", "") for part in candidates[0].get("content", {}).get("parts", []))
+
+    async def _post(self, model: str, body: dict) -> str:
+        import httpx
+
+        client = self.client()
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            retry_after = None
+            try:
+                async with self.slot():
+                    response = await client.post(f"/v1beta/models/{model}:generateContent", json=body)
+            except httpx.TransportError as e:
+                # Timeouts included.
+                error = e
+            else:
+                if response.status_code < 400:
+                    payload = response.json()
+                    text = self._text(payload)
+                    if not text:
+                        raise LLMError(f"{model} returned no text: {payload.get('promptFeedback') or payload}")
+                    return text
+                error = LLMError(f"{model} returned {response.status_code}: {response.text[:500]}")
+                if response.status_code not in RETRY_STATUSES:
+                    raise error
+                retry_after = response.headers.get("Retry-After")
+            if attempt == LLM_MAX_RETRIES:
+                raise error
+            await asyncio.sleep(backoff_seconds(attempt, retry_after))
+
+    async def complete(self, model, prompt, system, temperature, json_output) -> str:
+        return await self._post(model, self._body([{"text": prompt}], system, temperature, json_output))
+
+    async def stream(self, model, prompt, system, temperature) -> AsyncIterator[str]:
+        import httpx
+
+        client = self.client()
+        body = self._body([{"text": prompt}], system, temperature)
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            started = False
+            retry_after = None
+            try:
+                async with self.slot():
+                    async with client.stream(
+                        "POST", f"/v1beta/models/{model}:streamGenerateContent", params={"alt": "sse"}, json=body
+                    ) as response:
+                        if response.status_code >= 400:
+                            await response.aread()
+                            error = LLMError(f"{model} returned {response.status_code}: {response.text[:500]}")
+                            if response.status_code not in RETRY_STATUSES:
+                                raise error
+                            retry_after = response.headers.get("Retry-After")
+                        else:
+                            async for line in response.aiter_lines():
+                                if line.startswith("data:"):
+                                    text = self._text(json.loads(line[len("data:"):]))
+                                    if text:
+                                        started = True
+                                        yield text
+                            return
+            except httpx.TransportError as e:
+                if started:
+                    # The caller already has part of the text, a retry would repeat it.
+                    raise
+                error = e
+            if attempt == LLM_MAX_RETRIES:
+                raise error
+            await asyncio.sleep(backoff_seconds(attempt, retry_after))
+
+    async def transcribe(self, audio_path, model, prompt) -> str:
+        mime_type = mimetypes.guess_type(audio_path)[0] or "audio/ogg"
+        data = await asyncio.to_thread(read_base64, audio_path)
+        parts = [{"text": prompt or GEMINI_TRANSCRIBE_PROMPT}, {"inline_data": {"mime_type": mime_type, "data": data}}]
+        return (await self._post(model, self._body(parts, None, None))).strip()
+
+
+def read_base64(path: str) -> str:
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("ascii")
+
+
+class LLMClient:
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+        cache_size: int = LLM_CACHE_SIZE,
+    ):
+        self.providers = {
+            provider.name: provider
+            for provider in (OpenAIProvider(max_concurrency, max_connections),
+                             GeminiProvider(max_concurrency, max_connections))
+        }
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[tuple, Any]" = OrderedDict()
+        # The sync shims and an async caller may use the cache from different threads.
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+
+    def provider(self, model: str) -> Provider:
+        provider = self.providers.get(provider_of(model))
+        if provider is None:
+            raise ValueError(f"No provider for the model {model}, choose from {list(self.providers)}")
+        return provider
+
+    async def generate(
+        self,
+        prompt: str,
+        model: str,
+        system: Optional[str] = None,
+        temperature: Optional[float] = None,
+        json_output: bool = False,
+        use_cache: bool = False,
+    ) -> Any:
+        """The model's answer, as text or, with json_output, parsed. Cached answers are shared, don't mutate them."""
+        key = (model, system, prompt, temperature, json_output)
+        if use_cache:
+            with self._cache_lock:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    self.cache_hits += 1
+                    return self._cache[key]
+        text = await self.provider(model).complete(model, prompt, system, temperature, json_output)
+        result = parse_json_output(text) if json_output else text
+        if use_cache and self.cache_size > 0:
+            with self._cache_lock:
+                self._cache[key] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+    def stream(
+        self, prompt: str, model: str, system: Optional[str] = None, temperature: Optional[float] = None
+    ) -> AsyncIterator[str]:
+        """The pieces of the answer, in order, as soon as they are generated."""
+        return self.provider(model).stream(model, prompt, system, temperature)
+
+    async def transcribe(self, audio_path: str, model: str, prompt: Optional[str] = None) -> str:
+        return await self.provider(model).transcribe(audio_path, model, prompt)
+
+    def generate_sync(self, prompt: str, model: str, **kwargs) -> Any:
+        return run_sync(self.generate(prompt, model, **kwargs))
+
+    def stream_sync(self, prompt: str, model: str, **kwargs) -> Iterator[str]:
+        return iterate_sync(self.stream(prompt, model, **kwargs))
+
+    def transcribe_sync(self, audio_path: str, model: str, prompt: Optional[str] = None) -> str:
+        return run_sync(self.transcribe(audio_path, model, prompt))
+
+
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_loop_lock = threading.Lock()
+
+
+def background_loop() -> asyncio.AbstractEventLoop:
+    """The event loop the sync shims run on, in a daemon thread started on first use."""
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="llm_client", daemon=True).start()
+        return _background_loop
+
+
+def run_sync(coroutine: Awaitable[T]) -> T:
+    """Runs the coroutine on the background loop and waits for it. For threads without a running event loop."""
+    return asyncio.run_coroutine_threadsafe(coroutine, background_loop()).result()
+
+
+def iterate_sync(pieces: AsyncIterator[T]) -> Iterator[T]:
+    """Iterates an async iterator on the background loop. Closing the iterator early closes the stream."""
+    loop = background_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(pieces.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        if hasattr(pieces, "aclose"):
+            asyncio.run_coroutine_threadsafe(pieces.aclose(), loop).result()
+
+
+@functools.lru_cache(maxsize=None)
+def get_llm_client() -> LLMClient:
+    """The process-wide client, whose pools and slots every call site shares."""
+    return LLMClient()
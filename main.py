@@ -1,38 +1,110 @@
-import openai
+import os
 import tempfile
-from flask import Flask, request, jsonify, send_from_directory
-from pydub import AudioSegment
+from contextlib import ExitStack
+from flask import Flask, Response, g, request, jsonify, send_from_directory, stream_with_context
 import json
-from datetime import datetime
-from core import transcribe_voice_message, paraphrase_text, convert_audio_file_to_format
+from asr import get_asr_backend
+from audio_preprocess import ASR_AUDIO_EXTENSION, prepare_for_asr
+from core import parse_tag, paraphrase_text, paraphrase_text_stream
+from live_transcription import SessionStore
+from model_router import web_router
+from note_log import DEFAULT_USER, NoteLog
+from tracing import METRICS_CONTENT_TYPE, render_metrics, span, start_trace
+from transcript_cache import content_key, open_transcript_cache
 
 app = Flask(__name__)
 
 # Configs
 # TODO: move to a config file
-OUTPUT_FORMAT = "mp3"
-# For my use case, I want to log all the content to a file, so I can later use it for GPT analysis and dispatching.
-# Change it to an actual file name will enable this logging.
-PERSONAL_LOG_FILE = None
+# For my use case, I want to log all the content, so I can later use it for GPT analysis and dispatching.
+# Set it to a directory to enable this logging, see note_log.py for the layout.
+PERSONAL_LOG_DIR = os.environ.get("PERSONAL_LOG_DIR")
+# Keep proxies (e.g. nginx) from buffering the event stream.
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Speech recognition backend, see asr.py: openai (Whisper API), gemini or local (faster-whisper on the CPU).
+ASR_BACKEND = os.environ.get("ASR_BACKEND", "openai")
+
+# Loaded once at startup, so the local model stays resident.
+asr_backend = get_asr_backend(ASR_BACKEND)
+# Recordings uploaded chunk by chunk while the user is talking, see live_transcription.py.
+live_sessions = SessionStore(transcribe_fn=asr_backend.transcribe)
+note_log = NoteLog(PERSONAL_LOG_DIR) if PERSONAL_LOG_DIR else None
+# Picks the paraphrasing model by latency, errors and cost, see model_router.py.
+paraphrase_router = web_router()
+# Transcripts of uploads seen before, keyed by the hash of the audio, see transcript_cache.py.
+transcript_cache = open_transcript_cache()
+
+@app.before_request
+def begin_request_trace():
+    g.trace_stack = ExitStack()
+    g.trace_stack.enter_context(start_trace(route=request.path))
+
+@app.teardown_request
+def end_request_trace(exc):
+    trace_stack = g.pop('trace_stack', None)
+    if trace_stack is not None:
+        trace_stack.close()
+
+def ext_name_from_content_type(content_type: str) -> str:
+    """E.g. `audio/webm;codecs=opus` -> `webm`."""
+    return content_type.split(';')[0].split('/')[-1].strip()
+
+@app.route('/session', methods=['POST'])
+def create_session():
+    """Starts a live transcription session. Expects `{"mime_type": ...}` of the recording."""
+    data = request.get_json(force=True, silent=True) or {}
+    session = live_sessions.create(ext_name_from_content_type(data.get('mime_type', 'audio/webm')))
+    return jsonify({'session_id': session.session_id})
+
+@app.route('/session/<session_id>/chunk', methods=['POST'])
+def upload_chunk(session_id):
+    """Appends one recorded chunk (form fields `audio` and `seq`) to the session."""
+    session = live_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Unknown session'}), 404
+    if 'audio' not in request.files:
+        return jsonify({'error': 'No audio file'}), 400
+    session.append_chunk(int(request.form.get('seq', 0)), request.files['audio'].read())
+    return jsonify({'ok': True})
 
 @app.route('/transcribe', methods=['POST'])
 def transcribe():
+    if 'session_id' in request.form:
+        # The recording was uploaded chunk by chunk, only the last segment is left to transcribe.
+        try:
+            with span("asr", live=True):
+                transcribed_text = live_sessions.finish(request.form['session_id'])
+        except KeyError:
+            return jsonify({'error': 'Unknown session'}), 404
+        print(transcribed_text)
+        return jsonify(transcribed_text)
+
     if 'audio' not in request.files:
         return jsonify({'error': 'No audio file'}), 400
 
     audio_file = request.files['audio']
     file_type = audio_file.content_type
-    ext_name = file_type.split('/')[-1]
-    temp_audio_file = tempfile.NamedTemporaryFile(suffix=f'.{ext_name}')
-    with tempfile.NamedTemporaryFile(suffix=f'.{ext_name}') as temp_audio_file:
-        print(temp_audio_file.name)
-        audio_file.save(temp_audio_file.name)
-        # Default is AAC, we need to convert it to mp3.
-        with tempfile.NamedTemporaryFile(suffix=f'.{OUTPUT_FORMAT}') as temp_output_file:
-            convert_audio_file_to_format(temp_audio_file.name, temp_output_file.name, OUTPUT_FORMAT)
-
-            # Send audio file to Whisper ASR API
-            transcribed_text = transcribe_voice_message(temp_output_file.name)
+    ext_name = ext_name_from_content_type(file_type)
+    audio_data = audio_file.read()
+    # The same recording uploaded again is served from the transcript cache, without transcoding it.
+    cache_keys = [content_key(audio_data)]
+    transcribed_text = transcript_cache.get(cache_keys, asr_backend) if transcript_cache else None
+    if transcribed_text is None:
+        with tempfile.NamedTemporaryFile(suffix=f'.{ext_name}') as temp_audio_file:
+            print(temp_audio_file.name)
+            temp_audio_file.write(audio_data)
+            temp_audio_file.flush()
+            # Default is AAC, downmixed, trimmed and re-encoded for the ASR upload, see audio_preprocess.py.
+            with tempfile.NamedTemporaryFile(suffix=ASR_AUDIO_EXTENSION) as temp_output_file:
+                with span("transcode") as transcode:
+                    report = prepare_for_asr(temp_audio_file.name, temp_output_file.name)
+                    transcode.tags["bytes_saved"] = report.bytes_saved
+
+                with span("asr", backend=asr_backend.name):
+                    transcribed_text = asr_backend.transcribe(temp_output_file.name)
+        if transcript_cache:
+            transcript_cache.put(cache_keys, asr_backend, transcribed_text)
 
     print(transcribed_text)
     return jsonify(transcribed_text)
@@ -45,27 +117,66 @@ def process_audio():
         text = data['text']
 
         # Send transcribed text to ChatGPT with the provided system prompt
-        processed_text = paraphrase_text(text)
+        # No hedging in the sync app, only the routing (see asgi_app.py for both).
+        model = paraphrase_router.choose("paraphrase")[0]
+        with span("paraphrase", model=model), paraphrase_router.timed(model):
+            processed_text = paraphrase_text(text, model=model)
         print(processed_text)
-        if PERSONAL_LOG_FILE:
-            log_content_to_file(processed_text, PERSONAL_LOG_FILE)
+        log_note(text, processed_text, data.get('user'))
         return jsonify(processed_text)
 
+@app.route('/process_stream', methods=['POST'])
+def process_audio_stream():
+    """Same as /process, but streams the paraphrased text as server-sent events.
+    Each event carries `{"delta": ...}`, the last one `{"done": true, "text": ...}` or `{"error": ...}`.
+    """
+    data = request.get_json(force=True)
+    text = data['text']
+
+    def generate():
+        pieces = []
+        model = paraphrase_router.choose("paraphrase")[0]
+        try:
+            with span("paraphrase", stream=True, model=model), paraphrase_router.timed(model):
+                for delta in paraphrase_text_stream(text, model=model):
+                    pieces.append(delta)
+                    yield format_sse({'delta': delta})
+        except Exception as e:
+            yield format_sse({'error': str(e)})
+            return
+        processed_text = "".join(pieces).strip()
+        print(processed_text)
+        log_note(text, processed_text, data.get('user'))
+        yield format_sse({'done': True, 'text': processed_text})
+
+    # Keeps the request (and so its trace, closed on teardown) open until the stream ends, so that the paraphrase
+    # span is recorded in it.
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 @app.route('/')
 def index():
     return send_from_directory('static', 'index.html')
 
-def log_content_to_file(content: str, file_name: str):
-    """This function helps log each content to a file, which can be later used for GPT analysis and dispatching.
-    TODO: add user management so all the users can have their own log files or database.
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+def format_sse(payload: dict) -> str:
+    """Formats a payload as one server-sent event."""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def log_note(text: str, processed_text: str, user=None):
+    """Queues the note on the note log (if enabled), which can be later used for GPT analysis and dispatching.
+    Notes are partitioned by the optional `user` field of the request, and tagged with the 嘎嘎嘎 tag of the text.
 
     Args:
-        content (str): Content to be logged.
-        file_name (str): Logging filename.
+        text (str): The text that was paraphrased.
+        processed_text (str): Content to be logged.
+        user (str, optional): The user the note belongs to.
     """
-    content_json = json.dumps({'content': content, 'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, ensure_ascii=False)
-    with open(file_name, 'a', encoding='UTF-8') as f:
-        f.write(content_json + '\n')
+    if note_log is None:
+        return
+    note_log.append(processed_text, user=user or DEFAULT_USER, tag=parse_tag(text)['tag'])
 
 if __name__ == '__main__':
     app.run(debug=True)
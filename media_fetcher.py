@@ -0,0 +1,144 @@
+"""
+Shared YouTube audio fetcher for the bot (BotCore) and transcribe_youtube.py.
+
+Downloads go through the yt-dlp Python API (in a worker thread for async callers) into a content-addressed disk
+cache: files are named <video id>.<format>.<ext> under MEDIA_CACHE_DIR, so a video requested again is served from
+disk. The cache is kept under MEDIA_CACHE_MAX_BYTES by evicting the least recently used files, and concurrent
+requests for the same video share one download.
+"""
+import asyncio
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from typing import Optional, Tuple
+
+from singleflight import KeyedLocks, SingleFlight
+
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", "media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", str(2 * 2 ** 30)))
+YOUTUBE_COOKIE_FILE = os.environ.get("YOUTUBE_COOKIE_FILE", "../youtube_cookie.txt")
+# m4a audio.
+YOUTUBE_AUDIO_FORMAT = "140"
+# Files used more recently than this are never evicted, they may still be being sent.
+MIN_EVICTION_AGE_SECONDS = 600
+
+_video_id_matcher = re.compile(r"(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([A-Za-z0-9_-]{11})")
+
+
+def extract_video_id(url: str) -> Optional[str]:
+    m = _video_id_matcher.search(url)
+    return m.group(1) if m else None
+
+
+class MediaFetcher:
+    def __init__(
+        self,
+        cache_dir: str = MEDIA_CACHE_DIR,
+        max_bytes: int = MEDIA_CACHE_MAX_BYTES,
+        cookie_file: Optional[str] = YOUTUBE_COOKIE_FILE,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.cookie_file = cookie_file
+        self.single_flight = SingleFlight()
+        self._download_locks = KeyedLocks()
+        self._evict_lock = threading.Lock()
+
+    def cached_path(self, video_id: str, fmt: str = YOUTUBE_AUDIO_FORMAT) -> Optional[str]:
+        """The cached file of the video, if any. Counts as a use for the LRU eviction."""
+        prefix = f"{video_id}.{fmt}."
+        try:
+            names = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if name.startswith(prefix):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    # Evicted in the meantime.
+                    continue
+                return path
+        return None
+
+    def download(self, url: str, fmt: str = YOUTUBE_AUDIO_FORMAT) -> str:
+        """Returns the path of the video's audio in the cache, downloading it first if needed. Blocking."""
+        video_id = extract_video_id(url)
+        if video_id is None:
+            raise ValueError(f"Not a YouTube video link: {url}")
+        with self._download_locks.get((video_id, fmt)):
+            path = self.cached_path(video_id, fmt)
+            if path is not None:
+                return path
+            path = self._download(url, video_id, fmt)
+        self.evict(keep=path)
+        return path
+
+    async def fetch(self, url: str, fmt: str = YOUTUBE_AUDIO_FORMAT) -> str:
+        """Async download(). Concurrent fetches of the same video share one download."""
+        key = (extract_video_id(url) or url, fmt)
+        return await self.single_flight.do(key, lambda: asyncio.to_thread(self.download, url, fmt))
+
+    def _download(self, url: str, video_id: str, fmt: str) -> str:
+        import yt_dlp
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Download next to the cache and move the finished file in, so the cache never holds partial files.
+        work_dir = tempfile.mkdtemp(prefix=f".{video_id}.", dir=self.cache_dir)
+        try:
+            options = {
+                "format": fmt,
+                "outtmpl": os.path.join(work_dir, f"{video_id}.{fmt}.%(ext)s"),
+                "quiet": True,
+                "noprogress": True,
+                "noplaylist": True,
+            }
+            if self.cookie_file and os.path.exists(self.cookie_file):
+                options["cookiefile"] = self.cookie_file
+            with yt_dlp.YoutubeDL(options) as ydl:
+                ydl.download([url])
+            downloaded = os.listdir(work_dir)
+            if not downloaded:
+                raise RuntimeError(f"yt-dlp produced no file for {url}")
+            path = os.path.join(self.cache_dir, downloaded[0])
+            os.replace(os.path.join(work_dir, downloaded[0]), path)
+            return path
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def stats(self) -> Tuple[int, int]:
+        """(files, bytes) in the cache."""
+        try:
+            names = [name for name in os.listdir(self.cache_dir) if not name.startswith(".")]
+        except FileNotFoundError:
+            return 0, 0
+        files = [path for path in (os.path.join(self.cache_dir, name) for name in names) if os.path.isfile(path)]
+        return len(files), sum(os.path.getsize(path) for path in files)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Removes the least recently used files until the cache fits in max_bytes."""
+        with self._evict_lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name.startswith(".") or not os.path.isfile(path):
+                    # In-progress downloads.
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            now = time.time()
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep or now - mtime < MIN_EVICTION_AGE_SECONDS:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
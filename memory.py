@@ -0,0 +1,193 @@
+"""
+Memory accounting and caps for the bot's long-lived objects.
+
+* StateLimiter keeps each user's state (`context.user_data`, all held in RAM by PicklePersistence) bounded: the
+  research chat history is cut to CHAT_HISTORY_MAX_ENTRIES, and the oldest writer-mode notes are spilled to a
+  NoteLog under HISTORY_SPILL_DIR (or dropped, with it empty) beyond HISTORY_MAX_ENTRIES or USER_STATE_MAX_BYTES.
+* memory_report() is the text of the admin /memory command: process RSS, the largest user states, the sizes of the
+  caches and, with MEMORY_TRACEMALLOC=1 (tracemalloc slows allocations down, so it is off by default), the lines
+  allocating the most.
+"""
+import gc
+import os
+import sys
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from note_log import NoteLog
+
+CHAT_HISTORY_MAX_ENTRIES = int(os.environ.get("CHAT_HISTORY_MAX_ENTRIES", "50"))
+HISTORY_MAX_ENTRIES = int(os.environ.get("HISTORY_MAX_ENTRIES", "2000"))
+USER_STATE_MAX_BYTES = int(os.environ.get("USER_STATE_MAX_BYTES", str(8 * 2 ** 20)))
+HISTORY_SPILL_DIR = os.environ.get("HISTORY_SPILL_DIR", "history_spill")
+MEMORY_TRACEMALLOC = os.environ.get("MEMORY_TRACEMALLOC", "0") == "1"
+TRACEMALLOC_FRAMES = 1
+
+
+def deep_sizeof(obj) -> int:
+    """Bytes held by the object and everything it references through containers and instance attributes."""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, "__dict__") and not isinstance(item, type):
+            stack.append(item.__dict__)
+    return total
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def rss_bytes() -> Optional[int]:
+    """Current resident set size, on Linux."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def start_tracemalloc() -> None:
+    if MEMORY_TRACEMALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+
+def top_allocations(limit: int = 10) -> List[str]:
+    if not tracemalloc.is_tracing():
+        return []
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*"),
+    ])
+    return [
+        f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}: {format_bytes(stat.size)} in {stat.count} blocks"
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+
+class StateLimiter:
+    def __init__(
+        self,
+        spill_dir: Optional[str] = HISTORY_SPILL_DIR,
+        chat_history_max_entries: int = CHAT_HISTORY_MAX_ENTRIES,
+        history_max_entries: int = HISTORY_MAX_ENTRIES,
+        max_bytes: int = USER_STATE_MAX_BYTES,
+    ):
+        self.spill_dir = spill_dir
+        self.chat_history_max_entries = chat_history_max_entries
+        self.history_max_entries = history_max_entries
+        self.max_bytes = max_bytes
+        self._spill_log: Optional[NoteLog] = None
+        self.spilled = 0
+
+    @property
+    def spill_log(self) -> Optional[NoteLog]:
+        # Opened on the first spill, most deployments never need it.
+        if self._spill_log is None and self.spill_dir:
+            self._spill_log = NoteLog(self.spill_dir)
+        return self._spill_log
+
+    def spill(self, state: dict, entries: List[dict]) -> None:
+        log = self.spill_log
+        if log is None:
+            return
+        user = state.get("user_id", "default")
+        for entry in entries:
+            fields = {k: v for k, v in entry.items() if k not in ("content", "tag", "date")}
+            note_date = entry.get("date")
+            if isinstance(note_date, str):
+                try:
+                    note_date = datetime.fromisoformat(note_date)
+                except ValueError:
+                    note_date = None
+            # Filed under the day the note was taken, not the day it was spilled.
+            log.append(
+                entry.get("content", ""), user=user, tag=entry.get("tag"),
+                timestamp=note_date if isinstance(note_date, datetime) else None, **fields,
+            )
+        self.spilled += len(entries)
+
+    def enforce(self, state: dict) -> int:
+        """Applies the caps to one user's state, returns the number of notes spilled."""
+        chat_history = state.get("chat_history")
+        if chat_history and len(chat_history) > self.chat_history_max_entries:
+            del chat_history[:len(chat_history) - self.chat_history_max_entries]
+
+        history = state.get("history")
+        if not history:
+            return 0
+        excess = max(0, len(history) - self.history_max_entries)
+        if excess == 0 and deep_sizeof(state) > self.max_bytes:
+            # Drop the oldest notes until the state fits, the per-entry size is a good enough guide.
+            size = deep_sizeof(state)
+            history_size = deep_sizeof(history)
+            per_entry = history_size / len(history)
+            excess = min(len(history), int((size - self.max_bytes) / per_entry) + 1)
+        if excess:
+            self.spill(state, history[:excess])
+            del history[:excess]
+        return excess
+
+
+def snapshot_user_data(user_data: Dict[int, dict]) -> Dict[int, dict]:
+    """Copy of the states and of their lists and dicts, to take on the event loop before measuring in a thread.
+
+    The notes themselves are shared, they are not changed once in a state.
+    """
+    return {
+        user_id: {key: value.copy() if isinstance(value, (list, dict)) else value for key, value in state.items()}
+        for user_id, state in list(user_data.items())
+    }
+
+
+def memory_report(
+    user_data: Dict[int, dict],
+    caches: Dict[str, Callable[[], Tuple[int, int]]],
+    top_users: int = 5,
+) -> str:
+    """Text report. `caches` maps a cache name to a function returning its (entries, bytes).
+
+    Run in a thread, pass user_data through snapshot_user_data() first, as the handlers keep changing the states.
+    """
+    gc.collect()
+    lines = []
+    rss = rss_bytes()
+    if rss is not None:
+        lines.append(f"RSS: {format_bytes(rss)}")
+
+    sizes = sorted(((deep_sizeof(state), user_id) for user_id, state in user_data.items()), reverse=True)
+    lines.append(f"User states: {len(sizes)}, {format_bytes(sum(size for size, _ in sizes))} in total")
+    for size, user_id in sizes[:top_users]:
+        state = user_data[user_id]
+        lines.append(
+            f"  {user_id}: {format_bytes(size)}, {len(state.get('history', []))} notes, "
+            f"{len(state.get('chat_history', []))} chat entries"
+        )
+
+    lines.append("Caches:")
+    for name, measure in caches.items():
+        entries, size = measure()
+        lines.append(f"  {name}: {entries} entries, {format_bytes(size)}")
+
+    allocations = top_allocations()
+    if allocations:
+        lines.append("Top allocations:")
+        lines.extend(f"  {line}" for line in allocations)
+    elif not tracemalloc.is_tracing():
+        lines.append("Set MEMORY_TRACEMALLOC=1 for the top allocations.")
+    return "\n".join(lines)
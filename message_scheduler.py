@@ -0,0 +1,199 @@
+"""
+Outbound message scheduler for the Telegram bot. Replies are queued instead of sent inline, so a handler with 20+
+messages to send (e.g. `a:` or `bs` with 10 papers) returns right away, and the queue paces the sends to stay
+within Telegram's flood limits:
+
+* A global token bucket (OUTBOX_GLOBAL_RATE messages per second) and one per chat (OUTBOX_CHAT_RATE, with bursts of
+  OUTBOX_CHAT_BURST). Each chat has its own worker, so messages to one chat keep their order and a slow chat does not
+  hold up the others.
+* A 429 (RetryAfter) pauses the chat for the requested time, then the message is sent again.
+* Adjacent queued messages to the same chat with the same parse mode and reply target are coalesced into one
+  message, up to the 4096-character limit.
+
+Texts are split with split_for_telegram, which keeps HTML tags intact across messages.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional
+
+from telegram.error import RetryAfter
+
+from message_utils import TELEGRAM_MESSAGE_LIMIT, split_for_telegram
+
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = int(os.environ.get("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_MAX_RETRIES = int(os.environ.get("OUTBOX_MAX_RETRIES", "5"))
+# Separator between coalesced messages.
+COALESCE_SEPARATOR = "\n\n"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class OutboundMessage:
+    bot: object
+    chat_id: int
+    text: str
+    parse_mode: Optional[str] = None
+    reply_to_message_id: Optional[int] = None
+    # Resolved once this message (and everything coalesced into it) is delivered.
+    futures: List[asyncio.Future] = field(default_factory=list)
+
+    def can_coalesce(self, other: "OutboundMessage") -> bool:
+        return (
+            self.parse_mode == other.parse_mode
+            and self.reply_to_message_id == other.reply_to_message_id
+            and len(self.text) + len(COALESCE_SEPARATOR) + len(other.text) <= TELEGRAM_MESSAGE_LIMIT
+        )
+
+
+def retry_after_seconds(error) -> float:
+    retry_after = error.retry_after
+    # A timedelta in newer python-telegram-bot versions, an int before.
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+def quiet(future: asyncio.Future) -> asyncio.Future:
+    # Keep asyncio from warning about errors nobody awaited, the worker prints them.
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    return future
+
+
+class MessageScheduler:
+    def __init__(
+        self,
+        global_rate: float = OUTBOX_GLOBAL_RATE,
+        chat_rate: float = OUTBOX_CHAT_RATE,
+        chat_burst: int = OUTBOX_CHAT_BURST,
+        max_retries: int = OUTBOX_MAX_RETRIES,
+        coalesce: bool = True,
+    ):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.coalesce = coalesce
+        self._queues: Dict[int, Deque[OutboundMessage]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self.sent = 0
+        self.retried = 0
+
+    def send_text(
+        self,
+        bot,
+        chat_id: int,
+        text: str,
+        parse_mode: Optional[str] = None,
+        reply_to_message_id: Optional[int] = None,
+    ) -> asyncio.Future:
+        """Queues the text (split as needed) and returns a future resolved when all of it is delivered.
+
+        The future fails with the error of the first message that could not be sent; nobody has to await it.
+        """
+        futures = []
+        queue = self._queues.setdefault(chat_id, deque())
+        for chunk in split_for_telegram(text, parse_mode=parse_mode):
+            if not chunk:
+                continue
+            future = quiet(asyncio.get_running_loop().create_future())
+            futures.append(future)
+            queue.append(OutboundMessage(bot, chat_id, chunk, parse_mode, reply_to_message_id, [future]))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._run_chat(chat_id))
+        if not futures:
+            futures.append(asyncio.get_running_loop().create_future())
+            futures[0].set_result(None)
+        return quiet(asyncio.gather(*futures))
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self._buckets:
+            # Forget the buckets of chats that have been quiet long enough to be full again.
+            for idle_chat in [c for c, b in self._buckets.items() if c not in self._workers and b.idle()]:
+                del self._buckets[idle_chat]
+            self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self._buckets[chat_id]
+
+    def _next_message(self, queue: Deque[OutboundMessage]) -> OutboundMessage:
+        message = queue.popleft()
+        while self.coalesce and queue and message.can_coalesce(queue[0]):
+            other = queue.popleft()
+            message = OutboundMessage(
+                message.bot, message.chat_id, message.text + COALESCE_SEPARATOR + other.text,
+                message.parse_mode, message.reply_to_message_id, message.futures + other.futures,
+            )
+        return message
+
+    async def _run_chat(self, chat_id: int) -> None:
+        queue = self._queues[chat_id]
+        bucket = self._bucket(chat_id)
+        try:
+            while queue:
+                message = self._next_message(queue)
+                try:
+                    await self._send(message, bucket)
+                except Exception as e:
+                    print(f"Failed to send a message to chat {chat_id}: {e!r}")
+                    for future in message.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                self.sent += 1
+                for future in message.futures:
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            del self._workers[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+
+    async def _send(self, message: OutboundMessage, bucket: TokenBucket) -> None:
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await message.bot.send_message(
+                    chat_id=message.chat_id,
+                    text=message.text,
+                    parse_mode=message.parse_mode,
+                    reply_to_message_id=message.reply_to_message_id,
+                )
+                return
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                # Only this chat waits, the other chats keep going.
+                await asyncio.sleep(retry_after_seconds(e))
@@ -0,0 +1,112 @@
+import re
+from typing import List, Optional, Tuple
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# A tag, an entity, a run of plain text, or a stray < or &.
+_html_token = re.compile(r"<[^<>]*>|&#?\w+;|[^<&]+|[<&]")
+_html_tag = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*?(/?)>")
+
+
+def split_for_telegram(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT, parse_mode: Optional[str] = None) -> List[str]:
+    """Splits the text into messages of at most `limit` characters, preferring to cut between lines.
+
+    With parse_mode "HTML", a cut never falls inside a tag or an entity, and tags open at a cut (e.g. <b>, <a href>)
+    are closed at the end of the message and reopened at the start of the next one.
+    """
+    if parse_mode is not None and parse_mode.upper() == "HTML":
+        return split_html_for_telegram(text, limit)
+    if not text:
+        return [""]
+    chunks = []
+    current = []
+    current_len = 0
+    for paragraph in text.splitlines(keepends=True):
+        if current_len + len(paragraph) > limit and current:
+            chunks.append("".join(current).rstrip())
+            current = []
+            current_len = 0
+        if len(paragraph) > limit:
+            for i in range(0, len(paragraph), limit):
+                chunks.append(paragraph[i:i + limit].rstrip())
+            continue
+        current.append(paragraph)
+        current_len += len(paragraph)
+    if current:
+        chunks.append("".join(current).rstrip())
+    return chunks
+
+
+def _apply_tags(stack: List[Tuple[str, str]], html: str) -> List[Tuple[str, str]]:
+    """The stack of open (name, opening tag) after the given HTML."""
+    stack = list(stack)
+    for m in _html_tag.finditer(html):
+        closing, name, self_closing = m.group(1), m.group(2).lower(), m.group(3)
+        if self_closing:
+            continue
+        if not closing:
+            stack.append((name, m.group(0)))
+            continue
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] == name:
+                del stack[i:]
+                break
+    return stack
+
+
+def _closing_tags(stack: List[Tuple[str, str]]) -> str:
+    return "".join(f"</{name}>" for name, _ in reversed(stack))
+
+
+def _opening_tags(stack: List[Tuple[str, str]]) -> str:
+    return "".join(tag for _, tag in stack)
+
+
+def split_html_for_telegram(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    if not text:
+        return [""]
+    chunks = []
+    stack: List[Tuple[str, str]] = []
+    current = ""
+    has_content = False
+
+    def fits(piece: str, stack_after: List[Tuple[str, str]]) -> bool:
+        return len(current) + len(piece) + len(_closing_tags(stack_after)) <= limit
+
+    def flush() -> None:
+        nonlocal current, has_content
+        if has_content:
+            chunks.append(current.rstrip() + _closing_tags(stack))
+        current = _opening_tags(stack)
+        has_content = False
+
+    for paragraph in text.splitlines(keepends=True):
+        stack_after = _apply_tags(stack, paragraph)
+        if has_content and not fits(paragraph, stack_after):
+            flush()
+        if fits(paragraph, stack_after):
+            current += paragraph
+            stack = stack_after
+            has_content = True
+            continue
+
+        # The paragraph doesn't fit in a message of its own, cut it between tokens.
+        for token in _html_token.findall(paragraph):
+            if token.startswith("<") and len(token) > 1 or token.startswith("&") and len(token) > 1:
+                stack_after = _apply_tags(stack, token)
+                if has_content and not fits(token, stack_after):
+                    flush()
+                current += token
+                stack = stack_after
+                has_content = True
+                continue
+            while token:
+                room = limit - len(current) - len(_closing_tags(stack))
+                if room <= 0:
+                    flush()
+                    room = max(1, limit - len(current) - len(_closing_tags(stack)))
+                current += token[:room]
+                token = token[room:]
+                has_content = True
+    flush()
+    return chunks or [""]
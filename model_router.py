@@ -0,0 +1,280 @@
+"""
+Latency-aware model routing, used by LLMService (the bot's writer mode) and the web app's paraphrasing.
+
+Callers ask for a route ("chat", "writing", "paraphrase") instead of a model. Each route lists its candidate models
+in order of preference with a policy: a latency SLO on the rolling p95, a maximum error rate and a cost ceiling.
+The router keeps rolling latency and error statistics per model and per provider (the last ROUTER_WINDOW calls
+within ROUTER_WINDOW_SECONDS), and picks the first candidate meeting the policy; when none does, the one with the
+lowest p95.
+
+A route can also hedge: if the chosen model has not answered after `hedge_after` seconds (by default its own p95,
+at least ROUTER_MIN_HEDGE_SECONDS), the same request goes to the next candidate as well, and whichever answers first
+wins. This cuts the occasional multi-minute provider stall down to the hedge delay plus a normal call. A model that
+fails outright is failed over to the next candidate immediately.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple, TypeVar
+
+ROUTER_WINDOW = int(os.environ.get("ROUTER_WINDOW", "50"))
+ROUTER_WINDOW_SECONDS = float(os.environ.get("ROUTER_WINDOW_SECONDS", "900"))
+ROUTER_HEDGE = os.environ.get("ROUTER_HEDGE", "1") == "1"
+ROUTER_MIN_HEDGE_SECONDS = float(os.environ.get("ROUTER_MIN_HEDGE_SECONDS", "5"))
+# Below this many samples a model's statistics are not trusted, it is assumed to meet the policy.
+MIN_SAMPLES = 5
+
+T = TypeVar("T")
+
+# Name prefixes of OpenAI's models, chat as well as audio (Whisper, speech) and embeddings.
+OPENAI_MODEL_PREFIXES = ("gpt", "o1", "o3", "o4", "chatgpt", "whisper", "tts", "text-embedding", "omni-moderation")
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    name: str
+    provider: str
+    # Relative cost per call, only compared against RoutePolicy.max_cost.
+    cost: float = 1.0
+
+
+def provider_of(model: str) -> str:
+    if model.startswith("gemini"):
+        return "google"
+    if model.startswith(OPENAI_MODEL_PREFIXES):
+        return "openai"
+    return model.split("-")[0]
+
+
+@dataclass
+class RoutePolicy:
+    candidates: List[str]
+    # Rolling p95 latency in seconds a candidate must stay under, None for no SLO.
+    latency_slo: Optional[float] = None
+    max_error_rate: float = 0.2
+    max_cost: Optional[float] = None
+    hedge: bool = ROUTER_HEDGE
+    # Seconds before the hedged request, None for the p95 of the chosen model.
+    hedge_after: Optional[float] = None
+
+
+class RollingStats:
+    def __init__(self, window: int = ROUTER_WINDOW, window_seconds: float = ROUTER_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        # (time, latency, ok)
+        self.samples: Deque[Tuple[float, float, bool]] = deque(maxlen=window)
+
+    def record(self, latency: float, ok: bool) -> None:
+        self.samples.append((time.monotonic(), latency, ok))
+
+    def _recent(self) -> List[Tuple[float, float, bool]]:
+        cutoff = time.monotonic() - self.window_seconds
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return list(self.samples)
+
+    def count(self) -> int:
+        return len(self._recent())
+
+    def error_rate(self) -> float:
+        samples = self._recent()
+        return sum(not ok for _, _, ok in samples) / len(samples) if samples else 0.0
+
+    def percentile(self, q: float) -> Optional[float]:
+        # Failures count with the time they took, a timeout is as slow as it gets.
+        latencies = sorted(latency for _, latency, _ in self._recent())
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+class ModelRouter:
+    def __init__(self, models: List[ModelSpec], routes: Dict[str, RoutePolicy]):
+        self.models = {model.name: model for model in models}
+        for policy in routes.values():
+            for name in policy.candidates:
+                # E.g. a model added through ROUTE_*_MODELS.
+                self.models.setdefault(name, ModelSpec(name, provider_of(name)))
+        self.routes = routes
+        self.model_stats: Dict[str, RollingStats] = {name: RollingStats() for name in self.models}
+        self.provider_stats: Dict[str, RollingStats] = {
+            model.provider: RollingStats() for model in self.models.values()
+        }
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, model: str, latency: float, ok: bool) -> None:
+        self.model_stats[model].record(latency, ok)
+        self.provider_stats[self.models[model].provider].record(latency, ok)
+
+    @contextmanager
+    def timed(self, model: str):
+        """Records the latency and outcome of the call made in the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.record(model, time.perf_counter() - start, ok=False)
+            raise
+        # Not recorded when cancelled, e.g. a client leaving a stream says nothing about the model.
+        self.record(model, time.perf_counter() - start, ok=True)
+
+    def meets(self, model: str, policy: RoutePolicy) -> bool:
+        stats = self.model_stats[model]
+        provider_stats = self.provider_stats[self.models[model].provider]
+        if stats.count() >= MIN_SAMPLES:
+            if stats.error_rate() > policy.max_error_rate:
+                return False
+            p95 = stats.percentile(0.95)
+            if policy.latency_slo is not None and p95 > policy.latency_slo:
+                return False
+        # A provider-wide outage rules out all its models, even those without enough samples of their own.
+        return provider_stats.count() < MIN_SAMPLES or provider_stats.error_rate() <= policy.max_error_rate
+
+    def choose(self, route: str) -> List[str]:
+        """The route's candidates in the order to try them."""
+        policy = self.routes[route]
+        candidates = [
+            name for name in policy.candidates
+            if policy.max_cost is None or self.models[name].cost <= policy.max_cost
+        ] or list(policy.candidates)
+        good = [name for name in candidates if self.meets(name, policy)]
+        if good:
+            return good + [name for name in candidates if name not in good]
+        # Nothing meets the policy, least bad first.
+        return sorted(candidates, key=lambda name: (
+            self.model_stats[name].error_rate(),
+            self.model_stats[name].percentile(0.95) or 0.0,
+        ))
+
+    def hedge_delay(self, model: str, policy: RoutePolicy) -> float:
+        if policy.hedge_after is not None:
+            return policy.hedge_after
+        stats = self.model_stats[model]
+        p95 = stats.percentile(0.95) if stats.count() >= MIN_SAMPLES else None
+        return max(ROUTER_MIN_HEDGE_SECONDS, p95 if p95 is not None else policy.latency_slo or 0.0)
+
+    async def _attempt(self, model: str, call: Callable[[str], Awaitable[T]]) -> Tuple[T, str]:
+        start = time.perf_counter()
+        try:
+            result = await call(model)
+        except asyncio.CancelledError:
+            # Lost a hedge (or the caller gave up): not recorded, the elapsed time says nothing about the model's
+            # latency and counting it as a success would skew the statistics the routing relies on.
+            raise
+        except Exception:
+            self.record(model, time.perf_counter() - start, ok=False)
+            raise
+        self.record(model, time.perf_counter() - start, ok=True)
+        return result, model
+
+    async def run(self, route: str, call: Callable[[str], Awaitable[T]]) -> Tuple[T, str]:
+        """Runs call(model) on the route's models, returns the result and the model that produced it."""
+        policy = self.routes[route]
+        order = self.choose(route)
+        pending: Dict[asyncio.Task, str] = {}
+        # Launched by the hedge timeout, as opposed to a failover after an error.
+        hedged: Set[asyncio.Task] = set()
+        next_index = 0
+        last_error: Optional[BaseException] = None
+
+        def launch() -> asyncio.Task:
+            nonlocal next_index
+            model = order[next_index]
+            next_index += 1
+            task = asyncio.ensure_future(self._attempt(model, call))
+            pending[task] = model
+            return task
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if policy.hedge and next_index < len(order) and len(pending) == 1:
+                    timeout = self.hedge_delay(next(iter(pending.values())), policy)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The model is slow, hedge with the next one.
+                    self.hedges += 1
+                    hedged.add(launch())
+                    continue
+                for task in done:
+                    model = pending.pop(task)
+                    if task.exception() is None:
+                        if task in hedged:
+                            self.hedge_wins += 1
+                        return task.result()
+                    last_error = task.exception()
+                    print(f"Model {model} failed on route {route}: {last_error!r}")
+                if not pending and next_index < len(order):
+                    launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Rolling statistics per model, e.g. for logging."""
+        return {
+            name: {
+                "provider": self.models[name].provider,
+                "samples": stats.count(),
+                "error_rate": round(stats.error_rate(), 3),
+                "p50": stats.percentile(0.5),
+                "p95": stats.percentile(0.95),
+            }
+            for name, stats in self.model_stats.items()
+        }
+
+
+def env_candidates(name: str, default: str) -> List[str]:
+    return [model.strip() for model in os.environ.get(name, default).split(",") if model.strip()]
+
+
+def env_float(name: str) -> Optional[float]:
+    value = os.environ.get(name, "")
+    return float(value) if value else None
+
+
+# Gemini models through LLMService (the bot), and OpenAI models through core (the web app). The costs are rough
+# relative prices, lower is cheaper.
+GEMINI_MODELS = [
+    ModelSpec("gemini-2.5-flash", "google", cost=1.0),
+    ModelSpec("gemini-2.5-pro-preview-05-06", "google", cost=8.0),
+    ModelSpec("gemini-2.5-pro", "google", cost=8.0),
+]
+OPENAI_MODELS = [
+    ModelSpec("gpt-4", "openai", cost=20.0),
+    ModelSpec("gpt-4o", "openai", cost=5.0),
+    ModelSpec("gpt-4o-mini", "openai", cost=0.3),
+]
+
+
+def bot_router() -> ModelRouter:
+    """Routes of the bot's writer mode: `chat` for notes tagged 聊天, `writing` for the others."""
+    return ModelRouter(GEMINI_MODELS, {
+        "chat": RoutePolicy(
+            env_candidates("ROUTE_CHAT_MODELS", "gemini-2.5-flash,gemini-2.5-pro"),
+            latency_slo=env_float("ROUTE_CHAT_SLO") or 20.0,
+            max_cost=env_float("ROUTE_CHAT_MAX_COST"),
+        ),
+        "writing": RoutePolicy(
+            env_candidates("ROUTE_WRITING_MODELS", "gemini-2.5-pro-preview-05-06,gemini-2.5-pro,gemini-2.5-flash"),
+            latency_slo=env_float("ROUTE_WRITING_SLO") or 90.0,
+            max_cost=env_float("ROUTE_WRITING_MAX_COST"),
+        ),
+    })
+
+
+def web_router() -> ModelRouter:
+    """Route of the web app's paraphrasing."""
+    return ModelRouter(OPENAI_MODELS, {
+        "paraphrase": RoutePolicy(
+            env_candidates("ROUTE_PARAPHRASE_MODELS", "gpt-4,gpt-4o"),
+            latency_slo=env_float("ROUTE_PARAPHRASE_SLO") or 60.0,
+            max_cost=env_float("ROUTE_PARAPHRASE_MAX_COST"),
+        ),
+    })
@@ -0,0 +1,298 @@
+"""
+Note log: the paraphrased notes of every user, for later GPT analysis and dispatching.
+
+Layout under the log directory, one partition per user:
+    <user>/<YYYY-MM-DD>-<NNNN>.jsonl     the segment being written, one JSON line per note
+    <user>/<YYYY-MM-DD>-<NNNN>.jsonl.gz  sealed segments, gzip compressed
+    <user>/index.tsv                     date, tag, segment, offset and length of every note
+
+A segment is sealed (and compressed) when the day changes or it grows past max_segment_bytes.
+
+append() only queues the note; a background thread writes the queue in batches and fsyncs according to the fsync
+policy ("always": after every batch, "interval": at most every fsync_interval seconds, "never"). flush() waits
+until everything queued so far is written.
+
+query(user, start_date, end_date, tag) reads the index and then only the byte ranges of the matching notes, so
+e.g. "notes from last week tagged 聊天" does not scan the whole log.
+
+Only one process should write to a log directory at a time.
+"""
+import gzip
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_USER = "default"
+INDEX_FILE = "index.tsv"
+FSYNC_POLICIES = ("always", "interval", "never")
+
+_unsafe_chars = re.compile(r"[^A-Za-z0-9_.-]")
+_segment_name = re.compile(r"^(\d{4}-\d{2}-\d{2})-(\d{4})\.jsonl$")
+
+
+def partition_name(user) -> str:
+    name = _unsafe_chars.sub("_", str(user)) or DEFAULT_USER
+    # Keep "." and ".." from escaping the log directory.
+    return name if name.strip(".") else DEFAULT_USER
+
+
+@dataclass
+class _Note:
+    user: str
+    record: dict
+    day: str
+    tag: str
+
+
+@dataclass
+class _Segment:
+    name: str
+    day: str
+    file: IO[bytes]
+    size: int
+
+
+class NoteLog:
+    def __init__(
+        self,
+        log_dir: str,
+        max_segment_bytes: int = 16 * 2 ** 20,
+        fsync: str = "interval",
+        fsync_interval: float = 1.0,
+        max_batch: int = 256,
+        compress: bool = True,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync}, choose from {FSYNC_POLICIES}")
+        self.log_dir = log_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_batch = max_batch
+        self.compress = compress
+        os.makedirs(log_dir, exist_ok=True)
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._segments: Dict[str, _Segment] = {}
+        self._indexes: Dict[str, IO[str]] = {}
+        self._last_fsync = time.monotonic()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name="note_log_writer", daemon=True)
+        self._writer.start()
+
+    def append(
+        self, content: str, user=DEFAULT_USER, tag: Optional[str] = None, timestamp: Optional[datetime] = None,
+        **fields,
+    ) -> None:
+        """Queues one note. Returns right away, the note is written by the background thread.
+
+        The note is dated (and filed under the day of) timestamp, now by default; aware timestamps are converted to
+        local time first.
+        """
+        if self._closed:
+            raise RuntimeError("NoteLog is closed")
+        if timestamp is None:
+            timestamp = datetime.now()
+        elif timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone().replace(tzinfo=None)
+        record = {'content': content, 'date': timestamp.strftime('%Y-%m-%d %H:%M:%S'), 'tag': tag, **fields}
+        self._queue.put(_Note(partition_name(user), record, timestamp.strftime('%Y-%m-%d'), tag or ""))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until the notes queued so far are written (and fsynced unless the policy is "never")."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+
+    # Writer thread.
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            notes = [item for item in batch if isinstance(item, _Note)]
+            try:
+                if notes:
+                    self._write(notes)
+                waiting = [item for item in batch if isinstance(item, threading.Event)]
+                if waiting or self.fsync == "always" or (
+                    self.fsync == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval
+                ):
+                    self._sync(force=bool(waiting))
+            except Exception as e:
+                # Keep the writer alive, a full disk may well recover.
+                print(f"NoteLog failed to write {len(notes)} notes: {e!r}")
+
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if any(item is None for item in batch):
+                self._close_files()
+                return
+
+    def _write(self, notes: List[_Note]) -> None:
+        touched = set()
+        for note in notes:
+            line = (json.dumps(note.record, ensure_ascii=False) + "\n").encode("utf-8")
+            segment = self._segment_for(note.user, note.day, len(line))
+            offset = segment.size
+            segment.file.write(line)
+            segment.size += len(line)
+            self._index_for(note.user).write(f"{note.day}\t{note.tag}\t{segment.name}\t{offset}\t{len(line)}\n")
+            touched.add(note.user)
+        for user in touched:
+            self._segments[user].file.flush()
+            self._indexes[user].flush()
+
+    def _sync(self, force: bool = False) -> None:
+        if self.fsync == "never" and not force:
+            return
+        if self.fsync != "never":
+            for segment in self._segments.values():
+                os.fsync(segment.file.fileno())
+            for index in self._indexes.values():
+                os.fsync(index.fileno())
+        self._last_fsync = time.monotonic()
+
+    def _user_dir(self, user: str) -> str:
+        return os.path.join(self.log_dir, user)
+
+    def _index_for(self, user: str) -> IO[str]:
+        if user not in self._indexes:
+            os.makedirs(self._user_dir(user), exist_ok=True)
+            self._indexes[user] = open(os.path.join(self._user_dir(user), INDEX_FILE), "a", encoding="utf-8")
+        return self._indexes[user]
+
+    def _segment_for(self, user: str, day: str, incoming: int) -> _Segment:
+        segment = self._segments.get(user)
+        if segment is not None and segment.day == day and (
+            segment.size == 0 or segment.size + incoming <= self.max_segment_bytes
+        ):
+            return segment
+        if segment is not None:
+            self._seal(user, segment)
+        segment = self._open_segment(user, day)
+        self._segments[user] = segment
+        return segment
+
+    def _open_segment(self, user: str, day: str) -> _Segment:
+        user_dir = self._user_dir(user)
+        os.makedirs(user_dir, exist_ok=True)
+        last_seq = -1
+        for name in os.listdir(user_dir):
+            m = _segment_name.match(name[:-3] if name.endswith(".gz") else name)
+            if not m:
+                continue
+            if name.endswith(".jsonl") and m.group(1) != day:
+                # Left open by a previous process, seal it now.
+                self._compress(os.path.join(user_dir, name))
+            elif m.group(1) == day:
+                last_seq = max(last_seq, int(m.group(2)))
+
+        # Keep appending to today's open segment if it has room, otherwise start the next one.
+        if last_seq >= 0:
+            name = f"{day}-{last_seq:04d}"
+            path = os.path.join(user_dir, name + ".jsonl")
+            if os.path.exists(path) and os.path.getsize(path) < self.max_segment_bytes:
+                return _Segment(name, day, open(path, "ab"), os.path.getsize(path))
+        name = f"{day}-{last_seq + 1:04d}"
+        return _Segment(name, day, open(os.path.join(user_dir, name + ".jsonl"), "ab"), 0)
+
+    def _seal(self, user: str, segment: _Segment) -> None:
+        segment.file.flush()
+        if self.fsync != "never":
+            os.fsync(segment.file.fileno())
+        segment.file.close()
+        self._compress(os.path.join(self._user_dir(user), segment.name + ".jsonl"))
+
+    def _compress(self, path: str) -> None:
+        if not self.compress:
+            return
+        # Write next to it and rename, so readers see either the plain or the complete compressed segment.
+        tmp_path = path + ".gz.tmp"
+        with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, path + ".gz")
+        os.remove(path)
+
+    def _close_files(self) -> None:
+        self._sync(force=True)
+        for segment in self._segments.values():
+            segment.file.close()
+        for index in self._indexes.values():
+            index.close()
+        self._segments = {}
+        self._indexes = {}
+
+    # Reading.
+
+    def query(
+        self,
+        user=DEFAULT_USER,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        tag: Optional[str] = None,
+    ) -> Iterator[dict]:
+        """Yields the notes of the user between start_date and end_date (inclusive), optionally with the given tag.
+
+        Only sees notes that were written, call flush() first to include the queued ones.
+        """
+        user_dir = self._user_dir(partition_name(user))
+        start = start_date.isoformat() if start_date else ""
+        end = end_date.isoformat() if end_date else "9999-12-31"
+
+        # Group the matches by segment, keeping the segments in write order.
+        ranges: Dict[str, List[Tuple[int, int]]] = {}
+        try:
+            with open(os.path.join(user_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 5:
+                        # A line cut short by a crash.
+                        continue
+                    day, note_tag, segment, offset, length = fields
+                    if start <= day <= end and (tag is None or note_tag == tag):
+                        ranges.setdefault(segment, []).append((int(offset), int(length)))
+        except FileNotFoundError:
+            return
+
+        for segment, segment_ranges in ranges.items():
+            yield from self._read_ranges(os.path.join(user_dir, segment + ".jsonl"), segment_ranges)
+
+    def _read_ranges(self, path: str, ranges: List[Tuple[int, int]]) -> Iterator[dict]:
+        for _ in range(2):
+            # The segment may get compressed between the two checks, hence the retry.
+            try:
+                if os.path.exists(path + ".gz"):
+                    f = gzip.open(path + ".gz", "rb")
+                else:
+                    f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            with f:
+                for offset, length in ranges:
+                    # Forward seeks only, which gzip can do without restarting.
+                    f.seek(offset)
+                    data = f.read(length)
+                    if len(data) == length:
+                        yield json.loads(data)
+            return
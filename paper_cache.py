@@ -0,0 +1,180 @@
+"""
+Cache of parsed arXiv papers, and a background prefetcher warming it with the results of `a:` searches.
+
+* PaperCache keeps the last PAPER_CACHE_SIZE papers with their parsed LaTeX, keyed by arXiv id without version, so
+  a link pasted after a search (or pasted again) skips the metadata query, the e-print download and the parsing.
+  It also stays under PAPER_CACHE_MAX_BYTES, and papers taking more than a quarter of that are not cached.
+* PaperPrefetcher downloads and parses the top ARXIV_PREFETCH_TOP_K results of a search in the background, one
+  paper at a time, capped at ARXIV_PREFETCH_BYTES_PER_SECOND, and only while no interactive paper request is
+  running. A paper someone asks for while it is being prefetched is boosted to full speed instead of being
+  downloaded twice.
+"""
+import asyncio
+import copy
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from memory import deep_sizeof, format_bytes
+
+PAPER_CACHE_SIZE = int(os.environ.get("PAPER_CACHE_SIZE", "64"))
+ARXIV_PREFETCH_TOP_K = int(os.environ.get("ARXIV_PREFETCH_TOP_K", "3"))
+ARXIV_PREFETCH_BYTES_PER_SECOND = int(os.environ.get("ARXIV_PREFETCH_BYTES_PER_SECOND", str(1024 * 1024)))
+# Papers waiting to be prefetched, more are dropped.
+PREFETCH_QUEUE_SIZE = 32
+PAPER_CACHE_MAX_BYTES = int(os.environ.get("PAPER_CACHE_MAX_BYTES", str(256 * 2 ** 20)))
+# Papers larger than this fraction of PAPER_CACHE_MAX_BYTES are not cached.
+MAX_PAPER_FRACTION = 0.25
+# Seconds between checks whether the interactive requests are done.
+PREFETCH_IDLE_POLL_SECONDS = 0.5
+
+_version_suffix = re.compile(r"v\d+$")
+
+
+def paper_key(arxiv_id: str) -> str:
+    """The arXiv id without its version, search results have one and pasted links usually not."""
+    return _version_suffix.sub("", arxiv_id)
+
+
+class PaperCache:
+    def __init__(self, max_papers: int = PAPER_CACHE_SIZE, max_bytes: int = PAPER_CACHE_MAX_BYTES):
+        self.max_papers = max_papers
+        self.max_bytes = max_bytes
+        self._papers: "OrderedDict[str, object]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, arxiv_id: str):
+        """The cached ArXiv, with its sections parsed, or None. Shared, copy it before setting attributes."""
+        key = paper_key(arxiv_id)
+        with self._lock:
+            paper = self._papers.get(key)
+            if paper is None:
+                self.misses += 1
+                return None
+            self._papers.move_to_end(key)
+            self.hits += 1
+            return paper
+
+    def put(self, paper) -> None:
+        size = deep_sizeof(paper)
+        if size > self.max_bytes * MAX_PAPER_FRACTION:
+            # E.g. a whole thesis, it would push out many papers for one.
+            print(f"Not caching arXiv paper {paper.arxiv_id}, {format_bytes(size)} parsed")
+            return
+        with self._lock:
+            key = paper_key(paper.arxiv_id)
+            self._evict(key)
+            self._papers[key] = paper
+            self._sizes[key] = size
+            self.bytes += size
+            while len(self._papers) > self.max_papers or self.bytes > self.max_bytes:
+                self._evict(next(iter(self._papers)))
+
+    def _evict(self, key: str) -> None:
+        if key in self._papers:
+            del self._papers[key]
+            self.bytes -= self._sizes.pop(key)
+
+    def __contains__(self, arxiv_id: str) -> bool:
+        with self._lock:
+            return paper_key(arxiv_id) in self._papers
+
+    def __len__(self) -> int:
+        return len(self._papers)
+
+
+class Throttle:
+    """Caps the download bandwidth of background prefetches, except for the papers someone is waiting for."""
+
+    def __init__(self, bytes_per_second: float = ARXIV_PREFETCH_BYTES_PER_SECOND):
+        self.bytes_per_second = bytes_per_second
+        self.boosted: Set[str] = set()
+        self._lock = threading.Lock()
+        self._available = float(bytes_per_second)
+        self._updated = time.monotonic()
+
+    def boost(self, arxiv_id: str) -> None:
+        self.boosted.add(paper_key(arxiv_id))
+
+    def consume(self, nbytes: int, arxiv_id: str) -> None:
+        """Blocks until nbytes may be downloaded. Called from the download thread."""
+        if self.bytes_per_second <= 0 or paper_key(arxiv_id) in self.boosted:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(
+                float(self.bytes_per_second), self._available + (now - self._updated) * self.bytes_per_second
+            )
+            self._updated = now
+            self._available -= nbytes
+            wait = -self._available / self.bytes_per_second if self._available < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class PaperPrefetcher:
+    def __init__(
+        self,
+        cache: PaperCache,
+        top_k: int = ARXIV_PREFETCH_TOP_K,
+        bytes_per_second: float = ARXIV_PREFETCH_BYTES_PER_SECOND,
+        is_busy: Callable[[], bool] = lambda: False,
+    ):
+        self.cache = cache
+        self.top_k = top_k
+        self.throttle = Throttle(bytes_per_second)
+        # True while interactive paper requests are running, the prefetcher waits for them.
+        self.is_busy = is_busy
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[str] = set()
+        self._worker: Optional[asyncio.Task] = None
+        self.prefetched = 0
+
+    def submit(self, papers: Iterable) -> None:
+        """Queues the first top_k of the search results (ArXiv objects with metadata) that are not cached yet."""
+        if self.top_k <= 0:
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue(PREFETCH_QUEUE_SIZE)
+        for paper in list(papers)[:self.top_k]:
+            key = paper_key(paper.arxiv_id)
+            if key in self._queued or key in self.cache:
+                continue
+            try:
+                self._queue.put_nowait(paper)
+            except asyncio.QueueFull:
+                break
+            self._queued.add(key)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    def boost(self, arxiv_id: str) -> None:
+        """Someone is waiting for this paper, download it at full speed if it is being prefetched."""
+        if paper_key(arxiv_id) in self._queued:
+            self.throttle.boost(arxiv_id)
+
+    async def _run(self) -> None:
+        while not self._queue.empty():
+            paper = self._queue.get_nowait()
+            key = paper_key(paper.arxiv_id)
+            try:
+                while self.is_busy():
+                    await asyncio.sleep(PREFETCH_IDLE_POLL_SECONDS)
+                if key not in self.cache:
+                    # The search result may be shared with coalesced requests, parse a copy.
+                    paper = copy.copy(paper)
+                    await asyncio.to_thread(paper.download_latex, self.throttle)
+                    self.cache.put(paper)
+                    self.prefetched += 1
+            except Exception as e:
+                print(f"Prefetching arXiv paper {paper.arxiv_id} failed: {e!r}")
+            finally:
+                self._queued.discard(key)
+                self.throttle.boosted.discard(key)
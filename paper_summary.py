@@ -0,0 +1,259 @@
+"""
+Token-budgeted summarization of a whole paper, used by LLMService.summarize_paper_sections and
+llm_summary.ModelInterface.get_summary.
+
+* Map: the sections are packed in order into calls of at most `budget_tokens` input tokens. Small sections share a
+  call (the model returns one summary per section, as json), and a section too large for one call is split at
+  paragraph boundaries into parts that are summarized separately and joined.
+* Reduce: the section summaries, with the title and abstract, are merged into a whole-paper summary, in rounds if
+  they do not fit in one call. Every round leaves fewer summaries than it got (merging them in pairs when packing
+  by budget would not), so a model that does not shorten them cannot keep the reduce going.
+
+The calls are planned before anything is sent, so plan_summary(...).num_calls and .input_tokens tell the cost of a
+paper up front. Tokens are counted with tiktoken if it is installed, otherwise estimated (one token per CJK
+character, one per four other characters).
+"""
+import asyncio
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+PAPER_SUMMARY_BUDGET_TOKENS = int(os.environ.get("PAPER_SUMMARY_BUDGET_TOKENS", "6000"))
+# Map calls in flight at once for async summarization.
+PAPER_SUMMARY_CONCURRENCY = int(os.environ.get("PAPER_SUMMARY_CONCURRENCY", "4"))
+OVERALL_KEY = "Paper summary"
+
+MAP_PROMPT = (
+    "Generate a summary of each of the following sections of a paper. Each summary should be 1-2 sentences, "
+    "be concise and informative. Return a json object mapping each section title, exactly as given, to its summary."
+)
+REFERENCE_PROMPT = (
+    " Also compare the paper with a reference idea. Summarize how the reference idea is different from the "
+    "section, if the reference idea is relevant. Reference idea: {reference_idea}"
+)
+REDUCE_PROMPT = (
+    "Generate a natural language summary of the following paper, given its title, abstract and the summaries of "
+    "its sections. First, list 1-2 bullet points to summarize the main idea, without simply copying the abstract. "
+    "Second, list 1 bullet point for the methodology innovation, i.e. how it is different from existing works. "
+    "Finally, list 1-2 bullet points to summarize its experimental results, or say \"no experiments\"."
+)
+MERGE_PROMPT = (
+    "The following are summaries of consecutive sections of a paper. Merge them into fewer, shorter summaries, "
+    "keeping the contributions, methods and results. Return plain text."
+)
+
+_cjk = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+_json_block = re.compile(r"\{.*\}", re.DOTALL)
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except ImportError:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    cjk = len(_cjk.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_text(text: str, budget_tokens: int) -> List[str]:
+    """Splits the text into parts of at most budget_tokens, at paragraph boundaries where possible."""
+    parts: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for paragraph in re.split(r"(?<=\n)\s*\n", text):
+        tokens = count_tokens(paragraph)
+        if tokens > budget_tokens:
+            # A single huge paragraph (e.g. a table), cut it by characters.
+            chars = max(1, len(paragraph) * budget_tokens // tokens)
+            pieces = [paragraph[i:i + chars] for i in range(0, len(paragraph), chars)]
+        else:
+            pieces = [paragraph]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece)
+            if current and current_tokens + piece_tokens > budget_tokens:
+                parts.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        parts.append("\n".join(current))
+    return parts
+
+
+@dataclass
+class MapCall:
+    # (section title, part title, text); the part title is the section title, or "<title> (part i/n)".
+    items: List[Tuple[str, str, str]] = field(default_factory=list)
+    tokens: int = 0
+
+    def prompt(self, reference_idea: Optional[str]) -> str:
+        prompt = MAP_PROMPT
+        if reference_idea is not None:
+            prompt += REFERENCE_PROMPT.format(reference_idea=reference_idea)
+        body = "".join(f"\n\nSection title: {part_title}\nSection content: {text}" for _, part_title, text in self.items)
+        return prompt + body
+
+
+@dataclass
+class SummaryPlan:
+    map_calls: List[MapCall]
+    budget_tokens: int
+    # Tokens of the map calls, the reduce pass adds roughly one or two short calls.
+    map_tokens: int = 0
+
+    @property
+    def num_calls(self) -> int:
+        return len(self.map_calls) + 1
+
+    @property
+    def input_tokens(self) -> int:
+        return self.map_tokens
+
+
+def plan_summary(
+    sections: Dict[str, str],
+    budget_tokens: int = PAPER_SUMMARY_BUDGET_TOKENS,
+    reference_idea: Optional[str] = None,
+) -> SummaryPlan:
+    overhead = count_tokens(MAP_PROMPT) + (count_tokens(REFERENCE_PROMPT + reference_idea) if reference_idea else 0)
+    content_budget = max(256, budget_tokens - overhead)
+
+    items: List[Tuple[str, str, str, int]] = []
+    for title, content in sections.items():
+        header_tokens = count_tokens(title) + 8
+        tokens = count_tokens(content) + header_tokens
+        if tokens <= content_budget:
+            items.append((title, title, content, tokens))
+            continue
+        parts = split_text(content, content_budget - header_tokens - 8)
+        for i, part in enumerate(parts):
+            part_title = f"{title} (part {i + 1}/{len(parts)})"
+            items.append((title, part_title, part, count_tokens(part) + header_tokens + 8))
+
+    map_calls: List[MapCall] = []
+    for title, part_title, text, tokens in items:
+        if not map_calls or map_calls[-1].tokens + tokens > content_budget:
+            map_calls.append(MapCall())
+        map_calls[-1].items.append((title, part_title, text))
+        map_calls[-1].tokens += tokens
+    map_tokens = sum(call.tokens + overhead for call in map_calls)
+    return SummaryPlan(map_calls, budget_tokens, map_tokens)
+
+
+def parse_map_output(call: MapCall, output: str) -> List[Tuple[str, str]]:
+    """(section title, summary) per item of the call."""
+    if len(call.items) == 1:
+        # One section, the whole answer is its summary, json or not.
+        try:
+            parsed = json.loads(_json_block.search(output).group(0))
+            if isinstance(parsed, dict) and len(parsed) == 1:
+                output = str(next(iter(parsed.values())))
+        except (AttributeError, ValueError):
+            pass
+        return [(call.items[0][0], output.strip())]
+    try:
+        parsed = json.loads(_json_block.search(output).group(0))
+    except (AttributeError, ValueError):
+        parsed = None
+    if not isinstance(parsed, dict):
+        # Not the json we asked for, keep the answer under all the sections of the call.
+        return [(" / ".join(dict.fromkeys(title for title, _, _ in call.items)), output.strip())]
+    return [(title, str(parsed.get(part_title, parsed.get(title, ""))).strip()) for title, part_title, _ in call.items]
+
+
+def collect_sections(plan: SummaryPlan, outputs: List[str]) -> Dict[str, str]:
+    sections: Dict[str, List[str]] = {}
+    for call, output in zip(plan.map_calls, outputs):
+        for title, summary in parse_map_output(call, output):
+            if summary:
+                sections.setdefault(title, []).append(summary)
+    return {title: " ".join(summaries) for title, summaries in sections.items()}
+
+
+def reduce_prompts(title: str, abstract: str, section_summaries: Dict[str, str], budget_tokens: int) -> List[str]:
+    """One prompt for the whole-paper summary, or the merge prompts of the next round if that does not fit.
+
+    A round always has fewer merge prompts than summaries, so the rounds end even if the merges do not shorten.
+    """
+    lines = [f"{section}: {summary}" for section, summary in section_summaries.items()]
+    header = f"{REDUCE_PROMPT}\n\nTitle: {title}\nAbstract: {abstract}\nSection summaries:\n"
+    if count_tokens(header) + sum(count_tokens(line) + 1 for line in lines) <= budget_tokens or len(lines) <= 1:
+        return [header + "\n".join(lines)]
+    parts = split_text("\n\n".join(lines), budget_tokens - count_tokens(MERGE_PROMPT) - 16)
+    if len(parts) >= len(lines):
+        # The summaries are each about a call's worth already (or got split), packing them would not reduce
+        # anything; merge them in pairs, even if a pair goes over the budget.
+        parts = ["\n\n".join(lines[i:i + 2]) for i in range(0, len(lines), 2)]
+    return [f"{MERGE_PROMPT}\n\n{part}" for part in parts]
+
+
+@dataclass
+class PaperSummary:
+    sections: Dict[str, str]
+    overall: str
+    num_calls: int
+
+    def to_dict(self) -> Dict[str, str]:
+        """The whole-paper summary first, then the section summaries, as shown by ArXiv.to_message."""
+        return {OVERALL_KEY: self.overall, **self.sections}
+
+
+async def summarize_paper_async(
+    generate: Callable[[str], Awaitable[str]],
+    title: str,
+    abstract: str,
+    sections: Dict[str, str],
+    reference_idea: Optional[str] = None,
+    budget_tokens: int = PAPER_SUMMARY_BUDGET_TOKENS,
+    concurrency: int = PAPER_SUMMARY_CONCURRENCY,
+) -> PaperSummary:
+    plan = plan_summary(sections, budget_tokens, reference_idea)
+    slots = asyncio.Semaphore(concurrency)
+    num_calls = 0
+
+    async def call(prompt: str) -> str:
+        nonlocal num_calls
+        async with slots:
+            num_calls += 1
+            return await generate(prompt)
+
+    outputs = await asyncio.gather(*[call(map_call.prompt(reference_idea)) for map_call in plan.map_calls])
+    section_summaries = collect_sections(plan, list(outputs))
+    summaries = dict(section_summaries)
+    while True:
+        prompts = reduce_prompts(title, abstract, summaries, budget_tokens)
+        results = await asyncio.gather(*[call(prompt) for prompt in prompts])
+        if len(prompts) == 1:
+            return PaperSummary(section_summaries, results[0].strip(), num_calls)
+        summaries = {f"Part {i + 1}": result.strip() for i, result in enumerate(results)}
+
+
+def summarize_paper(
+    generate: Callable[[str], str],
+    title: str,
+    abstract: str,
+    sections: Dict[str, str],
+    reference_idea: Optional[str] = None,
+    budget_tokens: int = PAPER_SUMMARY_BUDGET_TOKENS,
+) -> PaperSummary:
+    """Blocking version of summarize_paper_async, making the calls one after another."""
+    plan = plan_summary(sections, budget_tokens, reference_idea)
+    outputs = [generate(map_call.prompt(reference_idea)) for map_call in plan.map_calls]
+    num_calls = len(outputs)
+    section_summaries = collect_sections(plan, outputs)
+    summaries = dict(section_summaries)
+    while True:
+        prompts = reduce_prompts(title, abstract, summaries, budget_tokens)
+        results = [generate(prompt) for prompt in prompts]
+        num_calls += len(results)
+        if len(prompts) == 1:
+            return PaperSummary(section_summaries, results[0].strip(), num_calls)
+        summaries = {f"Part {i + 1}": result.strip() for i, result in enumerate(results)}
@@ -0,0 +1,106 @@
+"""
+A small executor for pipelines of async stages with declared inputs, used by BotCore.handle_voice.
+
+Each Stage names the stages whose results it takes (as keyword arguments). Pipeline.run starts every stage as soon
+as its inputs are ready, so independent stages (e.g. deep research and writer-mode paraphrasing, which both only
+need the transcript) overlap instead of adding up. Per stage:
+* `enabled` turns it off for this run (e.g. from a user's state flag); stages depending on it are skipped too.
+* `timeout` bounds it in seconds; it is cancelled when the time is up.
+* `required` stages abort the whole run when they fail, cancelling everything still running. Other stages just
+  record their error, and the stages depending on them are skipped.
+
+Each stage is timed as a tracing span of its name.
+"""
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from tracing import span
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable[..., Awaitable[Any]]
+    inputs: Tuple[str, ...] = ()
+    timeout: Optional[float] = None
+    enabled: bool = True
+    required: bool = False
+
+
+@dataclass
+class StageResult:
+    value: Any = None
+    error: Optional[BaseException] = None
+    skipped: bool = False
+    duration: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.skipped and self.error is None
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage]):
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Duplicate stage names")
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError(f"Stage {stage.name} takes the unknown stage {name}")
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> List[str]:
+        order: List[str] = []
+        visiting = set()
+
+        def visit(name: str) -> None:
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle through stage {name}")
+            visiting.add(name)
+            for dependency in self.stages[name].inputs:
+                visit(dependency)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    async def _run_stage(self, stage: Stage, tasks: Dict[str, asyncio.Task]) -> StageResult:
+        inputs = {name: await tasks[name] for name in stage.inputs}
+        if not stage.enabled or any(not result.ok for result in inputs.values()):
+            return StageResult(skipped=True)
+        start = time.perf_counter()
+        try:
+            with span(stage.name):
+                value = await asyncio.wait_for(
+                    stage.run(**{name: result.value for name, result in inputs.items()}), stage.timeout
+                )
+        except Exception as e:
+            # Timeouts included.
+            if stage.required:
+                raise
+            print(f"Stage {stage.name} failed: {e!r}")
+            return StageResult(error=e, duration=time.perf_counter() - start)
+        return StageResult(value=value, duration=time.perf_counter() - start)
+
+    async def run(self) -> Dict[str, StageResult]:
+        """Runs all the stages, returns their results by name. Raises the error of a failed required stage."""
+        tasks: Dict[str, asyncio.Task] = {}
+        for name in self.order:
+            # In topological order, so the tasks of a stage's inputs exist when it is created.
+            tasks[name] = asyncio.ensure_future(self._run_stage(self.stages[name], tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            # Let the cancelled stages finish, and keep their errors from being reported as never retrieved.
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,71 @@
+"""
+Single-flight coalescing of identical concurrent calls: while a call for a key is in flight, later callers with the
+same key wait for its result instead of repeating the work. Used by BotCore (arXiv links, arXiv searches, stock
+sentiment) and LLMService (identical prompts), e.g. when several users paste the same link within seconds.
+
+Nothing is cached: once the call finishes, the next call for the key runs again. When every waiter is cancelled
+(e.g. the loser of a hedged model call, or a timed out pipeline stage), the call itself is cancelled too.
+"""
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self._waiters: Dict[Hashable, int] = {}
+        # Number of calls that were served by a call already in flight.
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Runs fn() unless a call for key is in flight, and returns (or raises) the shared result.
+
+        The shared result is the same object for every waiter, so callers must not mutate it.
+        """
+        future = self._calls.get(key)
+        if future is None:
+            # A task of its own, so that a cancelled waiter does not cancel the call for the others.
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not future.done():
+                # Nobody is left waiting for the result, stop the work rather than let it run to the end.
+                future.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved, in case every waiter was cancelled.
+            future.exception()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+class KeyedLocks:
+    """One threading.Lock per key, for serializing blocking work on the same resource (e.g. one arXiv paper)."""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> threading.Lock:
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
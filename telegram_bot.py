@@ -1,4 +1,6 @@
 from typing import List
+import asyncio
+import functools
 import os
 import tempfile
 import json
@@ -14,13 +16,27 @@ from telegram.ext import (
 import telegram.ext.filters as filters
 from subprocess import run, CalledProcessError
 
+from asr import get_asr_backend
 from bot_core import BotCore
+from digest import schedule_digests
 from llm_service import LLMService
-TELEGRAM_MESSAGE_LIMIT = 4096
+from memory import memory_report, snapshot_user_data, start_tracemalloc
+from message_scheduler import MessageScheduler
+from tracing import serve_metrics, span, start_trace
+from transcript_cache import open_transcript_cache
 
 DEEP_RESEARCH_DIR = os.environ.get("DEEP_RESEARCH_DIR", "/home/yuandong/Tongyi/inference")
 DEEP_RESEARCH_ENV_FILE = os.environ.get("DEEP_RESEARCH_ENV_FILE", "/home/yuandong/Tongyi/.env")
 DEEP_RESEARCH_MODEL = os.environ.get("DEEP_RESEARCH_MODEL", "")
+TELEGRAM_PERSISTENCE_FILE = os.environ.get("TELEGRAM_PERSISTENCE_FILE", "gpt_archive.pickle")
+# Let the LLM split the writer-mode tag together with the paraphrase, instead of parsing it locally.
+WRITER_COMBINED_PROMPT = os.environ.get("WRITER_COMBINED_PROMPT", "0") == "1"
+# Serve the stage latency histograms at :METRICS_PORT/metrics in polling mode (the webhook server has /metrics).
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# Speech recognition backend for voice notes, see asr.py. Empty keeps the Gemini transcription of LLMService.
+ASR_BACKEND = os.environ.get("ASR_BACKEND", "")
+# Send each user a daily digest of their writer-mode notes, see digest.py. Enable it on one replica only.
+DAILY_DIGEST = os.environ.get("DAILY_DIGEST", "1") == "1"
 
 telegram_api_token = os.environ.get('TELEGRAM_BOT_TOKEN')
 print(f'Bot token: {telegram_api_token}')
@@ -44,27 +60,6 @@ def load_env_file(path: str, base_env: dict) -> dict:
             env.setdefault(key, value)
     return env
 
-def split_for_telegram(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
-    if not text:
-        return [""]
-    chunks = []
-    current = []
-    current_len = 0
-    for paragraph in text.splitlines(keepends=True):
-        if current_len + len(paragraph) > limit and current:
-            chunks.append("".join(current).rstrip())
-            current = []
-            current_len = 0
-        if len(paragraph) > limit:
-            for i in range(0, len(paragraph), limit):
-                chunks.append(paragraph[i:i + limit].rstrip())
-            continue
-        current.append(paragraph)
-        current_len += len(paragraph)
-    if current:
-        chunks.append("".join(current).rstrip())
-    return chunks
-
 def run_deep_research(query: str) -> str:
     run_dir = DEEP_RESEARCH_DIR
     script_path = os.path.join(run_dir, "run_deep_research.py")
@@ -96,7 +91,16 @@ def run_deep_research(query: str) -> str:
     return payload.get("final_answer") or payload.get("prediction") or ""
 
 llm_service = LLMService(default_model="gemini-2.5-flash", use_cache=True)
-bot_core = BotCore(llm_service=llm_service, deep_research_runner=run_deep_research)
+bot_core = BotCore(
+    llm_service=llm_service,
+    deep_research_runner=run_deep_research,
+    use_combined_prompt=WRITER_COMBINED_PROMPT,
+    asr_backend=get_asr_backend(ASR_BACKEND) if ASR_BACKEND else None,
+    # Forwarded or re-sent voice notes reuse their transcript, see transcript_cache.py.
+    transcript_cache=open_transcript_cache(),
+)
+# Replies go through a paced queue, see message_scheduler.py.
+outbox = MessageScheduler()
 
 
 async def start(update: Update, context: CallbackContext):
@@ -120,14 +124,16 @@ async def help(update: Update, context: CallbackContext):
 
 *Usage*: Send me a voice message, and I will transcribe it for you\. Note I am not a QA bot, and will not answer your questions\. I will only listen to you and transcribe your voice message, with paraphrasing from GPT\-4\.
 
-*Data and privacy*: I log your transcriptions and paraphrased texts, to support a future service of sending summary of your voice messages\. I will not share your data with any third party\. I will not use your data for any purposes other than to provide you with a better service\. You can always check what data are logged by sending /data command, and clear your data \(on our end\) by sending /clear command\.
+*Data and privacy*: I log your transcriptions and paraphrased texts, to send you a daily digest of your voice messages in writer's mode\. I will not share your data with any third party\. I will not use your data for any purposes other than to provide you with a better service\. You can always check what data are logged by sending /data command, and clear your data \(on our end\) by sending /clear command\.
 
 *Commands*: 
 /help: Display this help message\.
 /data: Display any information we had about you from our end\.
 /clear: Clear any information we had about you from our end\.
 /toggle_writer: Toggle writer's mode\. 
+/toggle_deep_research: Toggle deep research on voice messages\.
 /toggle_context_summary: Toggle context summary for deep research\.
+/memory: Show the memory used by the bot\.
 
 """, parse_mode='MarkdownV2')
 
@@ -168,6 +174,17 @@ async def toggle_writer(update: Update, context: CallbackContext):
     writer_mode = bot_core.toggle_writer(context.user_data)
     await update.message.reply_text(f"Writer's mode is set to be {writer_mode}")
 
+async def toggle_deep_research(update: Update, context: CallbackContext):
+    """
+    Toggle deep research on voice messages.
+    """
+    user_full_name = await check_auth(update, context)
+    if user_full_name is None:
+        return
+
+    deep_research = bot_core.toggle_deep_research(context.user_data)
+    await update.message.reply_text(f"Deep research is set to be {deep_research}")
+
 async def toggle_context_summary(update: Update, context: CallbackContext):
     """
     Toggle context summary.
@@ -179,7 +196,25 @@ async def toggle_context_summary(update: Update, context: CallbackContext):
     use_context_summary = bot_core.toggle_context_summary(context.user_data)
     await update.message.reply_text(f"Context summary is set to be {use_context_summary}")
 
-# TODO: send out daily summaries to users.
+async def memory(update: Update, context: CallbackContext):
+    """
+    Show the memory used by the bot, its users and caches.
+    """
+    user_full_name = await check_auth(update, context)
+    if user_full_name is None:
+        return
+
+    caches = {
+        "papers (memory)": lambda: (len(bot_core.paper_cache), bot_core.paper_cache.bytes),
+        "YouTube audio (disk)": bot_core.media_fetcher.stats,
+    }
+    if bot_core.transcript_cache is not None:
+        caches["transcripts (disk)"] = bot_core.transcript_cache.stats
+    # Copied here on the loop, the handlers change the states while the report is computed.
+    user_data = snapshot_user_data(context.application.user_data)
+    report = await asyncio.to_thread(memory_report, user_data, caches)
+    outbox.send_text(context.bot, update.effective_chat.id, report)
+
 async def check_auth(update: Update, context: CallbackContext):
     chat_id = context._chat_id
     user_id = context._user_id
@@ -211,6 +246,17 @@ def build_reply_chain(update: Update) -> List[str]:
     return backward_chain[::-1]
 
 
+def traced_update(handler):
+    """Runs the handler in a trace tagged with the user and the update id, see tracing.py."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext):
+        user_id = update.effective_user.id if update.effective_user else None
+        with start_trace(user_id=user_id, request_id=update.update_id, handler=handler.__name__):
+            with span(f"handler.{handler.__name__}"):
+                return await handler(update, context)
+    return wrapper
+
+@traced_update
 async def handle_text_message(update: Update, context: CallbackContext):
     user_full_name = await check_auth(update, context)
     if user_full_name is None:
@@ -220,48 +266,68 @@ async def handle_text_message(update: Update, context: CallbackContext):
     msg_id = update.message.message_id
     reply_text = update.message.reply_to_message.text if update.message.reply_to_message else None
     reply_chain = build_reply_chain(update) if text == "bs" else None
-    responses = await bot_core.handle_text(context.user_data, text, reply_text=reply_text, reply_chain=reply_chain)
+    responses = await bot_core.handle_text(
+        context.user_data,
+        text,
+        reply_text=reply_text,
+        reply_chain=reply_chain,
+        # "Queued, position N." when the fair scheduler makes it wait, see fair_scheduler.py.
+        notify=lambda notice: outbox.send_text(
+            context.bot, update.effective_chat.id, notice, reply_to_message_id=msg_id
+        ),
+    )
     for response in responses:
         if response.kind == "audio" and response.file_path:
-            await update.message.reply_audio(open(response.file_path, "rb"), reply_to_message_id=msg_id)
+            with span("reply"):
+                await update.message.reply_audio(open(response.file_path, "rb"), reply_to_message_id=msg_id)
             if response.cleanup_path:
                 os.remove(response.file_path)
             continue
         if response.kind == "text" and response.text is not None:
-            for chunk in split_for_telegram(response.text):
-                await update.message.reply_text(
-                    chunk,
-                    parse_mode=response.parse_mode,
-                    reply_to_message_id=msg_id,
-                )
+            outbox.send_text(
+                context.bot,
+                update.effective_chat.id,
+                response.text,
+                parse_mode=response.parse_mode,
+                reply_to_message_id=msg_id,
+            )
 
 async def warn_if_not_voice_message(update: Update, context: CallbackContext):
     if not update.message.voice:
         await update.message.reply_text("Please send me a voice message. I will transcribe it and paraphrase for you.")
 
+@traced_update
 async def transcribe_voice_message(update: Update, context: CallbackContext):
     user_full_name = await check_auth(update, context)
     if user_full_name is None:
         return 
     
-    file_id = update.message.voice.file_id
-    voice_file = await context.bot.get_file(file_id)
-    voice_data = await voice_file.download_as_bytearray()
+    voice = update.message.voice
+
+    async def download_voice() -> bytearray:
+        # Only called when the transcript is not cached.
+        with span("download"):
+            voice_file = await context.bot.get_file(voice.file_id)
+            return await voice_file.download_as_bytearray()
 
     msg_id = update.message.message_id
     reply_text = update.message.reply_to_message.text if update.message.reply_to_message else None
     try:
         result = await bot_core.handle_voice(
             context.user_data,
-            voice_data,
+            download_voice,
             reply_text=reply_text,
             log_research_query=lambda query: print(
                 f'[{user_full_name}] Deep research query:\n{query}'
             ),
             message_date=update.message.date,
+            file_unique_id=voice.file_unique_id,
+            notify=lambda notice: outbox.send_text(
+                context.bot, update.effective_chat.id, notice, reply_to_message_id=msg_id
+            ),
         )
     except Exception as exc:
-        await update.message.reply_text(f"Deep research failed: {exc}", reply_to_message_id=msg_id)
+        await update.message.reply_text(f"Transcription failed: {exc}", reply_to_message_id=msg_id)
         return
 
     if result.transcribed_text:
@@ -269,17 +335,28 @@ async def transcribe_voice_message(update: Update, context: CallbackContext):
 
     for response in result.responses:
         if response.kind == "text" and response.text is not None:
-            for chunk in split_for_telegram(response.text):
-                await update.message.reply_text(chunk, reply_to_message_id=msg_id)
+            outbox.send_text(context.bot, update.effective_chat.id, response.text, reply_to_message_id=msg_id)
 
-commands = [start, help, clear, data, toggle_writer, toggle_context_summary]
+commands = [start, help, clear, data, toggle_writer, toggle_deep_research, toggle_context_summary, memory]
 
-def main():
+def build_application(concurrent_updates: int = 1, use_updater: bool = True) -> Application:
+    """Build the bot application with all handlers registered.
+
+    Args:
+        concurrent_updates (int): number of updates processed concurrently.
+        use_updater (bool): whether to build the polling updater. The webhook server feeds updates itself.
+    """
+    # With MEMORY_TRACEMALLOC=1, for the allocations reported by /memory.
+    start_tracemalloc()
     persistence = PicklePersistence(
-        filepath="gpt_archive.pickle",
+        filepath=TELEGRAM_PERSISTENCE_FILE,
         store_data=PersistenceInput(user_data=True, chat_data=True, bot_data=False),
     )
-    application = Application.builder().token(telegram_api_token).persistence(persistence).build()
+    builder = Application.builder().token(telegram_api_token).persistence(persistence)
+    builder = builder.concurrent_updates(concurrent_updates)
+    if not use_updater:
+        builder = builder.updater(None)
+    application = builder.build()
 
     # on different commands - answer in Telegram
     [ application.add_handler(CommandHandler(f.__name__, f)) for f in commands ]
@@ -289,6 +366,15 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
     application.add_handler(MessageHandler(~filters.VOICE & ~filters.TEXT & ~filters.COMMAND, warn_if_not_voice_message))
 
+    if DAILY_DIGEST:
+        schedule_digests(application, llm_service, outbox)
+    return application
+
+def main():
+    application = build_application()
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+
     # Run the bot until the user presses Ctrl-C
     print('Bot is running...')
     application.run_polling()
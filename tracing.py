@@ -0,0 +1,192 @@
+"""
+Per-stage latency tracing and metrics for the voice pipeline.
+
+* span(stage): times one stage (download, transcode, asr, paraphrase, an outbound arXiv call, ...). The duration is
+  recorded in the `voicenote_stage_duration_seconds` histogram (labels: stage, status) and, if a trace is active,
+  appended to it. Works in both sync and async code, and in threads started with asyncio.to_thread.
+* start_trace(user_id, request_id): groups the spans of one request. When TRACE_DUMP_DIR is set, every finished
+  trace is written to <TRACE_DUMP_DIR>/<request_id>.json.
+* render_metrics(): the histograms in the Prometheus text format, served by the web apps and the webhook server
+  at /metrics, or by serve_metrics(port) for the polling bot.
+
+User and request ids are kept on the trace spans only, so the number of metric series stays bounded.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+TRACE_DUMP_DIR = os.environ.get("TRACE_DUMP_DIR", "")
+
+STAGE_HISTOGRAM = "voicenote_stage_duration_seconds"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            # Per series: one count per bucket, then +Inf count and sum.
+            series = self._series.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for key, series in items:
+            labels = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(self.label_names, key))
+            prefix = f"{labels}," if labels else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {int(count)}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {int(series[-2])}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {int(series[-2])}")
+        return lines
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets=DEFAULT_BUCKETS) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help_text, label_names, buckets)
+        return self.histograms[name]
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+stage_durations = metrics.histogram(STAGE_HISTOGRAM, "Duration of the voice pipeline stages.", ("stage", "status"))
+
+
+@dataclass
+class Span:
+    stage: str
+    start: float
+    duration: float = 0.0
+    status: str = "ok"
+    error: Optional[str] = None
+    tags: Dict[str, object] = field(default_factory=dict)
+
+
+@dataclass
+class Trace:
+    request_id: str
+    user_id: Optional[str] = None
+    start: float = field(default_factory=time.time)
+    tags: Dict[str, object] = field(default_factory=dict)
+    spans: List[Span] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_trace_lock = threading.Lock()
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(user_id=None, request_id=None, **tags):
+    """Groups the spans of one request, e.g. one Telegram update or one web request."""
+    trace = Trace(
+        request_id=str(request_id) if request_id is not None else uuid.uuid4().hex,
+        user_id=str(user_id) if user_id is not None else None,
+        tags=tags,
+    )
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        if TRACE_DUMP_DIR:
+            dump_trace(trace, TRACE_DUMP_DIR)
+
+
+def dump_trace(trace: Trace, dump_dir: str) -> None:
+    os.makedirs(dump_dir, exist_ok=True)
+    with open(os.path.join(dump_dir, f"{trace.request_id}.json"), "w", encoding="utf-8") as f:
+        json.dump(trace.to_dict(), f, ensure_ascii=False, indent=2, default=str)
+
+
+@contextmanager
+def span(stage: str, **tags):
+    """Times the enclosed block as one stage. Exceptions are recorded with status "error" and re-raised."""
+    record = Span(stage=stage, start=time.time(), tags=tags)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record.status = "error"
+        record.error = repr(e)
+        raise
+    finally:
+        record.duration = time.perf_counter() - start
+        stage_durations.observe(record.duration, stage=stage, status=record.status)
+        trace = _current_trace.get()
+        if trace is not None:
+            with _trace_lock:
+                trace.spans.append(record)
+
+
+def render_metrics() -> str:
+    return metrics.render()
+
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def serve_metrics(port: int, host: str = "0.0.0.0"):
+    """Serves /metrics from a background thread, for processes without a web server of their own."""
+    # http.server is slow to import and only the polling bot needs it.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.partition("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
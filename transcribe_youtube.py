@@ -3,14 +3,11 @@
 import argparse
 import os
 import re
-import openai
 import subprocess
 
-openai.api_key = os.environ.get("OPENAI_API_KEY")
-
-file_matcher = re.compile(r"\[ffmpeg\] Correcting container in \"(.*?)\"") 
-file_matcher2 = re.compile(r"\[download\] (.*?) has already been downloaded")
-file_matcher3 = re.compile(r"\[download\] Destination: (.*?)")
+from core import WHISPER_MODEL
+from llm_client import get_llm_client
+from media_fetcher import MediaFetcher
 
 ffmpeg_matcher = re.compile(r"\[segment @ .*?\] Opening '(.*?)' for writing")
 
@@ -29,12 +26,9 @@ def go_through_matchers(output: str, matchers: list[re.Pattern], match_all=False
                     return [m.group(1).strip()]
     return results
 
-def download_youtube(video_url: str) -> str:
-    # First download the video using yt-dlp
-    output = subprocess.check_output(f"yt-dlp --cookies ../youtube_cookie.txt -f 140 {video_url}", shell=True)
-    print(output)
-    file_matchers = [file_matcher, file_matcher2, file_matcher3]
-    return go_through_matchers(output, file_matchers)
+def download_youtube(video_url: str) -> list[str]:
+    # Shares the bot's media cache, a video downloaded before is not fetched again.
+    return [MediaFetcher().download(video_url)]
 
 def transcribe_file(audio_file, segment_time=None):
     if segment_time is not None:
@@ -48,11 +42,10 @@ def transcribe_file(audio_file, segment_time=None):
 
     results = ""
     for i, audio_file in enumerate(audio_files):
-        with open(audio_file, "rb") as file:   
-            response = openai.Audio.transcribe('whisper-1', file)
-            if len(audio_files) > 1:
-                results += f"Segment {audio_file}: {i} of {len(audio_files)}\n"
-            results += response['text'] + "\n"
+        text = get_llm_client().transcribe_sync(audio_file, WHISPER_MODEL)
+        if len(audio_files) > 1:
+            results += f"Segment {audio_file}: {i} of {len(audio_files)}\n"
+        results += text + "\n"
     return results
 
 if __name__ == "__main__":
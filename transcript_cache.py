@@ -0,0 +1,147 @@
+"""
+Persistent cache of transcripts, so a voice note forwarded or sent again is not downloaded, transcoded and
+transcribed a second time.
+
+Entries are keyed by the audio (Telegram's file_unique_id, which is the same for a forwarded voice note, or the
+sha256 of the bytes for uploads) and by the ASR backend, model and prompt that produced them, so switching
+ASR_BACKEND or the Whisper prompt does not serve stale transcripts. They are stored in SQLite at
+TRANSCRIPT_CACHE_PATH, shared by the bot and the web apps, and evicted after TRANSCRIPT_CACHE_TTL_DAYS without use
+or, least recently used first, beyond TRANSCRIPT_CACHE_MAX_ENTRIES.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional, Tuple
+
+# Empty disables the cache.
+TRANSCRIPT_CACHE_PATH = os.environ.get("TRANSCRIPT_CACHE_PATH", "transcripts.sqlite3")
+TRANSCRIPT_CACHE_MAX_ENTRIES = int(os.environ.get("TRANSCRIPT_CACHE_MAX_ENTRIES", "50000"))
+TRANSCRIPT_CACHE_TTL_DAYS = float(os.environ.get("TRANSCRIPT_CACHE_TTL_DAYS", "90"))
+# Eviction runs once every this many insertions.
+EVICT_EVERY = 100
+
+
+def telegram_key(file_unique_id: str) -> str:
+    return f"tg:{file_unique_id}"
+
+
+def content_key(data: bytes) -> str:
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+def asr_identity(asr_backend, llm_model: Optional[str] = None) -> Tuple[str, str, str]:
+    """(backend, model, prompt) of an asr.ASRBackend. None is LLMService's transcription used by the bot, with
+    llm_model (its default_model).
+    """
+    if asr_backend is None:
+        if not llm_model:
+            raise ValueError("llm_model is needed to cache LLMService transcripts")
+        return "llm_service", llm_model, ""
+    return asr_backend.name, asr_backend.model, asr_backend.prompt or ""
+
+
+class TranscriptCache:
+    def __init__(
+        self,
+        path: str = TRANSCRIPT_CACHE_PATH,
+        max_entries: int = TRANSCRIPT_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = TRANSCRIPT_CACHE_TTL_DAYS * 86400,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # Autocommit; WAL lets the bot and the web app use the same file.
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS transcripts ("
+            " audio_key TEXT NOT NULL, backend TEXT NOT NULL, model TEXT NOT NULL, prompt TEXT NOT NULL,"
+            " text TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (audio_key, backend, model, prompt))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used)")
+        self._inserts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+        self, audio_keys: Iterable[str], asr_backend, llm_model: Optional[str] = None, count_miss: bool = True
+    ) -> Optional[str]:
+        """The transcript of the first of the keys found for this backend, model and prompt.
+
+        count_miss=False for a lookup followed by another one of the same request, so that it counts once.
+        """
+        backend, model, prompt = asr_identity(asr_backend, llm_model)
+        now = time.time()
+        with self._lock:
+            for audio_key in audio_keys:
+                row = self._db.execute(
+                    "SELECT text FROM transcripts WHERE audio_key = ? AND backend = ? AND model = ? AND prompt = ?"
+                    " AND last_used >= ?",
+                    (audio_key, backend, model, prompt, now - self.ttl_seconds),
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE transcripts SET last_used = ? WHERE audio_key = ? AND backend = ? AND model = ?"
+                        " AND prompt = ?",
+                        (now, audio_key, backend, model, prompt),
+                    )
+                    self.hits += 1
+                    return row[0]
+            if count_miss:
+                self.misses += 1
+        return None
+
+    def put(self, audio_keys: Iterable[str], asr_backend, text: str, llm_model: Optional[str] = None) -> None:
+        """Stores the transcript under each of the keys, e.g. both the file_unique_id and the content hash."""
+        if not text:
+            # Failed or silent recordings are worth another try.
+            return
+        backend, model, prompt = asr_identity(asr_backend, llm_model)
+        now = time.time()
+        with self._lock:
+            for audio_key in audio_keys:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (audio_key, backend, model, prompt, text, now, now),
+                )
+                self._inserts += 1
+            if self._inserts >= EVICT_EVERY:
+                self._inserts = 0
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        self._db.execute("DELETE FROM transcripts WHERE last_used < ?", (now - self.ttl_seconds,))
+        (count,) = self._db.execute("SELECT COUNT(*) FROM transcripts").fetchone()
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM transcripts WHERE rowid IN"
+                " (SELECT rowid FROM transcripts ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self) -> Tuple[int, int]:
+        """(entries, bytes on disk)."""
+        with self._lock:
+            (count,) = self._db.execute("SELECT COUNT(*) FROM transcripts").fetchone()
+        size = sum(os.path.getsize(path) for path in (self.path, self.path + "-wal") if os.path.exists(path))
+        return count, size
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def open_transcript_cache(path: str = TRANSCRIPT_CACHE_PATH) -> Optional[TranscriptCache]:
+    """The cache at path, or None if disabled (empty path) or the database cannot be opened."""
+    if not path:
+        return None
+    try:
+        return TranscriptCache(path)
+    except sqlite3.Error as e:
+        print(f"Transcript cache disabled, cannot open {path}: {e!r}")
+        return None
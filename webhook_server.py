@@ -0,0 +1,117 @@
+"""
+Webhook deployment mode for the Telegram bot, as an alternative to `telegram_bot.main` (long-polling).
+
+Telegram pushes every update to an HTTPS endpoint served by this module. The update is verified against the
+secret token, put on the application's update queue and acknowledged right away, and the application dispatches
+queued updates concurrently (see TELEGRAM_UPDATE_CONCURRENCY). Several replicas can run behind a load balancer.
+
+Endpoints:
+* POST TELEGRAM_WEBHOOK_PATH: receives a Telegram update (JSON).
+* GET /healthz: liveness, 200 as long as the process serves requests.
+* GET /readyz: readiness, 200 once the bot is started and the update queue is not backed up.
+* GET /metrics: stage latency histograms in the Prometheus text format (see tracing.py).
+
+For local testing, leave TELEGRAM_WEBHOOK_URL unset (the webhook is then not registered with Telegram) and post
+recorded update JSON to the endpoint:
+    curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: $TELEGRAM_WEBHOOK_SECRET" \\
+         -H "Content-Type: application/json" -d @update.json http://localhost:8443/telegram
+
+Run with `python webhook_server.py`, or `hypercorn webhook_server:app --bind 0.0.0.0:8443` in production.
+"""
+import hmac
+import json
+import os
+
+from quart import Quart, Response, request, jsonify
+from telegram import Update
+
+from telegram_bot import build_application
+from tracing import METRICS_CONTENT_TYPE, render_metrics
+
+# Public URL Telegram should post updates to, e.g. https://bot.example.com/telegram. Empty means don't register.
+WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL", "")
+WEBHOOK_PATH = os.environ.get("TELEGRAM_WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.environ.get("TELEGRAM_WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("TELEGRAM_WEBHOOK_PORT", "8443"))
+UPDATE_CONCURRENCY = int(os.environ.get("TELEGRAM_UPDATE_CONCURRENCY", "16"))
+# Readiness fails when more updates than this are waiting, so a load balancer can route around a busy replica.
+MAX_PENDING_UPDATES = int(os.environ.get("TELEGRAM_MAX_PENDING_UPDATES", "256"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+application = build_application(concurrent_updates=UPDATE_CONCURRENCY, use_updater=False)
+app = Quart(__name__)
+
+
+@app.before_serving
+async def startup():
+    await application.initialize()
+    await application.start()
+    if not WEBHOOK_SECRET:
+        print("Warning: TELEGRAM_WEBHOOK_SECRET is not set, incoming updates are not verified.")
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=min(100, max(1, UPDATE_CONCURRENCY)),
+        )
+        print(f"Webhook registered at {WEBHOOK_URL}")
+    print(f"Bot is running in webhook mode with update concurrency {UPDATE_CONCURRENCY}...")
+
+
+@app.after_serving
+async def shutdown():
+    # The webhook is deliberately left registered, other replicas may still be serving it.
+    await application.stop()
+    await application.shutdown()
+
+
+def is_authorized(headers) -> bool:
+    if not WEBHOOK_SECRET:
+        return True
+    return hmac.compare_digest(headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET)
+
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+async def telegram_webhook():
+    if not is_authorized(request.headers):
+        return jsonify({'error': 'Invalid secret token'}), 403
+
+    try:
+        data = json.loads(await request.get_data())
+    except ValueError:
+        return jsonify({'error': 'Invalid update JSON'}), 400
+    # Update.de_json expects an object with an update_id, anything else would fail with a 500.
+    if not isinstance(data, dict) or 'update_id' not in data:
+        return jsonify({'error': 'Invalid update JSON'}), 400
+
+    update = Update.de_json(data, application.bot)
+    if update is None:
+        return jsonify({'error': 'Invalid update JSON'}), 400
+
+    # Acknowledge right away; the application dispatches queued updates concurrently.
+    await application.update_queue.put(update)
+    return jsonify({'ok': True})
+
+
+@app.route('/healthz')
+async def healthz():
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz')
+async def readyz():
+    pending = application.update_queue.qsize()
+    ready = application.running and pending <= MAX_PENDING_UPDATES
+    return jsonify({'ready': ready, 'pending_updates': pending}), 200 if ready else 503
+
+
+@app.route('/metrics')
+async def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
+if __name__ == '__main__':
+    app.run(host=WEBHOOK_HOST, port=WEBHOOK_PORT)